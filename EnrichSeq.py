@@ -5,7 +5,10 @@ DESCRIPTION:
     build script and nextflow.
 
 positional arguments:
-  {db_build,enrichseq}  use enrichseq or build db.
+  {db_build,enrichseq,run,batch,serve,submit}
+                        use enrichseq (or run, with --engine), run a sample
+                        sheet (batch), start the job service (serve), send
+                        it a sample (submit) or build db.
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -14,8 +17,10 @@ optional arguments:
 import argparse
 import sys
 import os
+import time
 from enum import Enum
 import src.py_modules.utils as utils
+import src.py_modules.run_metrics as run_metrics
 
 
 
@@ -26,6 +31,35 @@ CURR_PATH = os.path.dirname(CURR_PATH)
 class SubparserNames(Enum):
     db_build = "db_build"
     enirchseq = "enrichseq"
+    run = "run"
+    batch = "batch"
+    serve = "serve"
+    submit = "submit"
+
+class Engines(Enum):
+    nextflow = "nextflow"
+    native = "native"
+
+class AssemblyModes(Enum):
+    full = "full"
+    subsample = "subsample"
+    normalize = "normalize"
+    skip = "skip"
+
+def add_assembly_arguments(parser: argparse.ArgumentParser):
+    """ adds the options of the assembly stage (see megahitRun.sh) """
+    parser.add_argument("-am", "--assembly_mode", choices=[mode.value for mode in AssemblyModes], default=AssemblyModes.full.value,
+                        help="assemble every read, a subsample, a coverage normalized subset, or skip assembly and classify the reads [Default full]", required=False)
+    parser.add_argument("-af", "--assembly_fraction", default="0.1", help="fraction of the reads assembled with --assembly_mode subsample [Default 0.1]", required=False)
+    parser.add_argument("-ac", "--assembly_coverage", default="20", help="target k-mer coverage with --assembly_mode normalize [Default 20]", required=False)
+    parser.add_argument("-amem", "--assembly_memory", default="auto", help="MEGAHIT memory: auto (from the available memory), bytes, or a fraction of the machine [Default auto]", required=False)
+
+def assembly_options(primary_args) -> dict:
+    """ the assembly options, as build_enrichseq_pipeline arguments """
+    return {"assembly_mode": primary_args.assembly_mode,
+            "assembly_fraction": float(primary_args.assembly_fraction),
+            "assembly_coverage": int(primary_args.assembly_coverage),
+            "assembly_memory": primary_args.assembly_memory}
 
 def parseArgs(argv=None) -> argparse.Namespace:
     """
@@ -44,7 +78,7 @@ def parseArgs(argv=None) -> argparse.Namespace:
     # if db_build
     db_build_parser = subparsers.add_parser(SubparserNames.db_build.value)
     # if enrichseq
-    enrich_parser = subparsers.add_parser(SubparserNames.enirchseq.value)
+    enrich_parser = subparsers.add_parser(SubparserNames.enirchseq.value, aliases=[SubparserNames.run.value])
     enrich_parser.add_argument("-1", "--input_1", help="the input fasta file (single or paired end 1)", required=True)
     enrich_parser.add_argument("-2", "--input_2", help="the input fasta file (single or paired end 2)", required=False)
     enrich_parser.add_argument("-o", "--output", help="the path to the output directory", required=True)
@@ -53,6 +87,48 @@ def parseArgs(argv=None) -> argparse.Namespace:
     enrich_parser.add_argument("-v", "--verbose", action="store_true", help="prints output figures and debug info", required=False)
     enrich_parser.add_argument("-c", "--use_gmm", action="store_false", help="use Gaussian Mixture Model in Merge Overlap", required=False)
     enrich_parser.add_argument("-t", "--threads", help="number of threads to use [Default 4]", required=False)
+    enrich_parser.add_argument("-e", "--engine", choices=[engine.value for engine in Engines], default=Engines.nextflow.value,
+                               help="run the stages with nextflow, or natively in process with stage caching [Default nextflow]", required=False)
+    enrich_parser.add_argument("-k", "--kmer_length", default="20", help="k-mer length for the genome comparison [Default 20]", required=False)
+    enrich_parser.add_argument("-th", "--clustering_threshold", default="0.2", help="similarity threshold for the genome clusters [Default 0.2]", required=False)
+    add_assembly_arguments(enrich_parser)
+    enrich_parser.add_argument("-r", "--resume", action="store_true", help="reuse finished stages of a previous run with the same output", required=False)
+    # if batch (always native, finished stages are reused)
+    batch_parser = subparsers.add_parser(SubparserNames.batch.value)
+    batch_parser.add_argument("-s", "--samples", help="tab separated sample sheet (columns sample, reads_1, reads_2)", required=True)
+    batch_parser.add_argument("-o", "--output", help="the path to the output directory (one sub directory per sample)", required=True)
+    batch_parser.add_argument("-kdb", "--kracken_db", help="the path to the kraken database", required=False)
+    batch_parser.add_argument("-gdb", "--genome_db", help="the path to the phage genome directory", required=False)
+    batch_parser.add_argument("-v", "--verbose", action="store_true", help="prints output figures and debug info", required=False)
+    batch_parser.add_argument("-c", "--use_gmm", action="store_false", help="use Gaussian Mixture Model in Merge Overlap", required=False)
+    batch_parser.add_argument("-t", "--threads", default="4", help="total number of threads to use [Default 4]", required=False)
+    batch_parser.add_argument("-p", "--parallel_samples", default="1", help="samples processed at once, sharing the threads [Default 1]", required=False)
+    batch_parser.add_argument("-k", "--kmer_length", default="20", help="k-mer length for the genome comparison [Default 20]", required=False)
+    batch_parser.add_argument("-th", "--clustering_threshold", default="0.2", help="similarity threshold for the genome clusters [Default 0.2]", required=False)
+    add_assembly_arguments(batch_parser)
+    # if serve (long running job service, see src/py_modules/enrichseq_service.py)
+    serve_parser = subparsers.add_parser(SubparserNames.serve.value)
+    serve_parser.add_argument("-o", "--output", help="the path to the service directory (job outputs and stage cache)", required=True)
+    serve_parser.add_argument("-kdb", "--kracken_db", help="the path to the kraken database", required=False)
+    serve_parser.add_argument("-gdb", "--genome_db", help="the path to the phage genome directory", required=False)
+    serve_parser.add_argument("-c", "--use_gmm", action="store_false", help="use Gaussian Mixture Model in Merge Overlap", required=False)
+    serve_parser.add_argument("-t", "--threads", default="4", help="threads per job [Default 4]", required=False)
+    serve_parser.add_argument("-j", "--max_jobs", default="1", help="jobs running at once [Default 1]", required=False)
+    serve_parser.add_argument("-q", "--queue_size", default="8", help="jobs waiting at most [Default 8]", required=False)
+    serve_parser.add_argument("-fj", "--max_finished_jobs", default="1000", help="finished jobs kept, the oldest are forgotten [Default 1000]", required=False)
+    serve_parser.add_argument("-k", "--kmer_length", default="20", help="k-mer length for the genome comparison [Default 20]", required=False)
+    serve_parser.add_argument("-th", "--clustering_threshold", default="0.2", help="similarity threshold for the genome clusters [Default 0.2]", required=False)
+    add_assembly_arguments(serve_parser)
+    # if submit (client of the service)
+    submit_parser = subparsers.add_parser(SubparserNames.submit.value)
+    submit_parser.add_argument("-1", "--input_1", help="the input fasta file (single or paired end 1)", required=True)
+    submit_parser.add_argument("-2", "--input_2", help="the input fasta file (paired end 2)", required=False)
+    submit_parser.add_argument("-n", "--name", help="label of the job", required=False)
+    submit_parser.add_argument("-w", "--wait", action="store_true", help="wait for the job and print its abundances", required=False)
+    for service_parser in (serve_parser, submit_parser):
+        service_parser.add_argument("--host", default="127.0.0.1", help="host of the service [Default 127.0.0.1]", required=False)
+        service_parser.add_argument("--port", default="8765", help="port of the service [Default 8765]", required=False)
+        service_parser.add_argument("--socket", help="Unix socket of the service (instead of host and port)", required=False)
     return parser.parse_args(argv)
 
 def run_dbbuild():
@@ -94,16 +170,148 @@ def run_enrichseq(primary_args):
         CMD_list += ["--verbose", "True"]
     if primary_args.use_gmm:
         CMD_list += ["--use_gmm"]
+    CMD_list += ["--kmer_length", primary_args.kmer_length]
+    CMD_list += ["--clustering_threshold", primary_args.clustering_threshold]
+    for option, value in assembly_options(primary_args).items():
+        CMD_list += [f"--{option}", str(value)]
     CMD_list += ["--workdir", primary_args.output]
+    CMD_list += ["-work-dir", os.path.join(primary_args.output, "work")] # nextflow task directories
+    trace_path = os.path.join(primary_args.output, "work", "trace.txt")
+    CMD_list += ["-with-trace", trace_path] # task resources, for run_metrics.json
+    if primary_args.resume:
+        CMD_list += ["-resume"]
+    start_time = time.perf_counter()
     out = utils.subproc_call(CMD_list)
+    if os.path.isfile(trace_path):
+        from src.py_modules.enrichseq_stages import nextflow_stage_metrics, WORKFLOW
+        stage_metrics = nextflow_stage_metrics(trace_path, os.path.join(primary_args.output, WORKFLOW))
+        run_metrics.write_run_metrics(primary_args.output, Engines.nextflow.value, stage_metrics,
+                                      time.perf_counter() - start_time)
     return out 
 
+def run_enrichseq_native(primary_args):
+    """
+    This method runs the EnrichSeq stages in process, skipping
+    stages whose inputs and parameters did not change since the
+    last run with the same output directory. The resources used
+    by each stage are saved to <output>/run_metrics.json.
+    """
+    from src.py_modules.pipeline import PipelineRunner
+    from src.py_modules.enrichseq_stages import build_enrichseq_pipeline
+    print(" \n Running Enrichseq (native engine) \n")
+    start_time = time.perf_counter()
+    threads = int(primary_args.threads) if primary_args.threads else 4
+    runner = PipelineRunner(primary_args.output, threads=threads, processes=2)
+    build_enrichseq_pipeline(runner,
+                             read_type="paired" if primary_args.input_2 else "single",
+                             reads_1=primary_args.input_1,
+                             reads_2=primary_args.input_2,
+                             krakendb=primary_args.kracken_db or f"{CURR_PATH}/database/krakenDB/",
+                             genome_directory=primary_args.genome_db or f"{CURR_PATH}/database/ref_genomes/",
+                             threads=threads,
+                             verbose=primary_args.verbose,
+                             use_gmm=primary_args.use_gmm,
+                             kmer_length=int(primary_args.kmer_length),
+                             clustering_threshold=float(primary_args.clustering_threshold),
+                             **assembly_options(primary_args))
+    try:
+        outputs = runner.run()
+    finally: # (a failed run still reports the stages that finished)
+        run_metrics.write_run_metrics(primary_args.output, Engines.native.value, runner.metrics,
+                                      time.perf_counter() - start_time)
+    return outputs
+
+def run_batch(primary_args):
+    """
+    This method runs EnrichSeq on every sample of a sample sheet
+    with one native runner, so the databases and genome indexes
+    are loaded once for the batch. Each sample is written to
+    <output>/<sample>, with the abundances of all samples in
+    <output>/abundance_matrix.tsv.
+    """
+    from src.py_modules.pipeline import PipelineRunner
+    from src.py_modules.enrichseq_batch import read_sample_sheet, build_batch_pipeline
+    start_time = time.perf_counter()
+    samples = read_sample_sheet(primary_args.samples)
+    parallel_samples = max(1, min(int(primary_args.parallel_samples), len(samples)))
+    print(f" \n Running Enrichseq on {len(samples)} samples ({parallel_samples} at once) \n")
+    # (assembly and read classification of a sample run at the same time)
+    runner = PipelineRunner(primary_args.output, threads=2 * parallel_samples, processes=parallel_samples)
+    build_batch_pipeline(runner, samples,
+                         krakendb=primary_args.kracken_db or f"{CURR_PATH}/database/krakenDB/",
+                         genome_directory=primary_args.genome_db or f"{CURR_PATH}/database/ref_genomes/",
+                         threads=int(primary_args.threads),
+                         parallel_samples=parallel_samples,
+                         verbose=primary_args.verbose,
+                         use_gmm=primary_args.use_gmm,
+                         kmer_length=int(primary_args.kmer_length),
+                         clustering_threshold=float(primary_args.clustering_threshold),
+                         **assembly_options(primary_args))
+    try:
+        outputs = runner.run()
+    finally:
+        run_metrics.write_run_metrics(primary_args.output, "batch", runner.metrics,
+                                      time.perf_counter() - start_time)
+    return outputs
+
+def run_service(primary_args):
+    """
+    This method starts the job service, which keeps the worker
+    processes, genome indexes and kraken database warm between jobs.
+    """
+    from src.py_modules.enrichseq_service import EnrichSeqService, make_server
+    settings = {"krakendb": primary_args.kracken_db or f"{CURR_PATH}/database/krakenDB/",
+                "genome_directory": primary_args.genome_db or f"{CURR_PATH}/database/ref_genomes/",
+                "threads": int(primary_args.threads),
+                "use_gmm": primary_args.use_gmm,
+                "kmer_length": int(primary_args.kmer_length),
+                "clustering_threshold": float(primary_args.clustering_threshold),
+                **assembly_options(primary_args)}
+    service = EnrichSeqService(primary_args.output, settings,
+                               max_jobs=int(primary_args.max_jobs),
+                               queue_size=int(primary_args.queue_size),
+                               max_finished_jobs=int(primary_args.max_finished_jobs)).start()
+    server = make_server(service, host=primary_args.host, port=int(primary_args.port),
+                         socket_path=primary_args.socket, verbose=True)
+    print(f" \n Enrichseq service listening on {primary_args.socket or f'{primary_args.host}:{primary_args.port}'} \n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+def run_submit(primary_args):
+    """
+    This method sends a sample to the job service.
+    """
+    import json
+    from src.py_modules.enrichseq_service import EnrichSeqClient
+    client = EnrichSeqClient(host=primary_args.host, port=int(primary_args.port), socket_path=primary_args.socket)
+    job = client.submit(os.path.abspath(primary_args.input_1),
+                        os.path.abspath(primary_args.input_2) if primary_args.input_2 else None,
+                        name=primary_args.name)
+    if primary_args.wait:
+        job = client.wait(job["job_id"])
+    print(json.dumps(job, indent=2))
+    return job
+
 def main():
     primary_args = parseArgs(sys.argv[1:])
     if primary_args.sub_parser == SubparserNames.db_build.value:
         run_dbbuild()
-    elif primary_args.sub_parser == SubparserNames.enirchseq.value:
-        run_enrichseq(primary_args)
+    elif primary_args.sub_parser in (SubparserNames.enirchseq.value, SubparserNames.run.value):
+        if primary_args.engine == Engines.native.value:
+            run_enrichseq_native(primary_args)
+        else:
+            run_enrichseq(primary_args)
+    elif primary_args.sub_parser == SubparserNames.batch.value:
+        run_batch(primary_args)
+    elif primary_args.sub_parser == SubparserNames.serve.value:
+        run_service(primary_args)
+    elif primary_args.sub_parser == SubparserNames.submit.value:
+        run_submit(primary_args)
     else:
         print(__doc__)
 
@@ -1,8 +1,11 @@
 """
 Mutations
 """
+import os
 import sys
 import random
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../../modules/fasta_module")
+from FastaIndex import read_fasta
 
 
 
@@ -12,22 +15,7 @@ def openFasta(fasta_path):
     Description: opens a fasta file
     Input: str - path to fasta file containing tail fibers
     """
-    fastaName2Seq = {}
-    with open(fasta_path, "r") as opened_fasta:
-        fasta_line = opened_fasta.readline()
-        line_counter = 0
-        while fasta_line:
-            if fasta_line[0] == ">":
-                if line_counter > 0: fastaName2Seq[fasta_name] = fasta_seq
-                fasta_name = fasta_line.strip("\n").strip(">")
-                fasta_seq = ""
-            else:
-                fasta_seq += fasta_line.strip("\n").strip(" ").strip("\t")
-            fastaName2Seq[fasta_name] = fasta_seq
-            fasta_line = opened_fasta.readline()
-            line_counter += 0
-
-    return fastaName2Seq
+    return {record.header: record.sequence for record in read_fasta(fasta_path)}
 
 def genome_mutate(genome_path, ani):
     """ creates a genome with an ANI """
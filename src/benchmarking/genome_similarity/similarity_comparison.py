@@ -24,6 +24,8 @@ import altair as alt
 import matplotlib.pyplot as plt
 
 current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../../modules/fasta_module")
+from FastaIndex import fasta_sequence
 
 
 # PRIVATE METHODS
@@ -48,26 +50,15 @@ def __fasta_to_genome(fasta_path) -> str:
     ''' 
         DESCRIPTION:
             Extracts just the genome from the genome member variable, which should be a file path.
-            Currently assumes only single FASTA file is passed (no multi-fasta). 
+            The records of a multi-fasta (contigs of the genome) are concatenated.
         
         INPUT:
-            FASTA/FASTQ file (.fa, .fna, .fasta, .fastq)
+            FASTA file (.fa, .fna, .fasta)
         
         OUTPUT:
             Genome in string format
     '''
-    sequence = ""
-    with open(fasta_path) as fasta_file:
-        fasta_lines = fasta_file.readlines()
-        sequence_i = ""
-        for counter, line in enumerate(fasta_lines):
-            if line[0] == ">": 
-                if (counter != 0):
-                    sequence += (sequence_i.rstrip())
-                    sequence_i = ""
-            elif line[0] != ">":
-                sequence += line.rstrip()
-    return sequence
+    return fasta_sequence(fasta_path)
 
 def extract_genome_path(genomes_directory: Path, filename: str) -> list:
     print(f"Extracting genome paths from: {genomes_directory}")
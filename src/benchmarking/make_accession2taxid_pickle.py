@@ -1,4 +1,9 @@
+import os
+import sys
 import pickle
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../modules/accession_module")
+from AccessionIndex import accession_index
 
 
 file_with_names = "./abundance.tsv"
@@ -26,30 +31,14 @@ def get_needed_ncbi_ids():
     
     return ncbi_ids
 
-ncbi_ids = get_needed_ncbi_ids()
-
-
-dictionary = {}
-
-# grab taxid mappings
-acc2tax_open = open(accession2taxid_file)
-line = acc2tax_open.readline()
-counter = 0
-while(line):
-    line = acc2tax_open.readline()
-    line = line.split("\t")
-    accession = line[1]
-    taxid = line[2]
-    if accession in ncbi_ids:
-        dictionary[accession] = taxid
-    if (len(dictionary.keys()) == len(ncbi_ids)):
-        break
-    counter += 1
-
-    if (counter % 100000 == 0):
-        print(f"{counter} lines have been parsed \n")
-        print(dictionary)
-acc2tax_open.close()
-
-with open('accession2taxid.pickle', 'wb') as handle:
-    pickle.dump(dictionary, handle, protocol=pickle.HIGHEST_PROTOCOL)
+if __name__ == "__main__": # (guarded for the processes building the index)
+    ncbi_ids = get_needed_ncbi_ids()
+
+
+    # grab taxid mappings (from the sorted accession index, built on first use)
+    acc2tax_index = accession_index(accession2taxid_file, processes=os.cpu_count() or 1)
+    dictionary = {accession: str(taxid) for accession, taxid in acc2tax_index.taxids(ncbi_ids).items()}
+    print(f"{len(dictionary)} of {len(ncbi_ids)} NCBI ids found")
+
+    with open('accession2taxid.pickle', 'wb') as handle:
+        pickle.dump(dictionary, handle, protocol=pickle.HIGHEST_PROTOCOL)
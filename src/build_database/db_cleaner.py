@@ -3,8 +3,17 @@
 DESCRIPTION:
     The purpose of this script is to clean the reference genome
     database.
+    The header and length of each genome are read with a pool of
+    processes, and recorded in the taxid index of the directory (keyed by
+    file name, size and modification time, see PathOrganizer.GenomeIndex),
+    so later runs only read the new or changed genomes.
+    Genomes of different taxids with the same sequence (by canonical hash,
+    whatever the line wrapping, strand or record order) are then collapsed
+    into one representative, and the removed ones are recorded in the
+    alias table of the directory (see PathOrganizer.read_aliases), so
+    results can be expanded to every taxid of a sequence.
 USAGE:
-    python db_cleaner.py <genome directory>
+    python db_cleaner.py <genome directory> [processes]
     python db_cleaner.py genome_directory/ 
 TODO:
     TIME COMPLEXITY: O(N+m)
@@ -17,13 +26,13 @@ TODO:
 import os
 import sys
 from pathlib import Path
-from typing import Dict, List
 from tqdm import tqdm
-import multiprocessing as mp
 # in house packages
 current_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(f"{current_path}/../modules/PathOrganizer_module")
-from PathOrganizer import PathOrganizer, PathErrors, DuplicateGenomeError
+from PathOrganizer import PathOrganizer, GenomeIndex, GenomeAlias, read_aliases, save_aliases
+sys.path.append(f"{current_path}/../modules/fasta_module")
+from FastaIndex import read_lengths
 
 
 
@@ -36,53 +45,75 @@ class DB_Duplicate_Cleaner(PathOrganizer):
         given the path to a fasta, this function gets the 
         genome's length
         """
-        genome_seq = ""
-        with open(fasta_path_in) as fasta:
-            for line_index, line in enumerate(fasta.readlines()):
-                if line[0] == ">" and (line_index == 0):
-                    continue
-                elif (line[0] == ">") and (line_index > 0):
-                    break
-                else:
-                    genome_seq += line.strip("\n")
-        return len(genome_seq)
+        for _, length in read_lengths(fasta_path_in): # (the first record)
+            return length
+        return 0
+
+
+def delete_identical_sequences(genome_index: GenomeIndex) -> int:
+    """
+    DESCRIPTION:
+        keeps one genome per sequence hash (the first RefSeq (GCF) file,
+        in name order, or else the first file), deletes the others and
+        adds them to the alias table (aliases of a deleted representative
+        are moved to the new one).
+
+    OUTPUT:
+        number of genomes deleted
+    """
+    hash2entries = {}
+    for file_name, (_, _, entry) in sorted(genome_index.files.items()):
+        if entry.length > 0:
+            hash2entries.setdefault(entry.sequence_hash, []).append(entry)
+    new_aliases = {}
+    for sequence_hash, entries in hash2entries.items():
+        if len(entries) < 2:
+            continue
+        representative = next((entry for entry in entries if "GCF" == entry.path.name[:3]), entries[0])
+        for entry in entries:
+            if entry is not representative:
+                new_aliases[entry.path.name] = GenomeAlias(entry.taxid, entry.accession, entry.path.name,
+                                                           representative.taxid, representative.path.name, sequence_hash)
+    if not new_aliases:
+        return 0
+    aliases = []
+    for alias in read_aliases(genome_index.database_path):
+        moved_to = new_aliases.get(alias.representative_file)
+        if moved_to is not None:
+            alias = alias._replace(representative_taxid=moved_to.representative_taxid,
+                                   representative_file=moved_to.representative_file)
+        aliases.append(alias)
+    save_aliases(genome_index.database_path, aliases + list(new_aliases.values()))
+    for file_name in tqdm(new_aliases):
+        os.remove(genome_index.database_path / file_name)
+    genome_index.update()
+    return len(new_aliases)
 
 
 def main():
     # INPUT ARGUMENTS
     genome_dir_path = sys.argv[1]
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
 
-    # get the paths to all genomes
-    full_genome_paths = [Path(genome_dir_path) / Path(fasta_file)
-                         for fasta_file in os.listdir(genome_dir_path)]
-
-    # obtain genomes to keep (keep the ones with longest genome.)
+    # read the headers and lengths of the new or changed genomes (the others are in the taxid index)
     print("FINDING FILES TO KEEP")
-    db_cleaner = DB_Duplicate_Cleaner(genome_dir_path)
-    taxid2PathAndLength: Dict[int, List[str]] = {}
-    genome_count = {}
-    for genome_path in tqdm(full_genome_paths): # O(N)
-        tax_id = int(db_cleaner.get_fasta_taxid(genome_path))
-        genome_length =  db_cleaner.get_genome_length(genome_path)
-        if tax_id in taxid2PathAndLength.keys():
-            original_length = taxid2PathAndLength[tax_id][1]
-            # print(tax_id, genome_length)
-            genome_count[tax_id] += 1
-            if "GCF" == Path(genome_path).name[:3]:
-                taxid2PathAndLength[tax_id] = [genome_path, genome_length]
+    genome_index = GenomeIndex(genome_dir_path)
+    genome_index.update(processes=processes)
+    print(f"read {genome_index.files_read} new or changed genome(s) of {len(genome_index.files)}")
 
-            # uncomment the below if selecting for the largest genome, if duplicates
-            # if genome_length > original_length:
-            #     taxid2PathAndLength[tax_id] = [genome_path, genome_length]
-        else:
-            taxid2PathAndLength[tax_id] = [genome_path, genome_length]
-            genome_count[tax_id] = 1
-
-    # get paths to keep 
+    # obtain genomes to keep (the first file, in name order, or the last RefSeq (GCF) one)
     files_to_keep = {}
-    for taxid, pathAndLength in taxid2PathAndLength.items():
-        path_of_genome = pathAndLength[0]
-        files_to_keep[path_of_genome] = 1
+    genome_count = {}
+    for tax_id, entries in genome_index.taxid2entries.items():
+        kept_entry = entries[0]
+        for entry in entries[1:]:
+            if "GCF" == entry.path.name[:3]:
+                kept_entry = entry
+            # uncomment the below if selecting for the largest genome, if duplicates
+            # if entry.length > kept_entry.length:
+            #     kept_entry = entry
+        files_to_keep[kept_entry.path] = 1
+        genome_count[tax_id] = len(entries)
 
     delete = []
     for key, val in genome_count.items():
@@ -94,12 +125,18 @@ def main():
     # delete files not in files_to_keep
     print("DELETNG DUPLICATE FILES")
     duplicate_count = 0
-    for genome_path in tqdm(full_genome_paths):
-        if genome_path not in files_to_keep.keys():
+    for file_name, (_, _, entry) in tqdm(sorted(genome_index.files.items())):
+        if entry.path not in files_to_keep.keys():
             duplicate_count += 1
-            os.remove(f"{genome_path}")
+            os.remove(f"{entry.path}")
+    if duplicate_count:
+        genome_index.update()
+
+    # collapse genomes of the same sequence (under different taxids)
+    print("DELETING IDENTICAL SEQUENCES")
+    identical_count = delete_identical_sequences(genome_index)
 
-    print(f"SUCCESS! Deleted {duplicate_count} duplicate(s)")
+    print(f"SUCCESS! Deleted {duplicate_count} duplicate(s) and {identical_count} identical sequence(s)")
 
 if __name__ == "__main__":
     main()
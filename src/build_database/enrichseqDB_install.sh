@@ -209,7 +209,8 @@ function multifasta2fasta(){
 
 ####
 # Description: 
-#      Deletes duplicate genomes in the genome directory
+#      Deletes duplicate genomes in the genome directory (same taxid, or
+#      same sequence under another taxid, kept in the alias table)
 # Errors:
 #      1. If db_cleaner.py not found
 ####
@@ -226,6 +227,30 @@ function delete_duplicates() {
   fi
 }
 
+####
+# Description: 
+#      Builds the taxid index of the genome directory (used by PathOrganizer
+#      to find genomes without reading every file) and the packed genome
+#      store (2-bit sequences, memory mapped when genomes are read)
+# Errors:
+#      1. If PathOrganizer.py not found
+####
+function build_genome_index() {
+  add_to_log "";
+  add_to_log "RUNNING: build_genome_index()";
+  local path_organizer_py=${DIR}/../modules/PathOrganizer_module/PathOrganizer.py
+  local genome_store_py=${DIR}/../modules/PathOrganizer_module/GenomeStore.py
+  local genome_dir=$1
+  if [[ ! -f ${path_organizer_py} ]]; then
+    throw_fatal_error "${path_organizer_py} is not found!";
+  else
+    python ${path_organizer_py} ${genome_dir}
+    add_to_log "SUCCESS: build_genome_index() indexed the genomes in ${genome_dir}";
+    python ${genome_store_py} ${genome_dir}
+    add_to_log "SUCCESS: build_genome_index() packed the genomes in ${genome_dir}";
+  fi
+}
+
 ####
 # Description: (Helper Function)
 #      Moves a file into a directory
@@ -326,6 +351,7 @@ function run_PIPELINE() {
     reorganizeFiles ${genomeDir} ${dbDir} ${actinoOutFile};                   
     multifasta2fasta ${movedActinoOutFile} ${genomeDir};
     delete_duplicates ${genomeDir};
+    build_genome_index ${genomeDir};
     addGenomesToDb ${genomeDir} ${dbDir};                                       
     buildKrakenDb ${dbDir};
 }
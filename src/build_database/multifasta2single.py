@@ -7,9 +7,13 @@ USAGE:
 EXAMPLE:
     python multifasta2single.py ref_genomes/actinoReformatted.fa ref_genomes/
 """
+import os
 import sys
 from pathlib import Path
 from tqdm import tqdm
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../modules/fasta_module")
+from FastaIndex import read_fasta
 
 
 
@@ -21,19 +25,9 @@ def multiFasta2fasta(multifasta_path):
     OUTPUT - 1. name (ordered list); 2. genome sequence (ordered list)
     """
     seq_names, sequences = [], []
-    with open(multifasta_path) as  multi_fasta_file:
-        fasta_input =  multi_fasta_file.readlines()
-        sequence_i = ""
-        for counter, line in enumerate(fasta_input):
-            if (line[0] == ">"):
-                seq_name = line[1:]
-                seq_names.append(seq_name.strip("\n"))
-                if (counter != 0):
-                    sequences.append(sequence_i.strip("\n"))
-                    sequence_i = "" # renew sequence
-            else:
-                sequence_i += line.strip("\n")
-        sequences.append(sequence_i.strip("\n"))
+    for record in read_fasta(multifasta_path):
+        seq_names.append(record.header)
+        sequences.append(record.sequence)
     return seq_names, sequences
 
 def addSeqsToFiles(output_directory, seq_names, sequences):
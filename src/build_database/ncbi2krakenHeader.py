@@ -8,7 +8,8 @@ YOU AREN'T USING THE SCRIPT CORRECTLY, CORRECT USAGE IS BELOW:
 USAGE:
     python ncbi2krakenHeader.py path/to/nucl_gb.accession2taxid path/to/genome_directory/
 NOTE: 
-    puts everything into memory!
+    the mapping is converted into a sorted binary index on first use
+    (<mapping>.a2t, see modules/accession_module), reused by later runs.
 INPUT:
     1. NCBI genbank file path
 OUTPUT:
@@ -18,6 +19,10 @@ import sys
 import os
 from tqdm import tqdm
 from pathlib import Path
+# in house packages
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../modules/accession_module")
+from AccessionIndex import accession_index
 
 
 
@@ -38,30 +43,15 @@ def get_acc2tax_map(genome_directory):
             accession_dict[accession_id] = 0
     return accession_dict
 
-def accession2taxid(genbank_file_path, accession_dict, delimiter="\t"):
+def accession2taxid(genbank_file_path, accession_dict, processes=None):
     """
     This function takes in a genabk file and
     returns a dictoinary mappinig the accession id
     to a NCBI tax id. 
     """
-    accession2taxid = {}
-    print("    Starting to read mapping file. Takes a couple of minutes... ")
-    with open(genbank_file_path) as gb_file:
-        counter = 0
-        while True:
-            line = gb_file.readline()
-            # If line is empty then end of file reached
-            if not line:
-                break
-            line = line.split(delimiter)
-            accessonAndVersion = line[1]
-            taxid = line[2]
-            if accessonAndVersion in accession_dict.keys():
-                accession2taxid[accessonAndVersion] = taxid
-            counter += 1
-            if (counter % 10000000) == 0:
-                print(f"        working on line #: {counter}")
-    return accession2taxid
+    print("    Opening the accession index (built on first use, takes a couple of minutes)... ")
+    index = accession_index(genbank_file_path, processes=processes or os.cpu_count() or 1)
+    return index.taxids(accession_dict.keys())
 
 def file2correctHeader(acc2taxid, genome_directory):
     """
@@ -0,0 +1,277 @@
+"""
+DESCRIPTION:
+    This module packs the genomes of a genome directory into one file.
+    Every sequence is 2-bit encoded (4 bases per byte), with a table of
+    the records of each genome file (taxid, header, offset and length) and
+    of the bases that are not A, C, G or T, or are lowercase, so the
+    sequences are decoded exactly. The file is memory mapped: a sequence
+    (or part of one) is read by slicing the mapped bytes, and only that
+    slice is decoded.
+
+    The store is kept next to the genome directory, as
+    .<directory name>.genomes.2bit, and is built by db_build. Genome files
+    whose size or modification time changed since the store was built
+    are read from their FASTA instead (see GenomeStore.has).
+
+USAGE:
+    python GenomeStore.py <genome directory>
+
+Classes
+    1. StoredRecord - a sequence of the store.
+    2. GenomeStore - the packed sequences of a genome directory.
+
+Methods
+    1. genome_store - the store of a genome directory, opened once per process.
+"""
+# std packages
+import os
+import sys
+import mmap
+import json
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+# non-std packages
+import numpy as np
+# in-house packages
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_path)
+from PathOrganizer import TAXID_TAG
+sys.path.append(f"{current_path}/../fasta_module")
+from FastaIndex import read_fasta
+
+
+MAGIC = b"ESQ2BIT1"
+HEADER = struct.Struct("<8sQ") # magic, offset of the table (JSON, after the packed sequences)
+BASES = b"ACGT"
+ENCODE = np.zeros(256, dtype=np.uint8)
+VALID = np.zeros(256, dtype=bool)
+for code, base in enumerate(BASES):
+    ENCODE[base] = code
+    VALID[base] = True
+# packed byte -> its 4 bases
+DECODE = np.array([[BASES[(byte >> shift) & 3] for shift in (6, 4, 2, 0)] for byte in range(256)], dtype=np.uint8)
+
+
+class StoredRecord(NamedTuple):
+    """ a sequence of the store (offset in bytes of the packed data, length in bases) """
+    name: str
+    offset: int
+    length: int
+    exceptions: List[Tuple[int, int, str]] # (start, length, base) runs of bases other than ACGT
+    lowercase: List[Tuple[int, int]] # (start, length) runs of lowercase bases
+
+
+def _runs(mask: np.ndarray, values: Optional[np.ndarray] = None) -> List[Tuple[int, int]]:
+    """ (start, length) of the runs of True in mask (split where values change) """
+    positions = np.flatnonzero(mask)
+    if len(positions) == 0:
+        return []
+    new_run = np.ones(len(positions), dtype=bool)
+    new_run[1:] = np.diff(positions) != 1
+    if values is not None:
+        new_run[1:] |= values[positions][1:] != values[positions][:-1]
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(positions)))
+    return [(int(positions[start]), int(length)) for start, length in zip(run_starts, run_lengths)]
+
+
+def pack_sequence(sequence: bytes) -> Tuple[bytes, List[Tuple[int, int, str]], List[Tuple[int, int]]]:
+    """
+    DESCRIPTION:
+        2-bit encodes a sequence (the bases other than ACGT are stored as A,
+        and listed in the exceptions).
+
+    OUTPUT:
+        packed bytes, exceptions, lowercase runs
+    """
+    characters = np.frombuffer(sequence, dtype=np.uint8)
+    lowercase = (characters >= ord("a")) & (characters <= ord("z"))
+    uppercase = np.where(lowercase, characters - 32, characters).astype(np.uint8)
+    exceptions = [(start, length, chr(uppercase[start]))
+                  for start, length in _runs(~VALID[uppercase], uppercase)]
+    codes = ENCODE[uppercase]
+    codes = np.concatenate([codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+    return packed.astype(np.uint8).tobytes(), exceptions, _runs(lowercase)
+
+
+class GenomeStore:
+    """
+    DESCRIPTION:
+        The packed sequences of a genome directory (use genome_store to
+        share an open store within a process).
+
+    INPUT:
+        1. genome directory
+    """
+
+    def __init__(self, database):
+        self.database_path = Path(database).resolve()
+        self.store_path = self.database_path.parent / f".{self.database_path.name}.genomes.2bit"
+        self.files: Dict[str, Dict] = {} # file name -> size, mtime_ns, taxid, records
+        self.store_stat: Optional[Tuple[int, int]] = None
+        self._map: Optional[mmap.mmap] = None
+        self._data_offset = HEADER.size
+        self.open()
+
+    def open(self):
+        """ memory maps the store (left empty if there is none) """
+        try:
+            with open(self.store_path, "rb") as store_file:
+                stat = os.fstat(store_file.fileno())
+                store_map = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        magic, table_offset = HEADER.unpack_from(store_map, 0)
+        if magic != MAGIC:
+            store_map.close()
+            return
+        table = json.loads(store_map[table_offset:].decode())
+        self.files = {file_name: {**genome_file, "records": [StoredRecord(*record) for record in genome_file["records"]]}
+                      for file_name, genome_file in table["files"].items()}
+        self.store_stat = (stat.st_size, stat.st_mtime_ns)
+        self._map = store_map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.files = {}
+
+    @property
+    def nbytes(self) -> int:
+        """ size of the store file """
+        return self.store_stat[0] if self.store_stat else 0
+
+    def has(self, genome_path) -> bool:
+        """ True if the genome file is stored, and hasn't changed since """
+        genome_path = Path(genome_path)
+        genome_file = self.files.get(genome_path.name)
+        if genome_file is None or genome_path.resolve().parent != self.database_path:
+            return False
+        try:
+            stat = os.stat(genome_path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (genome_file["size"], genome_file["mtime_ns"])
+
+    def taxid(self, genome_path) -> int:
+        return self.files[Path(genome_path).name]["taxid"]
+
+    def records(self, genome_path) -> List[StoredRecord]:
+        """ the sequences of a genome file, in file order """
+        return self.files[Path(genome_path).name]["records"]
+
+    def packed(self, record: StoredRecord) -> memoryview:
+        """ the packed bytes of a record (a view of the mapped file, not a copy) """
+        start = self._data_offset + record.offset
+        return memoryview(self._map)[start:start + (record.length + 3) // 4]
+
+    def sequence(self, record: StoredRecord, start: int = 0, end: Optional[int] = None) -> str:
+        """ the bases [start, end) of a record, decoded from the mapped file """
+        end = record.length if end is None else min(end, record.length)
+        start = max(0, start)
+        if start >= end:
+            return ""
+        first_byte = start // 4
+        packed = np.frombuffer(self._map, dtype=np.uint8, count=(end + 3) // 4 - first_byte,
+                               offset=self._data_offset + record.offset + first_byte)
+        bases = DECODE[packed].reshape(-1)[start - 4 * first_byte:end - 4 * first_byte]
+        for run_start, run_length, base in record.exceptions:
+            if run_start < end and run_start + run_length > start:
+                bases[max(run_start, start) - start:min(run_start + run_length, end) - start] = ord(base)
+        for run_start, run_length in record.lowercase:
+            if run_start < end and run_start + run_length > start:
+                bases[max(run_start, start) - start:min(run_start + run_length, end) - start] += 32
+        return bases.tobytes().decode()
+
+    def genome(self, genome_path) -> str:
+        """ the sequences of a genome file, concatenated """
+        return "".join(self.sequence(record) for record in self.records(genome_path))
+
+    @classmethod
+    def build(cls, database) -> "GenomeStore":
+        """
+        DESCRIPTION:
+            packs the genome files of a directory (the packed sequences of
+            the files that did not change are copied from the last store).
+
+        OUTPUT:
+            the new store
+        """
+        previous = cls(database)
+        temporary_path = previous.store_path.with_name(f"{previous.store_path.name}.{os.getpid()}.tmp")
+        files = {}
+        try:
+            with open(temporary_path, "wb") as store_file:
+                store_file.write(HEADER.pack(MAGIC, 0))
+                data_size = 0
+                with os.scandir(previous.database_path) as directory:
+                    genome_files = sorted((genome_file for genome_file in directory
+                                           if not genome_file.name.startswith(".") and genome_file.is_file()),
+                                          key=lambda genome_file: genome_file.name)
+                for genome_file in genome_files:
+                    stat = genome_file.stat()
+                    records = []
+                    if previous.has(genome_file.path):
+                        taxid = previous.taxid(genome_file.path)
+                        for record in previous.records(genome_file.path):
+                            records.append(record._replace(offset=data_size))
+                            data_size += store_file.write(previous.packed(record))
+                    else:
+                        taxid = 0
+                        for record_number, record in enumerate(read_fasta(genome_file.path)):
+                            if record_number == 0:
+                                taxid = record.header.partition(TAXID_TAG)[2].split(" ")[0]
+                                taxid = int(taxid) if taxid.isdigit() else 0
+                            packed, exceptions, lowercase = pack_sequence(record.sequence.encode())
+                            records.append(StoredRecord(record.header, data_size, len(record.sequence),
+                                                        exceptions, lowercase))
+                            data_size += store_file.write(packed)
+                    files[genome_file.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                               "taxid": taxid, "records": records}
+                table_offset = HEADER.size + data_size
+                store_file.write(json.dumps({"files": files}).encode())
+                store_file.seek(0)
+                store_file.write(HEADER.pack(MAGIC, table_offset))
+            previous.close()
+            os.replace(temporary_path, previous.store_path)
+        finally:
+            previous.close()
+            if temporary_path.exists():
+                temporary_path.unlink()
+        return cls(database)
+
+
+# the store of each genome directory, shared within a process
+_STORES: Dict[Path, GenomeStore] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def genome_store(database) -> GenomeStore:
+    """ the store of a genome directory (reopened if it was rebuilt, empty if there is none) """
+    database_path = Path(database).resolve()
+    with _STORES_LOCK:
+        store = _STORES.get(database_path)
+        if store is not None:
+            try:
+                stat = os.stat(store.store_path)
+                current = store.store_stat == (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = store.store_stat is None
+            if current:
+                return store
+            store.close()
+        store = _STORES[database_path] = GenomeStore(database_path)
+        return store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("USAGE: python GenomeStore.py <genome directory>")
+        sys.exit(1)
+    store = GenomeStore.build(sys.argv[1])
+    fasta_bytes = sum(genome_file["size"] for genome_file in store.files.values())
+    print(f"{len(store.files)} genomes packed in {store.store_path} ({store.nbytes} bytes, {fasta_bytes} as FASTA)")
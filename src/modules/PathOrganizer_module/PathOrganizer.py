@@ -1,14 +1,31 @@
-
 """
 DESCRIPTION:
     This module contains objects and methods for path disambiguation. 
+
+    Genomes are found with a taxid index of the genome directory (taxid,
+    accession, name and length of each genome file), stored next to the
+    directory as .<directory name>.taxid_index.tsv. The index is built by
+    db_build, and is updated (reading only the new or changed files) when
+    the files of the directory change.
+    The sequences can be read from the packed genome store of the
+    directory (see GenomeStore.py).
+
+USAGE:
+    python PathOrganizer.py <genome directory>    (builds the taxid index)
 """
 # std packages
 import os
+import sys
+import csv
+import threading
+import multiprocessing
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 import re
 # non-std packages
+# in-house packages
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../fasta_module")
+from FastaIndex import read_fasta, fasta_sequence, record_digest, combine_digests
 
 
 
@@ -46,33 +63,249 @@ class HeaderError(PathErrors):
         self.genome_name = genome_name
         self.message = message
 
+# taxid index
+TAXID_TAG = "|kraken:taxid|"
+INDEX_FIELDS = ["file", "size", "mtime_ns", "taxid", "accession", "length", "name", "sequence_hash"]
+PARALLEL_READ_MIN_FILES = 256 # fewer new files are read in the calling process
+
+
+class GenomeEntry(NamedTuple):
+    """ a genome file of the genome directory """
+    path: Path
+    taxid: int
+    accession: str
+    length: int
+    name: str
+    sequence_hash: str = "" # canonical hash of the sequences (see FastaIndex.sequence_hash)
+
+
+class GenomeIndex:
+    """
+    DESCRIPTION:
+        The genome files of a directory, by taxid. Each file is stored
+        with its size and modification time, so only the new or changed
+        files are read when the index is updated.
+
+    INPUT:
+        1. genome directory
+    """
+
+    def __init__(self, database):
+        self.database_path = Path(database).resolve()
+        self.index_path = self.database_path.parent / f".{self.database_path.name}.taxid_index.tsv"
+        self.directory_mtime_ns: Optional[int] = None # directory state the index was checked against
+        self.files: Dict[str, Tuple[int, int, GenomeEntry]] = {} # file name -> (size, mtime, entry)
+        self.taxid2entries: Dict[int, List[GenomeEntry]] = {}
+        self.files_read = 0 # files read by the last update
+
+    @staticmethod
+    def read_entry(genome_path: Path) -> GenomeEntry:
+        """ reads the header (taxid, accession and name), sequence length and sequence hash of a genome file """
+        try:
+            header, length, digests = "", 0, []
+            for record_number, record in enumerate(read_fasta(genome_path)):
+                header = record.header if record_number == 0 else header
+                length += len(record.sequence)
+                digests.append(record_digest(record.sequence))
+            description, _, taxid = header.partition(TAXID_TAG)
+            taxid = int(taxid.split(" ")[0]) if taxid else 0
+        except (OSError, ValueError):
+            raise HeaderError(genome_path, f"Header is not valid for genome: {genome_path}")
+        accession, _, name = description.partition(" ")
+        return GenomeEntry(genome_path, taxid, accession, length, name, combine_digests(digests))
+
+    def load(self):
+        """ reads the stored index (if any) """
+        self.files = {}
+        try:
+            with open(self.index_path, newline="") as index_file:
+                for row in csv.DictReader(index_file, delimiter="\t"):
+                    entry = GenomeEntry(self.database_path / row["file"], int(row["taxid"]), row["accession"],
+                                        int(row["length"]), row["name"], row["sequence_hash"])
+                    self.files[row["file"]] = (int(row["size"]), int(row["mtime_ns"]), entry)
+        except (OSError, KeyError, ValueError, csv.Error):
+            self.files = {} # missing or unreadable, rebuilt from the files
+
+    def save(self):
+        """ writes the index next to the genome directory (kept in memory if not writable) """
+        temporary_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temporary_path, "w", newline="") as index_file:
+                writer = csv.writer(index_file, delimiter="\t", lineterminator="\n")
+                writer.writerow(INDEX_FIELDS)
+                for file_name, (size, mtime_ns, entry) in sorted(self.files.items()):
+                    writer.writerow([file_name, size, mtime_ns, *entry[1:]])
+            os.replace(temporary_path, self.index_path)
+        except OSError:
+            if temporary_path.exists():
+                temporary_path.unlink()
+
+    def update(self, processes: int = 1) -> bool:
+        """
+        DESCRIPTION:
+            checks the index against the files of the directory (size and
+            modification time), reading the new or changed files (in a
+            pool of processes if there are many of them).
+
+        OUTPUT:
+            True if the index changed (and was saved)
+        """
+        self.directory_mtime_ns = os.stat(self.database_path).st_mtime_ns
+        if not self.files:
+            self.load()
+        files = {}
+        to_read: List[Tuple[str, int, int]] = [] # new or changed files (name, size, mtime)
+        with os.scandir(self.database_path) as directory:
+            for genome_file in directory:
+                if genome_file.name.startswith(".") or not genome_file.is_file():
+                    continue
+                stat = genome_file.stat()
+                stored = self.files.get(genome_file.name)
+                if stored is not None and stored[:2] == (stat.st_size, stat.st_mtime_ns):
+                    files[genome_file.name] = stored
+                else:
+                    to_read.append((genome_file.name, stat.st_size, stat.st_mtime_ns))
+        genome_paths = [self.database_path / file_name for file_name, _, _ in to_read]
+        if processes > 1 and len(genome_paths) >= PARALLEL_READ_MIN_FILES:
+            with multiprocessing.Pool(processes) as pool:
+                entries = pool.map(self.read_entry, genome_paths, chunksize=64)
+        else:
+            entries = [self.read_entry(genome_path) for genome_path in genome_paths]
+        for (file_name, size, mtime_ns), entry in zip(to_read, entries):
+            files[file_name] = (size, mtime_ns, entry)
+        self.files_read = len(to_read)
+        changed = bool(to_read) or files.keys() != self.files.keys()
+        self.files = files
+        self.taxid2entries = {}
+        for _, _, entry in sorted(files.values(), key=lambda stored: stored[2].path.name):
+            self.taxid2entries.setdefault(entry.taxid, []).append(entry)
+        if changed:
+            self.save()
+        return changed
+
+    def is_current(self) -> bool:
+        """ True if no file was added, removed or renamed since the last update """
+        try:
+            return self.directory_mtime_ns == os.stat(self.database_path).st_mtime_ns
+        except OSError:
+            return False
+
+    def entries(self, taxid: int) -> List[GenomeEntry]:
+        return self.taxid2entries.get(taxid, [])
+
+
+# the index of each genome directory, shared by the PathOrganizer objects of a process
+_INDEXES: Dict[Path, GenomeIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def genome_index(database) -> GenomeIndex:
+    """
+    DESCRIPTION:
+        the index of a genome directory. It is checked against the files
+        when first used in a process, and again when the directory changes
+        (files modified in place while a process runs are not seen).
+    """
+    database_path = Path(database).resolve()
+    with _INDEXES_LOCK:
+        index = _INDEXES.setdefault(database_path, GenomeIndex(database_path))
+        if not index.is_current():
+            index.update()
+        return index
+
+
+# genomes removed as identical in sequence to a kept genome (see db_cleaner)
+ALIAS_FIELDS = ["taxid", "accession", "file", "representative_taxid", "representative_file", "sequence_hash"]
+
+
+class GenomeAlias(NamedTuple):
+    """ a genome removed from the directory, with the kept genome of the same sequence """
+    taxid: int
+    accession: str
+    file: str
+    representative_taxid: int
+    representative_file: str
+    sequence_hash: str
+
+
+def aliases_path(database) -> Path:
+    """ the alias table of a genome directory (stored next to it) """
+    database_path = Path(database).resolve()
+    return database_path.parent / f".{database_path.name}.sequence_aliases.tsv"
+
+
+def read_aliases(database) -> List[GenomeAlias]:
+    """ the genomes removed as identical to a kept genome (empty if none were) """
+    try:
+        with open(aliases_path(database), newline="") as aliases_file:
+            return [GenomeAlias(int(row["taxid"]), row["accession"], row["file"], int(row["representative_taxid"]),
+                                row["representative_file"], row["sequence_hash"])
+                    for row in csv.DictReader(aliases_file, delimiter="\t")]
+    except FileNotFoundError:
+        return []
+
+
+def save_aliases(database, aliases: Iterable[GenomeAlias]):
+    """ writes the alias table of a genome directory """
+    with open(aliases_path(database), "w", newline="") as aliases_file:
+        writer = csv.writer(aliases_file, delimiter="\t", lineterminator="\n")
+        writer.writerow(ALIAS_FIELDS)
+        writer.writerows(sorted(aliases))
+
+
 # path storing class
 class PathOrganizer:
     """ This data structure holds paths and retrieves information """
 
     def __init__(self, database):
         self.database_path: str = str(database)
+        self.__aliases: Optional[Dict[int, List[GenomeAlias]]] = None
+
+    @staticmethod
+    def __taxid(genome_taxid) -> int:
+        try:
+            return int(genome_taxid)
+        except (TypeError, ValueError):
+            raise InvalidQueryError(f"genome query id {genome_taxid} is not valid")
+
+    def genome_info(self, genome_taxid) -> Optional[GenomeEntry]:
+        """ the genome file (path, accession, length and name) of a taxid """
+        entries = genome_index(self.database_path).entries(self.__taxid(genome_taxid))
+        if len(entries) > 1:
+            raise DuplicateGenomeError(entries[0].path, f"Duplicate genome for {entries[1].path}, rerun the DB Build script!!")
+        return entries[0] if entries else None
 
-    # @property
     def genome(self, genome_taxid) -> Optional[Path]:
-        """ This getter grabs a genome file based on the file name prefix """
-        genome_path = None
-        for genome_in_db in os.listdir(self.database_path):
-            full_path = Path(self.database_path) / Path(genome_in_db)
-            try:
-                file_taxid = int(self.get_fasta_taxid(full_path))
-            except:
-                raise HeaderError(full_path, f"Header is not valid for genome: {full_path}")
-            try:
-                genome_id = int(genome_taxid)
-            except: 
-                raise InvalidQueryError(f"genome query id {genome_taxid} is not valid")
-            if (file_taxid == genome_id):
-                if (genome_path == None):
-                    genome_path = full_path
-                else:
-                    raise DuplicateGenomeError(genome_path, f"Duplicate genome for {full_path}, rerun the DB Build script!!")
-        return genome_path
+        """ This getter grabs a genome file based on the taxid in its header """
+        entry = self.genome_info(genome_taxid)
+        return entry.path if entry is not None else None
+
+    def genomes(self, genome_taxids: Iterable) -> Dict[str, Optional[Path]]:
+        """ the genome file of each taxid (None if not found), in query order """
+        return {genome_taxid: self.genome(genome_taxid) for genome_taxid in genome_taxids}
+
+    def aliases(self, genome_taxid) -> List[GenomeAlias]:
+        """ the genomes removed from the directory as identical to the genome of a taxid """
+        if self.__aliases is None:
+            self.__aliases = {}
+            for alias in read_aliases(self.database_path):
+                self.__aliases.setdefault(alias.representative_taxid, []).append(alias)
+        return self.__aliases.get(self.__taxid(genome_taxid), [])
+
+    @property
+    def store(self):
+        """ the packed genome store of the directory (see GenomeStore.py) """
+        from GenomeStore import genome_store
+        return genome_store(self.database_path)
+
+    def genome_sequence(self, genome_taxid) -> Optional[str]:
+        """ the sequence of the genome of a taxid (records concatenated), from the store if it has it """
+        genome_path = self.genome(genome_taxid)
+        if genome_path is None:
+            return None
+        if self.store.has(genome_path):
+            return self.store.genome(genome_path)
+        return fasta_sequence(genome_path)
 
     def get_fasta_taxid(self, genome_in_db):
         """
@@ -83,4 +316,12 @@ class PathOrganizer:
                 taxid = fasta_file.readline().split("|kraken:taxid|")[1].split(" ")[0]
             except:
                 taxid = 0 
-        return taxid
\ No newline at end of file
+        return taxid
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("USAGE: python PathOrganizer.py <genome directory>")
+        sys.exit(1)
+    index = genome_index(sys.argv[1])
+    print(f"{len(index.files)} genomes ({len(index.taxid2entries)} taxids) indexed in {index.index_path}")
@@ -7,9 +7,12 @@ DESCRIPTION:
 # non-std packages
 import pytest
 import os
+import shutil
+import PathOrganizer
 from pathlib import Path
 # in-house package
-from PathOrganizer import PathOrganizer as PathO, DuplicateGenomeError, InvalidQueryError
+from PathOrganizer import PathOrganizer as PathO, DuplicateGenomeError, InvalidQueryError, GenomeIndex, GenomeAlias, save_aliases
+from GenomeStore import GenomeStore
 
 
 CURR_PATH = os.path.realpath(__file__)
@@ -52,3 +55,100 @@ def test_errorHandeling(object_PathOrganizer, genome_to_grab, expected_error):
     """
     with pytest.raises(expected_error) as error:
         object_PathOrganizer.genome(genome_to_grab)
+
+def test_genomes(object_PathOrganizer):
+    """
+    Tests the batch lookup and the indexed genome information.
+    """
+    genome_paths = object_PathOrganizer.genomes(["2099652", "1636581", "12345"])
+    assert list(genome_paths) == ["2099652", "1636581", "12345"]
+    assert genome_paths["2099652"].name == "GCF_002997835.1_ASM299783v1_genomic.fna"
+    assert genome_paths["12345"] is None
+    genome_info = object_PathOrganizer.genome_info(1636581)
+    assert genome_info.accession == "NC_049359.1"
+    assert genome_info.name == "Lactococcus phage 936 group phage PhiL.18, complete genome"
+    assert genome_info.length == 30882
+
+def test_index_updates(genome_testing_path, tmp_path):
+    """
+    Tests that the stored index is reused, and updated when the genomes change.
+    """
+    genome_dir = tmp_path / "genomes"
+    shutil.copytree(genome_testing_path, genome_dir)
+    (genome_dir / "copy_genome.fa").unlink()
+    assert PathO(genome_dir).genome("55884").name == "GCF_000839125.1_ViralProj14162_genomic.fna"
+    index = GenomeIndex(genome_dir)
+    assert index.index_path.is_file()
+    assert not index.update() # nothing changed since it was stored
+    (genome_dir / "new_genome.fa").write_text(">NC_1.1 new phage|kraken:taxid|42\nACGT\nAC\n")
+    assert PathO(genome_dir).genome_info("42").length == 6
+    assert GenomeIndex(genome_dir).update() is False # stored with the new genome
+
+def test_index_not_writable(genome_testing_path, tmp_path):
+    """
+    Tests that the index is kept in memory when it can't be written.
+    """
+    index = GenomeIndex(genome_testing_path)
+    index.index_path = tmp_path / "missing_directory" / "index.tsv"
+    assert index.update()
+    assert not index.index_path.exists() and index.entries(55884)
+
+def test_index_parallel_update(genome_testing_path, tmp_path, monkeypatch):
+    """
+    Tests that genomes read by a pool of processes are indexed as when read serially.
+    """
+    genome_dir = tmp_path / "genomes"
+    shutil.copytree(genome_testing_path, genome_dir)
+    monkeypatch.setattr(PathOrganizer, "PARALLEL_READ_MIN_FILES", 1)
+    serial_index, parallel_index = GenomeIndex(genome_dir), GenomeIndex(genome_dir)
+    serial_index.update()
+    parallel_index.index_path.unlink()
+    assert parallel_index.update(processes=2)
+    assert parallel_index.files_read == len(serial_index.files)
+    assert parallel_index.taxid2entries == serial_index.taxid2entries
+    (genome_dir / "new_genome.fa").write_text(">NC_1.1 new phage|kraken:taxid|42\nACGT\n")
+    updated_index = GenomeIndex(genome_dir)
+    assert updated_index.update(processes=2) and updated_index.files_read == 1 # only the new genome
+
+def test_sequence_aliases(genome_testing_path, tmp_path):
+    """
+    Tests that reverse complemented genomes have the same sequence hash, and that aliases are read by taxid.
+    """
+    genome_dir = tmp_path / "genomes"
+    genome_dir.mkdir()
+    (genome_dir / "forward.fa").write_text(">NC_1.1 forward|kraken:taxid|41\nAACCGT\nTT\n")
+    (genome_dir / "reverse.fa").write_text(">NC_2.1 reverse|kraken:taxid|42\naaACGGTT\n")
+    (genome_dir / "other.fa").write_text(">NC_3.1 other|kraken:taxid|43\nAACCGTTA\n")
+    path_organizer = PathO(genome_dir)
+    hashes = [path_organizer.genome_info(taxid).sequence_hash for taxid in (41, 42, 43)]
+    assert hashes[0] == hashes[1] != hashes[2]
+    assert GenomeIndex(genome_dir).update() is False # (hashes stored in the index)
+    assert path_organizer.aliases(41) == []
+    alias = GenomeAlias(42, "NC_2.1", "reverse.fa", 41, "forward.fa", hashes[0])
+    save_aliases(genome_dir, [alias])
+    assert PathO(genome_dir).aliases("41") == [alias]
+
+def test_genome_store(genome_testing_path, tmp_path):
+    """
+    Tests that the packed genome store decodes the genomes exactly.
+    """
+    genome_dir = tmp_path / "genomes"
+    shutil.copytree(genome_testing_path, genome_dir)
+    (genome_dir / "masked_genome.fa").write_text(">NC_2.1 masked|kraken:taxid|43\nACGTnnNNR\nacgTT\n>plasmid\nGGCC\n")
+    path_organizer = PathO(genome_dir)
+    fasta_sequence = path_organizer.genome_sequence("43") # (no store yet)
+    store = GenomeStore.build(genome_dir)
+    assert store.nbytes * 3 < sum(path.stat().st_size for path in genome_dir.iterdir())
+    assert path_organizer.store.has(genome_dir / "masked_genome.fa")
+    assert path_organizer.genome_sequence("43") == fasta_sequence == "ACGTnnNNRacgTTGGCC"
+    records = store.records(genome_dir / "masked_genome.fa")
+    assert [record.name for record in records] == ["NC_2.1 masked|kraken:taxid|43", "plasmid"]
+    assert store.sequence(records[0], 3, 10) == "TnnNNRa"
+    with open(genome_dir / "GCF_002593425.1_ASM259342v1_genomic.fna") as fasta_file:
+        assert store.genome(fasta_file.name) == "".join(line.strip() for line in fasta_file if line[0] != ">")
+    # changed files are read from the FASTA until the store is rebuilt
+    (genome_dir / "masked_genome.fa").write_text(">NC_2.1 masked|kraken:taxid|43\nTTTT\n")
+    assert not path_organizer.store.has(genome_dir / "masked_genome.fa")
+    assert path_organizer.genome_sequence("43") == "TTTT"
+    GenomeStore.build(genome_dir)
+    assert path_organizer.store.genome(genome_dir / "masked_genome.fa") == "TTTT"
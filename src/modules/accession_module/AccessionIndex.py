@@ -0,0 +1,259 @@
+"""
+DESCRIPTION:
+    This module converts an accession to taxid mapping (NCBI
+    nucl_gb.accession2taxid, or a kraken seqid2taxid.map) into a sorted
+    binary index, memory mapped for lookups (a binary search of the
+    accessions, a few microseconds each). The mapping is read in large
+    chunks, parsed by a pool of processes, and sorted one bucket (first
+    character of the accession) at a time, so only the largest bucket is
+    held in memory.
+
+    The index is written next to the mapping, as <mapping>.a2t, with the
+    size and modification time of the mapping it was built from
+    (see accession_index).
+
+USAGE:
+    python AccessionIndex.py <mapping> [key column] [taxid column] [processes]
+    python AccessionIndex.py nucl_gb.accession2taxid            (accession.version, column 1)
+    python AccessionIndex.py seqid2taxid.map 0 1
+
+Classes
+    1. AccessionIndex - sorted, memory mapped accession to taxid index.
+
+Methods
+    1. accession_index - opens the index of a mapping, building it if it is missing or stale.
+"""
+# std packages
+import os
+import sys
+import struct
+import tempfile
+import multiprocessing
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+# non-std packages
+import numpy as np
+
+
+INDEX_SUFFIX = ".a2t"
+MAGIC = b"ESQA2T01"
+HEADER = struct.Struct("<8sQQQq") # magic, accessions, key width, size and mtime of the mapping
+CHUNK_BYTES = 64 * 1024 * 1024 # bytes of the mapping parsed per task
+
+
+def _taxid_offset(count: int, key_width: int) -> int:
+    """ offset of the taxids (after the keys, aligned to 4 bytes) """
+    keys_end = HEADER.size + count * key_width
+    return keys_end + -keys_end % 4
+
+
+def _chunk_bounds(mapping_path: Path, chunk_bytes: int) -> List[Tuple[int, int]]:
+    """ (start, end) byte offsets of chunks of the mapping, ending at line ends """
+    size = os.path.getsize(mapping_path)
+    bounds = []
+    with open(mapping_path, "rb") as mapping_file:
+        start = 0
+        while start < size:
+            mapping_file.seek(min(start + chunk_bytes, size))
+            mapping_file.readline()
+            end = min(mapping_file.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _parse_chunk(task) -> Tuple[np.ndarray, np.ndarray]:
+    """ the (key, taxid) pairs of a chunk of the mapping, sorted by key (lines without a numeric taxid are skipped) """
+    mapping_path, start, end, key_column, taxid_column = task
+    with open(mapping_path, "rb") as mapping_file:
+        mapping_file.seek(start)
+        data = mapping_file.read(end - start)
+    keys, taxids = [], []
+    last_column = max(key_column, taxid_column)
+    for line in data.split(b"\n"):
+        fields = line.split(b"\t")
+        if len(fields) > last_column:
+            taxid = fields[taxid_column].strip()
+            if taxid.isdigit() and fields[key_column]:
+                keys.append(fields[key_column])
+                taxids.append(int(taxid))
+    keys = np.array(keys, dtype=bytes) if keys else np.array([], dtype="S1")
+    order = np.argsort(keys, kind="stable")
+    return keys[order], np.array(taxids, dtype=np.uint32)[order]
+
+
+class AccessionIndex:
+    """
+    DESCRIPTION:
+        Sorted accession to taxid index (use build, or accession_index,
+        to write one). Keys are fixed width byte strings and taxids 32
+        bit integers, both memory mapped.
+
+    INPUT:
+        1. index file
+    """
+
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        with open(self.index_path, "rb") as index_file:
+            magic, self.count, self.key_width, *signature = HEADER.unpack(index_file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.index_path} is not an accession index")
+        self.source_signature = tuple(signature)
+        if self.count:
+            self.keys = np.memmap(self.index_path, dtype=f"S{self.key_width}", mode="r",
+                                  offset=HEADER.size, shape=(self.count,))
+            self.taxid_values = np.memmap(self.index_path, dtype=np.uint32, mode="r",
+                                          offset=_taxid_offset(self.count, self.key_width), shape=(self.count,))
+        else:
+            self.keys = np.array([], dtype="S1")
+            self.taxid_values = np.array([], dtype=np.uint32)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, accession) -> bool:
+        return self.get(accession) is not None
+
+    def __getitem__(self, accession) -> int:
+        taxid = self.get(accession)
+        if taxid is None:
+            raise KeyError(accession)
+        return taxid
+
+    def get(self, accession, default=None) -> Optional[int]:
+        """ the taxid of an accession (default if it isn't in the index) """
+        key = accession.encode() if isinstance(accession, str) else bytes(accession)
+        if not key or len(key) > self.key_width or not self.count:
+            return default
+        position = int(np.searchsorted(self.keys, np.array(key, dtype=self.keys.dtype)))
+        if position < self.count and self.keys[position] == key:
+            return int(self.taxid_values[position])
+        return default
+
+    def taxids(self, accessions: Iterable) -> Dict[str, int]:
+        """ the taxid of each accession found in the index (one vectorised search) """
+        accessions = [accession for accession in accessions
+                      if 0 < len(accession.encode() if isinstance(accession, str) else accession) <= self.key_width]
+        if not accessions or not self.count:
+            return {}
+        keys = np.array([accession.encode() if isinstance(accession, str) else accession for accession in accessions],
+                        dtype=self.keys.dtype)
+        positions = np.minimum(np.searchsorted(self.keys, keys), self.count - 1)
+        found = self.keys[positions] == keys
+        return {accession: int(taxid) for accession, taxid, is_found
+                in zip(accessions, self.taxid_values[positions], found) if is_found}
+
+    @classmethod
+    def build(cls, mapping_path, index_path=None, key_column: int = 1, taxid_column: int = 2,
+              processes: int = 1, chunk_bytes: int = CHUNK_BYTES) -> "AccessionIndex":
+        """
+        DESCRIPTION:
+            writes the index of a tab separated mapping. Chunks are parsed
+            in a pool of processes and spilled to one file per first
+            character of the accessions, then each is sorted and written.
+            If an accession is listed twice, the first line is used.
+
+        INPUT:
+            1. mapping file
+            2. index file [Default <mapping>.a2t]
+            3. column of the accessions [Default 1, the accession.version of accession2taxid]
+            4. column of the taxids [Default 2]
+            5. processes
+            6. bytes parsed per task
+
+        OUTPUT:
+            the new index
+        """
+        mapping_path = Path(mapping_path)
+        index_path = Path(index_path) if index_path else Path(f"{mapping_path}{INDEX_SUFFIX}")
+        stat = os.stat(mapping_path)
+        tasks = [(mapping_path, start, end, key_column, taxid_column)
+                 for start, end in _chunk_bounds(mapping_path, chunk_bytes)]
+        temporary_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+        with tempfile.TemporaryDirectory(dir=index_path.parent) as spill_directory:
+            # parse the chunks (in file order) and spill them by first character
+            buckets: Dict[int, Path] = {}
+            count, key_width = 0, 1
+            pool = multiprocessing.Pool(processes) if processes > 1 and len(tasks) > 1 else None
+            try:
+                chunks = pool.imap(_parse_chunk, tasks) if pool else map(_parse_chunk, tasks)
+                for keys, taxids in chunks:
+                    if not len(keys):
+                        continue
+                    count += len(keys)
+                    key_width = max(key_width, keys.dtype.itemsize)
+                    first_characters = keys.view(np.uint8).reshape(len(keys), -1)[:, 0]
+                    bucket_starts = np.flatnonzero(np.diff(first_characters.astype(np.int16), prepend=-1))
+                    for bucket_start, bucket_end in zip(bucket_starts, np.append(bucket_starts[1:], len(keys))):
+                        bucket = int(first_characters[bucket_start])
+                        bucket_path = buckets.setdefault(bucket, Path(spill_directory) / f"{bucket}.npy")
+                        with open(bucket_path, "ab") as bucket_file:
+                            np.save(bucket_file, keys[bucket_start:bucket_end])
+                            np.save(bucket_file, taxids[bucket_start:bucket_end])
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            # sort and write each bucket, in order
+            try:
+                with open(temporary_path, "wb") as index_file:
+                    index_file.write(HEADER.pack(MAGIC, count, key_width, stat.st_size, stat.st_mtime_ns))
+                    index_file.truncate(_taxid_offset(count, key_width) + 4 * count)
+                position = 0
+                for bucket in sorted(buckets):
+                    keys, taxids = cls.__read_bucket(buckets[bucket], key_width)
+                    order = np.argsort(keys, kind="stable")
+                    keys_out = np.memmap(temporary_path, dtype=f"S{key_width}", mode="r+",
+                                         offset=HEADER.size + position * key_width, shape=(len(keys),))
+                    keys_out[:] = keys[order]
+                    keys_out.flush()
+                    taxids_out = np.memmap(temporary_path, dtype=np.uint32, mode="r+",
+                                           offset=_taxid_offset(count, key_width) + 4 * position, shape=(len(keys),))
+                    taxids_out[:] = taxids[order]
+                    taxids_out.flush()
+                    del keys_out, taxids_out
+                    position += len(keys)
+                os.replace(temporary_path, index_path)
+            finally:
+                if temporary_path.exists():
+                    temporary_path.unlink()
+        return cls(index_path)
+
+    @staticmethod
+    def __read_bucket(bucket_path: Path, key_width: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ the keys (as key_width wide strings) and taxids spilled to a bucket """
+        keys, taxids = [], []
+        with open(bucket_path, "rb") as bucket_file:
+            while bucket_file.tell() < os.fstat(bucket_file.fileno()).st_size:
+                keys.append(np.load(bucket_file).astype(f"S{key_width}"))
+                taxids.append(np.load(bucket_file))
+        return np.concatenate(keys), np.concatenate(taxids)
+
+
+def accession_index(mapping_path, index_path=None, key_column: int = 1, taxid_column: int = 2,
+                    processes: int = 1) -> AccessionIndex:
+    """
+    DESCRIPTION:
+        the index of a mapping: opened if it was built from the current
+        mapping (same size and modification time), else (re)built.
+    """
+    index_path = Path(index_path) if index_path else Path(f"{mapping_path}{INDEX_SUFFIX}")
+    stat = os.stat(mapping_path)
+    try:
+        index = AccessionIndex(index_path)
+        if index.source_signature == (stat.st_size, stat.st_mtime_ns):
+            return index
+    except (OSError, ValueError, struct.error):
+        pass
+    return AccessionIndex.build(mapping_path, index_path, key_column, taxid_column, processes)
+
+
+if __name__ == "__main__":
+    if not 2 <= len(sys.argv) <= 5:
+        print(__doc__)
+        sys.exit(1)
+    columns = [int(column) for column in sys.argv[2:4]]
+    processes = int(sys.argv[4]) if len(sys.argv) == 5 else (os.cpu_count() or 1)
+    index = AccessionIndex.build(sys.argv[1], None, *columns, processes=processes)
+    print(f"{len(index)} accessions indexed in {index.index_path}")
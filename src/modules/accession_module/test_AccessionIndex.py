@@ -0,0 +1,51 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from AccessionIndex import AccessionIndex, accession_index
+
+
+ACCESSION2TAXID = ("accession\taccession.version\ttaxid\tgi\n"
+                   "NC_001416\tNC_001416.1\t10710\t9626243\n"
+                   "MN908947\tMN908947.3\t2697049\t1798174254\n"
+                   "AAAA02000001\tAAAA02000001.1\t39946\t0\n"
+                   "KX000001\tKX000001.1\t12\t1\n"
+                   "NC_001416\tNC_001416.1\t999\t9626243\n" # (listed twice, the first is used)
+                   "MN1\tMN1.1\t7\t2\n")
+
+
+@pytest.fixture
+def mapping_path(tmp_path):
+    mapping_path = tmp_path / "nucl_gb.accession2taxid"
+    mapping_path.write_text(ACCESSION2TAXID)
+    return mapping_path
+
+
+def test_accession_index(mapping_path):
+    index = AccessionIndex.build(mapping_path, processes=2, chunk_bytes=64) # (several chunks)
+    assert len(index) == 6
+    assert index.get("NC_001416.1") == 10710
+    assert index["MN908947.3"] == 2697049 and index.get("MN1.1") == 7
+    assert "accession.version" not in index and "NC_001416" not in index
+    with pytest.raises(KeyError):
+        index["MN908947.30"]
+    assert index.taxids(["KX000001.1", "missing.1", "AAAA02000001.1", "a" * 100]) == {"KX000001.1": 12,
+                                                                                     "AAAA02000001.1": 39946}
+
+
+def test_accession_index_reused(mapping_path, tmp_path):
+    index_path = accession_index(mapping_path).index_path
+    assert index_path == tmp_path / "nucl_gb.accession2taxid.a2t"
+    index_mtime = os.stat(index_path).st_mtime_ns
+    assert accession_index(mapping_path).get("MN1.1") == 7
+    assert os.stat(index_path).st_mtime_ns == index_mtime # (not rebuilt)
+    mapping_path.write_text("accession\taccession.version\ttaxid\tgi\nMN1\tMN1.1\t8\t2\n")
+    assert accession_index(mapping_path).get("MN1.1") == 8
+
+
+def test_seqid_map(tmp_path):
+    seqid_path = tmp_path / "seqid2taxid.map"
+    seqid_path.write_text("kraken:taxid|10710|NC_001416.1\t10710\nNC_045512.2\t2697049\n")
+    index = accession_index(seqid_path, key_column=0, taxid_column=1)
+    assert index.get("NC_045512.2") == 2697049
+    assert index.get("kraken:taxid|10710|NC_001416.1") == 10710
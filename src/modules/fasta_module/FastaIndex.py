@@ -0,0 +1,236 @@
+"""
+DESCRIPTION:
+    This module reads FASTA files. Records are streamed one at a time
+    (lines are joined once per record, not concatenated string by string),
+    and a byte offset index (like a samtools .fai, with the offset of each
+    header) gives random access to record N, the headers and the number
+    of records without reading the sequences again.
+
+USAGE:
+    python FastaIndex.py <fasta file>    (writes the index, <fasta file>.fxi)
+
+Classes
+    1. FastaRecord - a record of a FASTA file.
+    2. IndexEntry - the position of a record within a FASTA file.
+    3. FastaIndex - byte offset index of a FASTA file.
+
+Methods
+    1. read_fasta - streams the records of a FASTA file.
+    2. read_headers - streams the headers of a FASTA file.
+    3. read_lengths - streams the header and sequence length of each record.
+    4. fasta_sequence - the sequences of a FASTA file, concatenated.
+    5. record_digest - hash of a sequence, the same for its reverse complement.
+    6. sequence_hash - canonical hash of the sequences of a FASTA file.
+"""
+# std packages
+import os
+import sys
+import hashlib
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+INDEX_SUFFIX = ".fxi"
+COMPLEMENT = bytes.maketrans(b"ACGTURYKMBVDHN", b"TGCAAYRMKVBHDN") # (IUPAC codes, others are kept)
+
+
+class FastaRecord(NamedTuple):
+    """ a record of a FASTA file (the header is the line without '>') """
+    header: str
+    sequence: str
+
+    @property
+    def name(self) -> str:
+        """ first word of the header (the sequence id) """
+        return self.header.split(maxsplit=1)[0] if self.header.strip() else ""
+
+
+class IndexEntry(NamedTuple):
+    """
+    the position of a record: bytes offsets of its header and sequence,
+    and the bases and bytes per line (0 if the lines differ in length)
+    """
+    header: str
+    length: int
+    header_offset: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+
+def _records(fasta_path) -> Iterator[Tuple[str, List[bytes]]]:
+    """ (header, sequence lines) of each record """
+    with open(fasta_path, "rb") as fasta_file:
+        header, lines = None, []
+        for line in fasta_file:
+            if line.startswith(b">"):
+                if header is not None:
+                    yield header, lines
+                header, lines = line[1:].strip().decode(), []
+            elif header is not None:
+                lines.append(line.strip())
+        if header is not None:
+            yield header, lines
+
+
+def read_fasta(fasta_path) -> Iterator[FastaRecord]:
+    """ streams the records of a FASTA file (whitespace at the ends of lines is removed) """
+    for header, lines in _records(fasta_path):
+        yield FastaRecord(header, b"".join(lines).decode())
+
+
+def read_headers(fasta_path) -> Iterator[str]:
+    """ streams the headers of a FASTA file, skipping the sequence lines """
+    with open(fasta_path, "rb") as fasta_file:
+        for line in fasta_file:
+            if line.startswith(b">"):
+                yield line[1:].strip().decode()
+
+
+def read_lengths(fasta_path) -> Iterator[Tuple[str, int]]:
+    """ streams the header and sequence length of each record (the sequences aren't kept) """
+    for header, lines in _records(fasta_path):
+        yield header, sum(len(line) for line in lines)
+
+
+def fasta_sequence(fasta_path) -> str:
+    """ the sequences of every record of a FASTA file, concatenated (a genome split in contigs) """
+    return "".join(record.sequence for record in read_fasta(fasta_path))
+
+
+def record_digest(sequence: str) -> bytes:
+    """ hash of a sequence (uppercased), the same for its reverse complement """
+    forward = sequence.upper().encode()
+    reverse = forward.translate(COMPLEMENT)[::-1]
+    return hashlib.blake2b(min(forward, reverse), digest_size=16).digest()
+
+
+def combine_digests(digests: Iterable[bytes]) -> str:
+    """ hash of the record digests of a file, whatever the order of the records """
+    return hashlib.blake2b(b"".join(sorted(digests)), digest_size=16).hexdigest()
+
+
+def sequence_hash(fasta_path) -> str:
+    """
+    DESCRIPTION:
+        canonical hash of the sequences of a FASTA file: the same for
+        files whose records only differ in line wrapping, case, strand,
+        order or headers.
+    """
+    return combine_digests(record_digest(record.sequence) for record in read_fasta(fasta_path))
+
+
+class FastaIndex:
+    """
+    DESCRIPTION:
+        Byte offset index of a FASTA file. It is read from <fasta>.fxi if
+        that was written (see save) for the current file, else built with
+        one pass over the file.
+
+    INPUT:
+        1. FASTA file
+        2. index file [Default <fasta>.fxi]
+    """
+
+    def __init__(self, fasta_path, index_path=None):
+        self.fasta_path = Path(fasta_path)
+        self.index_path = Path(index_path) if index_path else Path(f"{fasta_path}{INDEX_SUFFIX}")
+        stat = os.stat(self.fasta_path)
+        self.signature = (stat.st_size, stat.st_mtime_ns)
+        self.entries: List[IndexEntry] = self.load() or self.build()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, record_number: int) -> IndexEntry:
+        return self.entries[record_number]
+
+    def headers(self) -> List[str]:
+        return [entry.header for entry in self.entries]
+
+    def load(self) -> Optional[List[IndexEntry]]:
+        """ the stored entries, None if there is no index for the current file """
+        try:
+            with open(self.index_path) as index_file:
+                if index_file.readline().split() != ["#", *map(str, self.signature)]:
+                    return None
+                entries = []
+                for line in index_file:
+                    header, *positions = line.rstrip("\n").split("\t")
+                    entries.append(IndexEntry(header, *map(int, positions)))
+                return entries
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def build(self) -> List[IndexEntry]:
+        """ reads the positions of every record """
+        entries = []
+        record = None
+        position = 0
+        with open(self.fasta_path, "rb") as fasta_file:
+            for line in fasta_file:
+                if line.startswith(b">"):
+                    if record is not None:
+                        entries.append(self.__entry(**record))
+                    record = {"header": line[1:].strip().decode(), "length": 0, "header_offset": position,
+                              "offset": position + len(line), "first": None, "last": None, "uniform": True}
+                elif record is not None:
+                    bases = len(line.strip())
+                    if record["last"] is not None and record["last"] != record["first"]:
+                        record["uniform"] = False # a short line before the last one
+                    if record["first"] is None:
+                        record["first"] = (bases, len(line))
+                    record["last"] = (bases, len(line))
+                    record["length"] += bases
+                position += len(line)
+        if record is not None:
+            entries.append(self.__entry(**record))
+        return entries
+
+    @staticmethod
+    def __entry(header, length, header_offset, offset, first, last, uniform) -> IndexEntry:
+        """ entry of a record, with the line layout if the lines (except the last) are of equal length """
+        line_bases, line_width = first if first is not None else (0, 0)
+        if line_bases == 0 or not uniform or last[0] > line_bases:
+            line_bases = line_width = 0
+        return IndexEntry(header, length, header_offset, offset, line_bases, line_width)
+
+    def save(self) -> Path:
+        """ writes the index (header lines with tabs are written as spaces) """
+        with open(self.index_path, "w") as index_file:
+            index_file.write(f"# {self.signature[0]} {self.signature[1]}\n")
+            for entry in self.entries:
+                index_file.write("\t".join([entry.header.replace("\t", " "), *map(str, entry[1:])]) + "\n")
+        return self.index_path
+
+    def record(self, record_number: int) -> FastaRecord:
+        """ reads record N (0 based) """
+        entry = self.entries[record_number]
+        end = self.entries[record_number + 1].header_offset if record_number + 1 < len(self.entries) else self.signature[0]
+        with open(self.fasta_path, "rb") as fasta_file:
+            fasta_file.seek(entry.offset)
+            sequence = b"".join(fasta_file.read(end - entry.offset).split())
+        return FastaRecord(entry.header, sequence.decode())
+
+    def fetch(self, record_number: int, start: int = 0, end: Optional[int] = None) -> str:
+        """ the bases [start, end) of record N, reading only those lines when the lines are of equal length """
+        entry = self.entries[record_number]
+        end = entry.length if end is None else min(end, entry.length)
+        start = max(0, start)
+        if start >= end:
+            return ""
+        if entry.line_bases == 0:
+            return self.record(record_number).sequence[start:end]
+        first = entry.offset + (start // entry.line_bases) * entry.line_width + start % entry.line_bases
+        last = entry.offset + ((end - 1) // entry.line_bases) * entry.line_width + (end - 1) % entry.line_bases
+        with open(self.fasta_path, "rb") as fasta_file:
+            fasta_file.seek(first)
+            return b"".join(fasta_file.read(last - first + 1).split()).decode()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    fasta_index = FastaIndex(sys.argv[1])
+    print(f"{len(fasta_index)} records indexed in {fasta_index.save()}")
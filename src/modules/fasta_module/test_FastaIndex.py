@@ -0,0 +1,57 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from FastaIndex import FastaIndex, FastaRecord, read_fasta, read_headers, read_lengths, fasta_sequence, sequence_hash
+
+
+FASTA = ">r1 first record\nACGTACGTAC\nGTACGTACGT\nACG\n>r2 uneven lines\nAAAA\nCC\nGGGG\n>r3\n>r4 last\r\nTTTTTTTT"
+
+
+@pytest.fixture
+def fasta_path(tmp_path):
+    fasta_path = tmp_path / "records.fa"
+    fasta_path.write_bytes(FASTA.encode())
+    return fasta_path
+
+
+def test_read_fasta(fasta_path):
+    records = list(read_fasta(fasta_path))
+    assert records == [FastaRecord("r1 first record", "ACGTACGTACGTACGTACGTACG"),
+                       FastaRecord("r2 uneven lines", "AAAACCGGGG"),
+                       FastaRecord("r3", ""),
+                       FastaRecord("r4 last", "TTTTTTTT")]
+    assert records[1].name == "r2"
+    assert list(read_headers(fasta_path)) == [record.header for record in records]
+    assert list(read_lengths(fasta_path)) == [(record.header, len(record.sequence)) for record in records]
+    assert fasta_sequence(fasta_path) == "".join(record.sequence for record in records)
+
+
+def test_fasta_index(fasta_path):
+    fasta_index = FastaIndex(fasta_path)
+    assert len(fasta_index) == 4
+    assert fasta_index.headers() == list(read_headers(fasta_path))
+    assert [fasta_index.record(number) for number in range(len(fasta_index))] == list(read_fasta(fasta_path))
+    assert (fasta_index[0].line_bases, fasta_index[1].line_bases) == (10, 0) # uneven lines aren't laid out
+    sequence = fasta_index.record(0).sequence
+    for start, end in [(0, 23), (8, 23), (9, 11), (10, 20), (22, 30), (5, 5)]:
+        assert fasta_index.fetch(0, start, end) == sequence[start:end]
+    assert fasta_index.fetch(1, 2, 9) == "AACCGGG"
+
+
+def test_fasta_index_saved(fasta_path):
+    index_path = FastaIndex(fasta_path).save()
+    assert FastaIndex(fasta_path).load() == FastaIndex(fasta_path).build()
+    # a changed file isn't read with the old index
+    fasta_path.write_text(">new\nAC\n")
+    assert FastaIndex(fasta_path).load() is None
+    assert FastaIndex(fasta_path).record(0) == FastaRecord("new", "AC")
+    assert index_path.is_file()
+
+
+def test_sequence_hash(fasta_path, tmp_path):
+    rewrapped_path = tmp_path / "rewrapped.fa"
+    rewrapped_path.write_text(">r4 other name\nAAAAAAAA\n>r2\nCCCCGGTTTT\n>r3\n>r1\nCGTACGTACGT\nacgtacgtacgt\n")
+    assert sequence_hash(rewrapped_path) == sequence_hash(fasta_path)
+    rewrapped_path.write_text(">r4\nAAAAAAAA\n>r2\nCCCCGGTTTT\n>r1\nCGTACGTACGTACGTACGTACGT\n")
+    assert sequence_hash(rewrapped_path) != sequence_hash(fasta_path) # (record r3 missing)
@@ -7,6 +7,9 @@ from pathlib import Path
 current_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(f"{current_path}/../PathOrganizer_module")
 from PathOrganizer import PathOrganizer, PathErrors, DuplicateGenomeError
+from GenomeStore import genome_store
+sys.path.append(f"{current_path}/../fasta_module")
+from FastaIndex import fasta_sequence
 
 class DNA:
     ''' TODO: deal with taxid instead of names
@@ -19,14 +22,14 @@ class DNA:
     #     self.genome: str = self.fasta_to_genome(fasta_file) if self.fasta_file != None else None
     #     self.kmers: List = self.create_kmers(self.genome, kmer_len) if self.genome != None else []
 
-    def __init__(self, taxid, genome_directory, kmer_len):
+    def __init__(self, taxid, genome_directory, kmer_len, fasta_file=None):
         # self.name: str = name
         self.taxid = int(taxid)
 
-        # uses PathOrganizer module
+        # uses PathOrganizer module (unless the genome file was already looked up)
         self.pathOrganizerObj = PathOrganizer(genome_directory)
-        self.fasta_file: Path = self.pathOrganizerObj.genome(taxid)
-        self.genome: str = self.fasta_to_genome(self.fasta_file) if self.fasta_file != None else None
+        self.fasta_file: Path = fasta_file if fasta_file is not None else self.pathOrganizerObj.genome(taxid)
+        self.genome: str = self.read_genome(self.fasta_file, genome_directory) if self.fasta_file != None else None
         self.kmers: List = self.create_kmers(self.genome, kmer_len) if self.genome != None else []
 
 
@@ -48,33 +51,28 @@ class DNA:
         return kmers
 
 
+    def read_genome(self, fasta_path, genome_directory) -> str:
+        ''' Reads the genome from the packed genome store if it has it, else from the FASTA '''
+        store = genome_store(genome_directory)
+        if store.has(fasta_path):
+            return store.genome(fasta_path)
+        return self.fasta_to_genome(fasta_path)
+
+
     # TODO: add multifasta logic
     def fasta_to_genome(self, fasta_path) -> str:
         ''' 
             DESCRIPTION:
                 Extracts just the genome from the genome member variable, which should be a file path.
-                Currently assumes only single FASTA file is passed (no multi-fasta). 
+                The records of a multi-fasta (contigs of the genome) are concatenated.
             
             INPUT:
-                FASTA/FASTQ file (.fa, .fna, .fasta, .fastq)
+                FASTA file (.fa, .fna, .fasta)
             
             OUTPUT:
                 Genome in string format
         '''
-        sequence = ""
-        with open(fasta_path) as fasta_file:
-            fasta_lines = fasta_file.readlines()
-            sequence_i = ""
-            # If name is found (i.e. this is the correct file), get genome
-            for counter, line in enumerate(fasta_lines):
-                if line[0] == ">" and re.search(str(self.taxid), line, re.IGNORECASE):
-                    if (counter != 0):
-                        sequence += (sequence_i.rstrip())
-                        sequence_i = ""
-                elif line[0] != ">":
-                    sequence += line.rstrip()
-
-        return sequence
+        return fasta_sequence(fasta_path)
 
 
     def validate_file_extension(self, file) -> bool:
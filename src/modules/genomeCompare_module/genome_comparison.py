@@ -6,9 +6,10 @@ import pandas as pd
 import argparse
 import matplotlib.pyplot as plt
 from typing import List
-from dna import DNA
 from pathlib import Path
 current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_path)
+from dna import DNA
 sys.path.append(f"{current_path}/../PathOrganizer_module")
 from PathOrganizer import PathOrganizer, PathErrors, DuplicateGenomeError
 
@@ -35,13 +36,13 @@ class GenomeCompare:
         '''
         dnaList = []
         print(f"Extracting taxids from LSV file: {inputfile}")
-        taxidfile = open(inputfile, 'r')
-        #with open(inputfile) as taxidfile:
-        for taxid in taxidfile:
-            #taxid = taxidfile.readlines()
-            taxid = taxid.rstrip()
+        with open(inputfile) as taxidfile:
+            taxids = [taxid.rstrip() for taxid in taxidfile]
+        # one lookup in the genome directory index for every taxid
+        genome_paths = PathOrganizer(genome_dir).genomes(taxids)
+        for taxid in taxids:
             print(taxid)
-            dnaList.append(DNA(taxid, genome_dir, kmer_length))
+            dnaList.append(DNA(taxid, genome_dir, kmer_length, fasta_file=genome_paths[taxid]))
 
         return dnaList
 
@@ -204,6 +205,11 @@ def main():
         to create DNA objects '''
     print("Running Genome Comparison clustering...")
     arguments = parseArgs(argv=sys.argv[1:])
+    run_genome_comparison(arguments)
+
+
+def run_genome_comparison(arguments: argparse.Namespace):
+    ''' clusters the genomes found by merge overlap and writes the cluster members and abundances '''
 
     # find out if single genome or more.
     single_genome = True
@@ -0,0 +1,194 @@
+"""
+This script turns the per-read kraken2 output (piped into stdin) into a
+compact binary read-to-taxid table, so the multi-GB text output never has
+to be stored. Read names are kept as 64 bit hashes, sorted for lookups.
+
+USAGE:
+    kraken2 --db <db> --report <report> <reads> | python KrakenReadTable.py --out <table.npz>
+
+Classes
+    1. KrakenReadTableWriter - aggregates kraken2 per-read lines into a table.
+    2. KrakenReadTable - looks up the taxid (and confidence) of reads by name.
+
+Methods
+    1. read_key - 64 bit hash of a read name (mate suffixes /1 and /2 removed).
+    2. parse_kraken_line - parses one line of the kraken2 per-read output.
+"""
+import sys
+import re
+import argparse
+import hashlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+
+
+MATE_SUFFIX = re.compile(r"/[12]$")
+NAMED_TAXID = re.compile(r"\(taxid (\d+)\)$") # taxid column written with --use-names
+
+
+def read_key(read_name: str) -> int:
+    """
+    DESCRIPTION:
+        64 bit hash of a read name, ignoring the mate suffix so both mates
+        of a pair (and kraken2 --paired output) give the same key.
+    """
+    read_name = MATE_SUFFIX.sub("", read_name.split()[0])
+    return int.from_bytes(hashlib.blake2b(read_name.encode(), digest_size=8).digest(), "little")
+
+
+def parse_kraken_line(line: str) -> Optional[Tuple[str, int, float]]:
+    """
+    DESCRIPTION:
+        parses a kraken2 per-read line:
+        C/U, read name, taxid, length, LCA mapping of the k-mers ("taxid:count ...")
+
+    OUTPUT:
+        (read name, taxid, confidence) for classified reads, else None.
+        The confidence is the fraction of the non-ambiguous k-mers
+        assigned to the taxid of the read itself.
+    """
+    line_array = line.rstrip("\n").split("\t")
+    if len(line_array) < 5 or line_array[0] != "C":
+        return None
+    taxid_column = line_array[2]
+    named_taxid = NAMED_TAXID.search(taxid_column)
+    taxid = int(named_taxid.group(1) if named_taxid else taxid_column)
+    taxid_kmers, total_kmers = 0, 0
+    for kmer_hits in line_array[4].split():
+        kmer_taxid, _, count = kmer_hits.partition(":")
+        if kmer_taxid in ("A", "|") or not count:
+            continue # ambiguous k-mers and the paired read separator
+        total_kmers += int(count)
+        if kmer_taxid == str(taxid):
+            taxid_kmers += int(count)
+    confidence = taxid_kmers / total_kmers if total_kmers else 0.0
+    return line_array[1], taxid, confidence
+
+
+class KrakenReadTableWriter:
+    """
+    DESCRIPTION:
+        Aggregates kraken2 per-read lines as they arrive, keeping
+        16 bytes per classified read (key, taxid, confidence) and
+        the number of reads per taxid.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        self._keys = np.empty(capacity, dtype=np.uint64)
+        self._taxids = np.empty(capacity, dtype=np.uint32)
+        self._confidences = np.empty(capacity, dtype=np.float32)
+        self.classified_reads = 0
+        self.unclassified_reads = 0
+        self.taxid_counts: Dict[int, int] = {}
+
+    def add_line(self, line: str):
+        """ adds one line of kraken2 output """
+        parsed = parse_kraken_line(line)
+        if parsed is None:
+            if line.strip():
+                self.unclassified_reads += 1
+            return
+        read_name, taxid, confidence = parsed
+        if self.classified_reads == len(self._keys):
+            self.__grow()
+        self._keys[self.classified_reads] = read_key(read_name)
+        self._taxids[self.classified_reads] = taxid
+        self._confidences[self.classified_reads] = confidence
+        self.classified_reads += 1
+        self.taxid_counts[taxid] = self.taxid_counts.get(taxid, 0) + 1
+
+    def add_lines(self, lines: Iterable[str]):
+        """ adds every line of kraken2 output """
+        for line in lines:
+            self.add_line(line)
+
+    def __grow(self):
+        """ doubles the capacity of the arrays """
+        for attribute in ("_keys", "_taxids", "_confidences"):
+            old_array = getattr(self, attribute)
+            new_array = np.empty(max(2 * len(old_array), 1), dtype=old_array.dtype)
+            new_array[:len(old_array)] = old_array
+            setattr(self, attribute, new_array)
+
+    def save(self, out_path: Union[str, Path]) -> Path:
+        """ saves the table, sorted by read key, as a compressed .npz """
+        order = np.argsort(self._keys[:self.classified_reads], kind="stable")
+        count_taxids = np.array(sorted(self.taxid_counts), dtype=np.uint32)
+        np.savez_compressed(out_path,
+                            read_keys=self._keys[:self.classified_reads][order],
+                            taxids=self._taxids[:self.classified_reads][order],
+                            confidences=self._confidences[:self.classified_reads][order],
+                            count_taxids=count_taxids,
+                            counts=np.array([self.taxid_counts[taxid] for taxid in count_taxids.tolist()], dtype=np.int64),
+                            unclassified_reads=np.int64(self.unclassified_reads))
+        return Path(out_path)
+
+
+class KrakenReadTable:
+    """
+    DESCRIPTION:
+        Read-to-taxid table written by KrakenReadTableWriter.
+
+    INPUT:
+        table path (.npz)
+    """
+
+    def __init__(self, table_path: Union[str, Path]):
+        table_path = Path(table_path)
+        if not table_path.is_file():
+            raise FileNotFoundError(f'{table_path} does not exist.')
+        with np.load(table_path) as table:
+            self.read_keys = table["read_keys"]
+            self.taxids = table["taxids"]
+            self.confidences = table["confidences"]
+            self.taxid_counts = dict(zip(table["count_taxids"].tolist(), table["counts"].tolist()))
+            self.unclassified_reads = int(table["unclassified_reads"])
+
+    def __len__(self) -> int:
+        return len(self.read_keys)
+
+    def lookup(self, read_names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        DESCRIPTION:
+            finds the taxid and confidence of each read (taxid 0 and
+            confidence 0.0 for reads kraken2 did not classify).
+        """
+        keys = np.array([read_key(name) for name in read_names], dtype=np.uint64)
+        if len(self.read_keys) == 0:
+            return np.zeros(len(keys), dtype=np.uint32), np.zeros(len(keys), dtype=np.float32)
+        positions = np.minimum(np.searchsorted(self.read_keys, keys), len(self.read_keys) - 1)
+        found = self.read_keys[positions] == keys
+        taxids = np.where(found, self.taxids[positions], 0)
+        confidences = np.where(found, self.confidences[positions], 0.0)
+        return taxids, confidences
+
+    def assigned_taxids(self, read_names: List[str], candidate_taxids, min_confidence: float = 0.5) -> List[Optional[str]]:
+        """
+        DESCRIPTION:
+            the taxid of each read, if kraken2 assigned it to one of the
+            candidate taxids with at least min_confidence (else None).
+        """
+        candidate_taxids = set(str(taxid) for taxid in candidate_taxids)
+        taxids, confidences = self.lookup(read_names)
+        assigned = []
+        for taxid, confidence in zip(taxids.tolist(), confidences.tolist()):
+            taxid = str(taxid)
+            assigned.append(taxid if taxid in candidate_taxids and confidence >= min_confidence else None)
+        return assigned
+
+
+def main():
+    """ controls the script """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--out", help="output read table (.npz)", required=True)
+    arguments = parser.parse_args(sys.argv[1:])
+
+    writer = KrakenReadTableWriter()
+    writer.add_lines(sys.stdin)
+    writer.save(arguments.out)
+    print(f"{writer.classified_reads} classified and {writer.unclassified_reads} unclassified reads")
+
+
+if __name__ == "__main__":
+    main()
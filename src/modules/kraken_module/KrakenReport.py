@@ -0,0 +1,139 @@
+"""
+This module parses a kraken report into a taxonomy tree. The report is
+streamed line by line, and the tree is built from the indentation of the
+names (two spaces per level).
+
+Classes
+    1. TaxonNode - one line of the report (a taxon and its read counts).
+    2. KrakenReport - the taxonomy tree of a report, with candidate filtering.
+
+Methods
+    1. normalize_name - normalizes a taxon name for deduplication.
+"""
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+
+SPECIES_RANKS = ("S", "S1")
+
+
+def normalize_name(name: str) -> str:
+    """
+    DESCRIPTION:
+        lower cases a name and collapses punctuation and whitespace,
+        so "Mycobacterium phage  Paphu" and "mycobacterium_phage Paphu"
+        give the same key.
+    """
+    return " ".join(re.split(r"[\W_]+", name.casefold())).strip()
+
+
+@dataclass
+class TaxonNode:
+    """ a taxon in a kraken report """
+    percent: float
+    clade_reads: int # reads assigned to this taxon and everything below it
+    direct_reads: int # reads assigned to this taxon only
+    rank: str
+    taxid: str
+    name: str
+    depth: int
+    parent: Optional["TaxonNode"] = field(default=None, repr=False)
+    children: List["TaxonNode"] = field(default_factory=list, repr=False)
+
+
+class KrakenReport:
+    """
+    DESCRIPTION:
+        Taxonomy tree of a kraken report.
+
+    INPUT:
+        kraken report file
+    """
+
+    def __init__(self, kraken_file: Union[str, Path]):
+        self.kraken_file = Path(kraken_file)
+        if not self.kraken_file.is_file():
+            raise FileNotFoundError(f'{kraken_file} does not exist.')
+        self.roots: List[TaxonNode] = [] # top level taxa (e.g. unclassified, root)
+        self.nodes: List[TaxonNode] = [] # every taxon, in report order
+        self.__parse()
+
+    def __parse(self):
+        """ streams the report, attaching each taxon to the closest shallower taxon """
+        ancestors: List[TaxonNode] = []
+        with open(self.kraken_file) as report:
+            for line in report:
+                node = self.parse_line(line)
+                if node is None:
+                    continue
+                while ancestors and ancestors[-1].depth >= node.depth:
+                    ancestors.pop()
+                if ancestors:
+                    node.parent = ancestors[-1]
+                    node.parent.children.append(node)
+                else:
+                    self.roots.append(node)
+                ancestors.append(node)
+                self.nodes.append(node)
+
+    @staticmethod
+    def parse_line(line: str) -> Optional[TaxonNode]:
+        """
+        parses one report line:
+        percent, clade reads, direct reads, rank, taxid, indented name
+        """
+        line_array = line.rstrip("\n").split("\t")
+        if len(line_array) < 6:
+            return None
+        indented_name = line_array[5]
+        name = indented_name.lstrip(" ")
+        return TaxonNode(percent=float(line_array[0]),
+                         clade_reads=int(line_array[1]),
+                         direct_reads=int(line_array[2]),
+                         rank=line_array[3].strip(),
+                         taxid=line_array[4].strip(),
+                         name=name.strip(),
+                         depth=(len(indented_name) - len(name)) // 2)
+
+    @property
+    def total_reads(self) -> int:
+        """ reads in the report (classified and unclassified) """
+        return sum(node.clade_reads for node in self.roots)
+
+    def candidates(self, ranks: Tuple[str, ...] = SPECIES_RANKS, min_reads: int = 0,
+                   min_fraction: float = 0.0) -> Iterator[TaxonNode]:
+        """
+        DESCRIPTION:
+            yields the taxa passing the filters, skipping taxa whose
+            normalized name was already yielded.
+
+        INPUT:
+            ranks to keep
+            minimum reads in the clade
+            minimum fraction of all reads in the clade
+
+        OUTPUT:
+            taxon nodes, in report order
+        """
+        total_reads = self.total_reads
+        seen_names = set()
+        for node in self.nodes:
+            if node.rank not in ranks or node.clade_reads < min_reads:
+                continue
+            if total_reads and node.clade_reads / total_reads < min_fraction:
+                continue
+            name_key = normalize_name(node.name)
+            if name_key in seen_names:
+                continue
+            seen_names.add(name_key)
+            yield node
+
+    def lineage(self, node: TaxonNode) -> List[TaxonNode]:
+        """ the taxa from the top of the tree down to the node """
+        lineage = []
+        while node is not None:
+            lineage.append(node)
+            node = node.parent
+        return lineage[::-1]
@@ -1,15 +1,19 @@
 usage() {
-    echo; echo "Usage: bash $0 --krakendb=krakenDB/ --queryfasta=inputfasta/simulatedgenomes_illumina.fa --report=kraken.report.txt --out=krakenout.kraken"
+    echo; echo "Usage: bash $0 --krakendb=krakenDB/ --queryfasta=inputfasta/simulatedgenomes_illumina.fa --report=kraken.report.txt --out=kraken_reads.npz [--threads=4] [--memory_mapping]"
     echo "  --krakendb   Path to the kraken2 database created using the config and kraken2Build.sh"
     echo "  --queryfasta     Path to the in fasta file"
     echo "  --report    Report file for kraken results"
-    echo "  --out       File name for .kraken output"
+    echo "  --out       File name for the read to taxid table (.npz) built from the per-read output"
+    echo "  --threads   Number of threads [Default 4]"
+    echo "  --memory_mapping  Memory map the database instead of loading it (runs share it through the page cache)"
     echo "  -h, --help  Print this help message out"; echo;
     exit 1;
 }
 
+scriptDir=$(cd "$(dirname "$0")" && pwd)
+
 # check that all the required arguments are used
-if [ $# -gt 4 ] || [ $# -lt 4 ]
+if [ $# -gt 6 ] || [ $# -lt 4 ]
 then
     usage
 fi
@@ -47,6 +51,14 @@ do
         echo "$0: missing argument for '$1' option"
         usage
         exit 1;;
+    --threads=?*)
+        threads=${1#*=};;
+    --threads|threads=)
+        echo "$0: missing argument for '$1' option"
+        usage
+        exit 1;;
+    --memory_mapping)
+        memoryMapping="--memory-mapping";;
     --)
         shift
         break;;
@@ -67,11 +79,17 @@ function runKraken2() {
   local inFasta=$2;
   local reportFile=$3;
   local krakenOutFile=$4;
+  local threads=${5:-4};
+  local memoryMapping=$6;
   
   if [[ -f ${dbDir}/taxo.k2d ]]; then 
-    kraken2 --use-names --threads 4 --db ${dbDir} --report ${reportFile} ${inFasta} > ${krakenOutFile}
+    # the per-read output is streamed into the read table, never written as text
+    set -o pipefail
+    kraken2 --threads ${threads} ${memoryMapping} --db ${dbDir} --report ${reportFile} ${inFasta} \
+      | python ${scriptDir}/KrakenReadTable.py --out ${krakenOutFile}
   else
     echo "Kraken database must be built first"
+    exit 1
   fi
 }
 
@@ -82,6 +100,7 @@ function main() {
   echo $inFasta;
   echo $reportFile;
   echo $krakenOutFile;
+  echo $threads;
 
   # input arguments
   # local dbDir="krakenDB";
@@ -89,7 +108,7 @@ function main() {
   # local reportFile="krakenOut.txt";
   # local krakenOutFile="krakenOut.kraken";
 
-  runKraken2 ${dbDir} ${inFasta} ${reportFile} ${krakenOutFile};
+  runKraken2 ${dbDir} ${inFasta} ${reportFile} ${krakenOutFile} "${threads:-4}" "${memoryMapping}";
 }
 
 
@@ -4,42 +4,36 @@ de novo assembly).
 
 USAGE:
     python parse_kraken.py <kraken_outfile> <outputfile_taxids> <outputfile_names>
+                           [--ranks S S1] [--min_reads 0] [--min_fraction 0.0]
 """
 import sys
-import re
+import os
+import argparse
 from pathlib import Path
+# in house packages
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from KrakenReport import KrakenReport, SPECIES_RANKS
 
 
-def parseKrakenFile(kraken_file) -> dict:
+def parseKrakenFile(kraken_file, ranks=SPECIES_RANKS, min_reads=0, min_fraction=0.0) -> dict:
     """
     DESCRIPTION:
-        Extracts phage names from kraken report (only at species level)
+        Extracts phage names from kraken report (only at species level
+        by default). Phages with the same normalized name are only kept once.
 
     INPUT:
         kraken report file
+        ranks to keep
+        minimum reads in the clade of a phage
+        minimum fraction of all reads in the clade of a phage
 
     OUTPUT:
-        returns list of phages
+        returns dictionary of phages {taxid: name}
     """
+    report = KrakenReport(kraken_file)
     phages = {}
-    try:
-        kraken_reports = open(kraken_file).readlines()
-    except FileNotFoundError:
-        raise FileNotFoundError(f'{kraken_file} does not exist.')
-    else:
-        # TODO: don't include duplicates
-        for line in kraken_reports:
-            line_array = line.strip("\n").split('\t')
-            if line and not line.isspace(): 
-                genome_level = line_array[3]
-                full_name = line_array[5]
-                # filter by species
-                if genome_level == 'S' or genome_level == 'S1':
-                    taxid = line.strip("\n").split()[4]
-                    # check that the phage doesn't already exist
-                    if not checkPhageExists(full_name, phages):
-                        phages[taxid] = full_name.strip()
-
+    for node in report.candidates(ranks=tuple(ranks), min_reads=min_reads, min_fraction=min_fraction):
+        phages[node.taxid] = node.name
     return phages
 
 
@@ -57,8 +51,9 @@ def checkPhageExists(phage_name, phage_dict) -> bool:
                 false if not
     """
 
+    phage_name = phage_name.casefold()
     for key in phage_dict:
-        if re.search(phage_name, phage_dict[key], re.IGNORECASE):
+        if phage_name in phage_dict[key].casefold():
             return True
     return False
 
@@ -108,17 +103,31 @@ def saveNameToFile(outfile, kraken_phages) -> Path:
         return Path(outfile)
 
 
+def parseArgs(argv=None) -> argparse.Namespace:
+    """ parses the script arguments """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kraken_file", help="kraken report")
+    parser.add_argument("outfile_taxid", help="output file for the phage taxids")
+    parser.add_argument("outfile_names", help="output file for the phage names")
+    parser.add_argument("--ranks", nargs="+", default=list(SPECIES_RANKS), help="ranks to keep [Default: S S1]")
+    parser.add_argument("--min_reads", type=int, default=0, help="minimum reads in the clade of a phage")
+    parser.add_argument("--min_fraction", type=float, default=0.0, help="minimum fraction of all reads in the clade of a phage")
+    return parser.parse_args(argv)
+
+
 def main():
     """ controls the script """
     kraken_phages = {}
 
     ### SCRIPT INPUT
-    kraken_file = sys.argv[1]
-    outfile_taxid = sys.argv[2]
-    outfile_names = sys.argv[3]
-
-    # TEST
-    kraken_phages = parseKrakenFile(kraken_file)
+    arguments = parseArgs(sys.argv[1:])
+    kraken_file = arguments.kraken_file
+    outfile_taxid = arguments.outfile_taxid
+    outfile_names = arguments.outfile_names
+
+    kraken_phages = parseKrakenFile(kraken_file, ranks=arguments.ranks,
+                                    min_reads=arguments.min_reads,
+                                    min_fraction=arguments.min_fraction)
     saveTaxidToFile(outfile_taxid, kraken_phages)
     saveNameToFile(outfile_names, kraken_phages)
 
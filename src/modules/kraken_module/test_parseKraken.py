@@ -2,6 +2,8 @@ import pytest
 import sys
 import os
 import parseKraken as parser
+from KrakenReport import KrakenReport, normalize_name
+from KrakenReadTable import KrakenReadTable, KrakenReadTableWriter, parse_kraken_line
 from typing import Dict
 from pathlib import Path
 
@@ -14,7 +16,7 @@ def expected_phage_dict():
 
 @pytest.fixture
 def kraken_report_path():
-    return Path(os.getcwd()) / Path("kraken_testing") 
+    return Path(os.path.dirname(os.path.abspath(__file__))) / Path("kraken_testing")
 
 
 @pytest.mark.parametrize("kraken_file, expected", [
@@ -32,6 +34,63 @@ def test_parseKrakenFile_nonexistent(kraken_report_path):
         parser.parseKrakenFile(kraken_report_path/Path("kraken_FAIL.report"))
 
 
+@pytest.mark.parametrize("min_reads, min_fraction, expected", [
+    (0, 0.0, ["2502430", "2599873", "1913110"]),
+    (22, 0.0, ["2502430", "2599873"]),
+    (0, 0.0005, ["2502430"])
+    ])
+def test_parseKrakenFile_filters(kraken_report_path, min_reads, min_fraction, expected):
+    phages = parser.parseKrakenFile(kraken_report_path / Path("kraken_SAMPLE.report"),
+                                    min_reads=min_reads, min_fraction=min_fraction)
+    assert list(phages.keys()) == expected
+
+
+def test_KrakenReport_tree(kraken_report_path):
+    report = KrakenReport(kraken_report_path / Path("kraken_SAMPLE.report"))
+    assert report.total_reads == 161 + 51919
+    assert [node.name for node in report.roots] == ["unclassified", "root"]
+    fushigi = report.nodes[11]
+    assert fushigi.taxid == "2502430" and fushigi.clade_reads == 29
+    assert [node.rank for node in report.lineage(fushigi)] == ["R", "D", "D1", "D2", "P", "C", "O", "F", "G", "G1", "S"]
+    assert len(fushigi.parent.children) == 3
+
+
+def test_KrakenReport_dedup(tmp_path):
+    """ names that only differ by case/punctuation are kept once, and names aren't regex patterns """
+    report_lines = [" 100.00\t10\t0\tR\t1\troot",
+                    "  50.00\t5\t5\tS\t11\t  Phage (a+b)",
+                    "  30.00\t3\t3\tS\t12\t  phage  (A+B)",
+                    "  20.00\t2\t2\tS\t13\t  Phage a+b"]
+    report_path = tmp_path / "dup.report"
+    report_path.write_text("\n".join(report_lines) + "\n")
+    assert parser.parseKrakenFile(report_path) == {"11": "Phage (a+b)"}
+    assert normalize_name("Mycobacterium phage  Paphu") == normalize_name("mycobacterium_phage Paphu")
+
+
+@pytest.mark.parametrize("kraken_line, expected", [
+    ("C\tread1\t2502430\t150\t2502430:80 186764:20\n", ("read1", 2502430, 0.8)),
+    ("C\tread2/1\tMycobacterium phage Paphu (taxid 2599873)\t150|150\t2599873:50 A:20 |:| 0:50\n", ("read2/1", 2599873, 0.5)),
+    ("U\tread3\t0\t150\t0:116\n", None)
+    ])
+def test_parse_kraken_line(kraken_line, expected):
+    assert parse_kraken_line(kraken_line) == expected
+
+
+def test_KrakenReadTable(tmp_path):
+    writer = KrakenReadTableWriter(capacity=1)
+    writer.add_lines(["C\tread1\t2502430\t150\t2502430:80 186764:20\n",
+                      "U\tread3\t0\t150\t0:116\n",
+                      "C\tread2\t2599873\t150\t2599873:30 186764:70\n",
+                      "C\tread4\t2502430\t150\t2502430:100\n"])
+    table = KrakenReadTable(writer.save(tmp_path / "reads.npz"))
+    assert len(table) == 3 and table.unclassified_reads == 1
+    assert table.taxid_counts == {2502430: 2, 2599873: 1}
+    taxids, _ = table.lookup(["read4", "read3", "read2/2", "missing"])
+    assert taxids.tolist() == [2502430, 0, 2599873, 0]
+    assert table.assigned_taxids(["read1", "read2", "read4"], ["2599873", "2502430"], min_confidence=0.5) == ["2502430", None, "2502430"]
+    assert table.assigned_taxids(["read1", "read2"], ["2599873"], min_confidence=0.0) == [None, "2599873"]
+
+
 @pytest.mark.parametrize("phage_name, expected", [
     ("Mycobacterium phage Paphu", True),
     ("mycobacterium phage paphu", True),
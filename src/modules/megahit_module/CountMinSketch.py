@@ -0,0 +1,93 @@
+"""
+Module for counting k-mers in fixed memory. A count-min sketch keeps
+depth rows of width counters; each k-mer adds one to a counter per row,
+and its count is estimated as the minimum of its counters. Estimates
+never undercount, and overcount only through collisions (rare when the
+width is large compared to the number of distinct k-mers).
+
+Classes
+    1. CountMinSketch - approximate k-mer counts in depth x width counters.
+
+Methods
+    1. canonical_kmers - 2-bit encoded canonical k-mers of a sequence.
+"""
+from typing import Optional
+import numpy as np
+
+
+# A, C, G, T -> 0..3, anything else -> 4 (k-mers containing it are skipped)
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+MAX_K = 31 # 2 bits per base in a uint64
+
+
+def canonical_kmers(sequence: str, k: int) -> np.ndarray:
+    """
+    DESCRIPTION:
+        the canonical k-mers of a sequence (the smaller of each k-mer and
+        its reverse complement), 2-bit encoded in uint64. K-mers with a
+        base other than ACGT are skipped.
+    """
+    if not 0 < k <= MAX_K:
+        raise ValueError(f"k must be between 1 and {MAX_K}: {k}")
+    codes = BASE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    valid = windows.max(axis=1) < 4
+    windows = windows[valid].astype(np.uint64)
+    powers = np.uint64(4) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    forward = (windows * powers).sum(axis=1, dtype=np.uint64)
+    # reverse complement: complemented bases (3 - code) in reverse order
+    reverse = ((np.uint64(3) - windows) * powers[::-1]).sum(axis=1, dtype=np.uint64)
+    return np.minimum(forward, reverse)
+
+
+class CountMinSketch:
+    """
+    DESCRIPTION:
+        Approximate counts of uint64 keys (e.g. canonical k-mers) in
+        depth x 2^width_bits counters, using multiply-shift hashing.
+
+    INPUT:
+        1. log2 of the counters per row
+        2. rows (hash functions)
+        3. seed of the hash functions
+    """
+
+    def __init__(self, width_bits: int = 22, depth: int = 4, seed: int = 0):
+        if not 1 <= width_bits <= 32:
+            raise ValueError(f"width_bits must be between 1 and 32: {width_bits}")
+        self.width_bits = width_bits
+        self.depth = depth
+        self.counts = np.zeros((depth, 1 << width_bits), dtype=np.uint32)
+        random_state = np.random.default_rng(seed)
+        # odd multipliers for multiply-shift hashing
+        self._multipliers = random_state.integers(1, 1 << 63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._shift = np.uint64(64 - width_bits)
+        self._rows = np.arange(depth)[:, None]
+
+    @property
+    def nbytes(self) -> int:
+        return self.counts.nbytes
+
+    def columns(self, keys: np.ndarray) -> np.ndarray:
+        """ the counter of each key in each row (depth x keys) """
+        with np.errstate(over="ignore"):
+            return (self._multipliers[:, None] * keys.astype(np.uint64)[None, :]) >> self._shift
+
+    def add(self, keys: np.ndarray, columns: Optional[np.ndarray] = None):
+        """ counts each key once per occurrence """
+        if len(keys) == 0:
+            return
+        columns = self.columns(keys) if columns is None else columns
+        np.add.at(self.counts, (np.broadcast_to(self._rows, columns.shape), columns), 1)
+
+    def estimate(self, keys: np.ndarray, columns: Optional[np.ndarray] = None) -> np.ndarray:
+        """ estimated count of each key (never below the true count) """
+        if len(keys) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        columns = self.columns(keys) if columns is None else columns
+        return self.counts[self._rows, columns].min(axis=0)
@@ -0,0 +1,147 @@
+"""
+This script picks the reads given to MEGAHIT. The contigs are only used
+to find candidate genomes with kraken, so the whole read set rarely has
+to be assembled.
+
+Modes
+    subsample - keeps a fraction of the reads (or read pairs), picked by a
+                hash of the read name, so the same reads are kept on every
+                run and both mates of a pair are kept together.
+    normalize - digital normalization: keeps a read only while the median
+                count of its k-mers (in the reads kept so far) is below the
+                target coverage, so high coverage genomes are thinned and
+                low coverage genomes are kept whole. The k-mers are counted
+                in a count-min sketch, so memory is fixed (--sketch_bits).
+    skip      - keeps every read (written as the contigs, so kraken
+                classifies the raw reads instead of an assembly).
+
+USAGE:
+    python ReadSubsampler.py --mode subsample --fraction 0.1 --input1 reads_1.fq [--input2 reads_2.fq] \
+                             --out1 subsample_1.fa [--out2 subsample_2.fa]
+    (paired reads without --out2 are both written to --out1)
+
+Methods
+    1. keep_fraction - keeps a fraction of the reads, by read name.
+    2. normalize_by_median - digital normalization of the reads.
+    3. write_fasta - writes reads (or read pairs) to FASTA.
+"""
+import os
+import sys
+import argparse
+import hashlib
+from typing import Iterable, Iterator, Optional, Tuple
+import numpy as np
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../mergeoverlap_filter_module")
+from ReadStream import ReadStream, PairedReadStream
+from CountMinSketch import CountMinSketch, canonical_kmers
+
+
+MODES = ("subsample", "normalize", "skip")
+
+
+def _fragment_name(name: str) -> str:
+    """ read name without the mate suffix """
+    return PairedReadStream.MATE_SUFFIX.sub("", name)
+
+
+def _mates(sequence) -> Tuple[str, ...]:
+    """ the sequences of a read or read pair """
+    return tuple(sequence) if isinstance(sequence, tuple) else (sequence,)
+
+
+def keep_fraction(reads: Iterable, fraction: float, seed: int = 0) -> Iterator:
+    """
+    DESCRIPTION:
+        keeps the reads whose (seeded) name hash falls below the fraction.
+        The choice only depends on the name, so both mates of a pair, and
+        the same reads on every run, are kept.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError(f"the fraction must be in (0, 1]: {fraction}")
+    threshold = int(fraction * (1 << 64))
+    for name, sequence in reads:
+        digest = hashlib.blake2b(f"{seed}:{_fragment_name(name)}".encode(), digest_size=8).digest()
+        if int.from_bytes(digest, "little") < threshold:
+            yield name, sequence
+
+
+def normalize_by_median(reads: Iterable, coverage: int = 20, k: int = 20,
+                        sketch: Optional[CountMinSketch] = None) -> Iterator:
+    """
+    DESCRIPTION:
+        digital normalization: a read (or pair, if either mate is below
+        the coverage) is kept while the median count of its k-mers is
+        below the coverage, and its k-mers are then counted. Reads
+        without k-mers (shorter than k) are kept.
+    """
+    sketch = sketch if sketch is not None else CountMinSketch()
+    for name, sequence in reads:
+        mate_kmers = [canonical_kmers(mate, k) for mate in _mates(sequence)]
+        mate_columns = [sketch.columns(kmers) for kmers in mate_kmers]
+        if any(len(kmers) == 0 or np.median(sketch.estimate(kmers, columns)) < coverage
+               for kmers, columns in zip(mate_kmers, mate_columns)):
+            for kmers, columns in zip(mate_kmers, mate_columns):
+                sketch.add(kmers, columns)
+            yield name, sequence
+
+
+def write_fasta(reads: Iterable, out_1: str, out_2: Optional[str] = None) -> int:
+    """
+    DESCRIPTION:
+        writes reads to FASTA. Read pairs are written to out_1 and out_2,
+        or both to out_1 (as <name>/1 and <name>/2) without out_2.
+
+    OUTPUT:
+        number of reads (or pairs) written
+    """
+    written = 0
+    with open(out_1, "w") as fasta_1, open(out_2 if out_2 else os.devnull, "w") as fasta_2:
+        for name, sequence in reads:
+            if isinstance(sequence, tuple):
+                name = _fragment_name(name)
+                fasta_1.write(f">{name}/1\n{sequence[0]}\n")
+                (fasta_2 if out_2 else fasta_1).write(f">{name}/2\n{sequence[1]}\n")
+            else:
+                fasta_1.write(f">{name}\n{sequence}\n")
+            written += 1
+    return written
+
+
+def parseArgs(argv=None) -> argparse.Namespace:
+    """ parses the arguments of the script """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES, required=True)
+    parser.add_argument("--input1", help="reads (mate 1 for paired reads)", required=True)
+    parser.add_argument("--input2", help="mate 2 reads", required=False)
+    parser.add_argument("--out1", help="output FASTA (mate 1 for paired reads)", required=True)
+    parser.add_argument("--out2", help="output FASTA of mate 2 (else written to --out1)", required=False)
+    parser.add_argument("--fraction", type=float, default=0.1, help="fraction of reads kept by subsample [Default 0.1]")
+    parser.add_argument("--coverage", type=int, default=20, help="target k-mer coverage of normalize [Default 20]")
+    parser.add_argument("--kmer_length", type=int, default=20, help="k-mer length of normalize [Default 20]")
+    parser.add_argument("--sketch_bits", type=int, default=22,
+                        help="log2 of the counters per row of the normalize sketch (4 rows of 4 byte counters) [Default 22, 64MB]")
+    parser.add_argument("--seed", type=int, default=0, help="seed of subsample [Default 0]")
+    return parser.parse_args(argv)
+
+
+def main():
+    """ controls the script """
+    arguments = parseArgs(sys.argv[1:])
+    if arguments.input2:
+        reads = PairedReadStream(arguments.input1, arguments.input2)
+    else:
+        reads = ReadStream(arguments.input1)
+    if arguments.mode == "subsample":
+        kept = keep_fraction(reads, arguments.fraction, arguments.seed)
+    elif arguments.mode == "normalize":
+        kept = normalize_by_median(reads, arguments.coverage, arguments.kmer_length,
+                                   CountMinSketch(width_bits=arguments.sketch_bits))
+    else:
+        kept = reads
+    written = write_fasta(kept, arguments.out1, arguments.out2)
+    print(f"{arguments.mode}: kept {written} of {reads.total_reads} reads")
+
+
+if __name__ == "__main__":
+    main()
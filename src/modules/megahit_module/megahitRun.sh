@@ -1,18 +1,22 @@
 #!/bin/bash
 
 usage() {
-    echo; echo "Usage: bash $0 --read=single --input=inputfasta/simgenomes.fa --threads=4 --out=megahit_20210307"
+    echo; echo "Usage: bash $0 --read=single --input1=inputfasta/simgenomes.fa --threads=4 --out=megahit_20210307 [--mode=full] [--memory=auto]"
     echo "  --read      Read type of fasta files [single, paired, long]"
     echo "  --input1     Input fasta file 1 (just this is single end)"
     echo "  --input2     Input fasta file 2"
     echo "  --threads   Number of threads"
     echo "  --out       Output directory for metaphlan results"
+    echo "  --mode      Reads assembled: full, subsample, normalize or skip (reads written as the contigs) [Default full]"
+    echo "  --fraction  Fraction of the reads assembled with --mode=subsample [Default 0.1]"
+    echo "  --coverage  Target k-mer coverage with --mode=normalize [Default 20]"
+    echo "  --memory    MEGAHIT memory: auto (from the available memory), bytes, or a fraction of the machine [Default auto]"
     echo "  -h, --help  Print this help message out"; echo;
     exit 1;
 }
 
 # check that all the required arguments are used
-if [ $# -gt 5 ] || [ $# -lt 4 ]
+if [ $# -gt 9 ] || [ $# -lt 4 ]
 then
     usage
 fi
@@ -56,6 +60,18 @@ do
         echo "$0: missing argument for '$1' option"
         usage
         exit 1;;
+    --mode=?*)
+        mode=${1#*=};;
+    --fraction=?*)
+        fraction=${1#*=};;
+    --coverage=?*)
+        coverage=${1#*=};;
+    --memory=?*)
+        memory=${1#*=};;
+    --mode|mode=|--fraction|fraction=|--coverage|coverage=|--memory|memory=)
+        echo "$0: missing argument for '$1' option"
+        usage
+        exit 1;;
     --)
         shift
         break;;
@@ -70,6 +86,33 @@ do
 done
 
 
+scriptDir=$(dirname "$0")
+mode=${mode:-full}
+fraction=${fraction:-0.1}
+coverage=${coverage:-20}
+memory=${memory:-auto}
+
+
+# prints the memory for megahit -m: 90% of the available memory (or of the
+# cgroup limit, if lower). Falls back to half of the machine if unknown.
+function autoMemory() {
+  local available="";
+  if [[ -r /proc/meminfo ]]; then
+    available=$(awk '/^MemAvailable:/ {printf "%.0f", $2 * 1024}' /proc/meminfo);
+  elif command -v sysctl > /dev/null; then
+    available=$(sysctl -n hw.memsize 2> /dev/null);
+  fi
+  local limit=$(cat /sys/fs/cgroup/memory.max 2> /dev/null || cat /sys/fs/cgroup/memory/memory.limit_in_bytes 2> /dev/null);
+  if [[ ${limit} =~ ^[0-9]+$ ]] && [[ -n ${available} ]] && (( limit < available )); then
+    available=${limit};
+  fi
+  if [[ ${available} =~ ^[0-9]+$ ]]; then
+    awk -v bytes=${available} 'BEGIN {printf "%.0f", bytes * 0.9}';
+  else
+    echo 0.5;
+  fi
+}
+
 function runMegahit() {
   echo "Running runMegahit()";
   # arguments
@@ -78,11 +121,12 @@ function runMegahit() {
   local inFasta2=$3;
   local threads=$4;
   local outdir=$5;
+  local memory=$6;
 
   if [[ ${readType} == "single" ]]; then
-    megahit -r ${inFasta} -t ${threads} -m 1e9 -o ${outdir} --out-prefix megahit_out
+    megahit -r ${inFasta} -t ${threads} -m ${memory} -o ${outdir} --out-prefix megahit_out
   elif [[ ${readType} == "paired" ]]; then
-    megahit -1 ${inFasta} -2 ${inFasta2} -t ${threads} -m 1e9 -o ${outdir} --out-prefix megahit_out
+    megahit -1 ${inFasta} -2 ${inFasta2} -t ${threads} -m ${memory} -o ${outdir} --out-prefix megahit_out
   fi
 
 }
@@ -93,8 +137,42 @@ function main() {
   echo ${inFasta2};
   echo ${threads};
   echo ${outdir};
+  echo ${mode};
 
-  runMegahit ${readType} ${inFasta} ${inFasta2} ${threads} ${outdir};
+  if [[ ${memory} == "auto" ]]; then
+    memory=$(autoMemory);
+  fi
+  echo "megahit memory: ${memory}";
+
+  local subsampleArgs="--input1 ${inFasta}";
+  if [[ ${readType} == "paired" ]]; then
+    subsampleArgs="${subsampleArgs} --input2 ${inFasta2}";
+  fi
+  case ${mode} in
+  full)
+    runMegahit ${readType} ${inFasta} ${inFasta2} ${threads} ${outdir} ${memory};;
+  skip)
+    # the reads are classified instead of contigs (megahit is not run)
+    mkdir -p ${outdir};
+    python ${scriptDir}/ReadSubsampler.py --mode skip ${subsampleArgs} \
+           --out1 ${outdir}/megahit_out.contigs.fa || exit 1;;
+  subsample|normalize)
+    # (megahit needs a new output directory, so the reads are kept next to it)
+    local readsDir="${outdir}_reads";
+    mkdir -p ${readsDir};
+    local outArgs="--out1 ${readsDir}/reads_1.fa";
+    if [[ ${readType} == "paired" ]]; then
+      outArgs="${outArgs} --out2 ${readsDir}/reads_2.fa";
+    fi
+    python ${scriptDir}/ReadSubsampler.py --mode ${mode} ${subsampleArgs} ${outArgs} \
+           --fraction ${fraction} --coverage ${coverage} || exit 1;
+    runMegahit ${readType} ${readsDir}/reads_1.fa ${readsDir}/reads_2.fa ${threads} ${outdir} ${memory} || exit 1;
+    rm -rf ${readsDir};;
+  *)
+    echo "$0: invalid mode: ${mode}"
+    usage
+    exit 1;;
+  esac
 }
 
 echo "Running the megahit run script";
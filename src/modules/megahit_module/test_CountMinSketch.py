@@ -0,0 +1,43 @@
+import pytest
+import sys
+import os
+import random
+from collections import Counter
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from CountMinSketch import CountMinSketch, canonical_kmers
+
+
+def test_canonical_kmers():
+    kmers = canonical_kmers("ACGTTNAAAA", 4)
+    assert list(kmers) == list(canonical_kmers("ACGT", 4)) + list(canonical_kmers("AACG", 4)) + [0] # AAAA
+    # a k-mer and its reverse complement share a key
+    assert list(canonical_kmers("AAAACCCC", 8)) == list(canonical_kmers("GGGGTTTT", 8))
+    assert len(canonical_kmers("NNN", 4)) == 0
+    with pytest.raises(ValueError):
+        canonical_kmers("ACGT", 32)
+
+
+def test_sketch_counts():
+    rng = random.Random(0)
+    sequences = ["".join(rng.choice("ACGT") for _ in range(100)) for _ in range(20)]
+    exact = Counter()
+    sketch = CountMinSketch(width_bits=16)
+    for sequence in sequences + sequences[:5]:
+        kmers = canonical_kmers(sequence, 12)
+        exact.update(kmers.tolist())
+        sketch.add(kmers)
+    keys = np.array(list(exact), dtype=np.uint64)
+    estimates = sketch.estimate(keys)
+    assert all(estimate == exact[key] for key, estimate in zip(keys.tolist(), estimates))
+    assert sketch.nbytes == 4 * (1 << 16) * 4
+
+
+def test_sketch_never_undercounts():
+    # a tiny sketch collides a lot, but only overcounts
+    keys = np.arange(1000, dtype=np.uint64)
+    sketch = CountMinSketch(width_bits=4, depth=2)
+    sketch.add(keys)
+    sketch.add(keys[:10])
+    estimates = sketch.estimate(keys)
+    assert (estimates[:10] >= 2).all() and (estimates >= 1).all()
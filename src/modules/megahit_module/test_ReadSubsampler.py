@@ -0,0 +1,47 @@
+import pytest
+import sys
+import os
+import random
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from ReadSubsampler import keep_fraction, normalize_by_median, write_fasta
+from ReadStream import ReadStream, PairedReadStream
+
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "examples")
+SINGLE_READS = os.path.join(EXAMPLES, "single_end_reads", "simulated_test_reads_illumina.fa")
+PAIRED_READS = (os.path.join(EXAMPLES, "paired_end_reads", "paired_illumina_1.fa"),
+                os.path.join(EXAMPLES, "paired_end_reads", "paired_illumina_2.fa"))
+
+
+def test_keep_fraction():
+    kept = [name for name, _ in keep_fraction(ReadStream(SINGLE_READS), 0.1)]
+    assert 800 < len(kept) < 1200 # of 10000 reads
+    # the same reads on every run, others with another seed
+    assert kept == [name for name, _ in keep_fraction(ReadStream(SINGLE_READS), 0.1)]
+    assert kept != [name for name, _ in keep_fraction(ReadStream(SINGLE_READS), 0.1, seed=1)]
+    with pytest.raises(ValueError):
+        list(keep_fraction(ReadStream(SINGLE_READS), 0))
+
+
+def test_keep_fraction_paired(tmp_path):
+    written = write_fasta(keep_fraction(PairedReadStream(*PAIRED_READS), 0.2),
+                          tmp_path / "reads_1.fa", tmp_path / "reads_2.fa")
+    mates_1 = [name for name, _ in ReadStream(tmp_path / "reads_1.fa")]
+    mates_2 = [name for name, _ in ReadStream(tmp_path / "reads_2.fa")]
+    assert len(mates_1) == len(mates_2) == written > 0
+    assert [name[:-2] for name in mates_1] == [name[:-2] for name in mates_2]
+
+
+def test_normalize_by_median():
+    rng = random.Random(0)
+    genome = "".join(rng.choice("ACGT") for _ in range(60))
+    reads = [(f"read{i}", genome) for i in range(50)] + [("other", genome[::-1])]
+    kept = [name for name, _ in normalize_by_median(reads, coverage=5, k=10)]
+    assert kept == [f"read{i}" for i in range(5)] + ["other"]
+
+
+def test_normalize_by_median_paired():
+    # a pair is kept while either mate is below the coverage
+    reads = [(f"pair{i}", ("ACGTACGGTCAAGT", f"TTGCA{'AC'[i % 2]}CCAGGATC")) for i in range(8)]
+    kept = [name for name, _ in normalize_by_median(reads, coverage=2, k=8)]
+    assert kept == ["pair0", "pair1", "pair2", "pair3"]
@@ -0,0 +1,109 @@
+"""
+Module for tracking the read coverage of a genome while reads are mapped.
+Coverage is kept in a difference array sized to the genome, so memory
+scales with the genome length instead of the number of reads.
+
+Classes
+    1. CoverageAccumulator - per-genome difference array of read coverage, giving
+                             the breadth, mean depth, depth evenness and
+                             windowed coverage.
+
+Methods
+    N/A
+"""
+from typing import Dict, Union, List, Tuple, Optional, Set
+import numpy as np
+
+
+
+
+class CoverageAccumulator:
+    """
+    This accumulates the coverage of the reads mapping to a genome.
+
+    A read spanning [start, end) adds 1 at diff[start] and -1 at diff[end],
+    so adding a read is O(1) and the depth at every base is the cumulative
+    sum of the difference array.
+    """
+
+    def __init__(self, genome_length: int):
+        self.genome_length: int = int(genome_length)
+        self._diff = np.zeros(self.genome_length + 1, dtype=np.int64)
+        self.mapped_bases: int = 0 # sum of the read span lengths
+        self.readcount: int = 0
+
+    def add(self, start: int, end: int):
+        """ adds the span of a single read """
+        start, end = self.__clip(start), self.__clip(end)
+        self._diff[start] += 1
+        self._diff[end] -= 1
+        self.mapped_bases += end - start
+        self.readcount += 1
+
+    def add_batch(self, starts: np.ndarray, ends: np.ndarray):
+        """ adds the spans of many reads at once """
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, self.genome_length)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), 0, self.genome_length)
+        np.add.at(self._diff, starts, 1)
+        np.add.at(self._diff, ends, -1)
+        self.mapped_bases += int(np.sum(ends - starts))
+        self.readcount += len(starts)
+
+    def merge(self, other: "CoverageAccumulator"):
+        """ adds the coverage of another accumulator for the same genome """
+        if other.genome_length != self.genome_length:
+            raise ValueError("can't merge coverage of genomes with different lengths")
+        self._diff += other._diff
+        self.mapped_bases += other.mapped_bases
+        self.readcount += other.readcount
+
+    def __clip(self, position: int) -> int:
+        """ keeps a position within the genome """
+        return min(max(int(position), 0), self.genome_length)
+
+    def depth(self) -> np.ndarray:
+        """ read depth at every base of the genome """
+        return np.cumsum(self._diff[:-1])
+
+    def breadth(self) -> float:
+        """ fraction of the genome covered by at least one read """
+        if self.genome_length == 0:
+            return 0.0
+        return float(np.count_nonzero(self.depth())) / self.genome_length
+
+    def mean_depth(self) -> float:
+        """ average read depth across the genome """
+        if self.genome_length == 0:
+            return 0.0
+        return self.mapped_bases / self.genome_length
+
+    def evenness(self) -> float:
+        """
+        evenness score of the depth (Mokry et al. 2010); 1.0 if every base has
+        the mean depth, approaching 0.0 as the reads pile up in fewer places.
+        """
+        depth = self.depth()
+        mean_depth = int(round(self.mean_depth()))
+        if mean_depth == 0:
+            return 0.0
+        below_mean = depth[depth <= mean_depth]
+        return float(1.0 - (len(below_mean) - np.sum(below_mean) / mean_depth) / self.genome_length)
+
+    def windowed_coverage(self, window_size: int = 1000) -> np.ndarray:
+        """ mean depth in consecutive windows across the genome """
+        depth = self.depth()
+        window_starts = np.arange(0, self.genome_length, window_size)
+        if len(window_starts) == 0:
+            return np.zeros(0, dtype=np.float64)
+        window_sums = np.add.reduceat(depth, window_starts)
+        window_lengths = np.diff(np.append(window_starts, self.genome_length))
+        return window_sums / window_lengths
+
+    def covered_intervals(self) -> Set[Tuple[int, int]]:
+        """
+        the regions of the genome covered by reads, with overlapping
+        (or touching) reads merged into one interval.
+        """
+        covered = np.concatenate(([0], (self.depth() > 0).astype(np.int8), [0]))
+        edges = np.flatnonzero(np.diff(covered))
+        return set(zip(edges[0::2].tolist(), edges[1::2].tolist()))
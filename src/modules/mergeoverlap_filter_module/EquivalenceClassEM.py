@@ -0,0 +1,103 @@
+"""
+Module for estimating genome abundances from reads that map to more than
+one genome. Reads are grouped into equivalence classes (the set of genomes
+a read is compatible with, plus the number of reads with that set), and the
+reads of each class are shared between its genomes with expectation-maximization.
+
+Classes
+    1. EquivalenceClassEM - resolves equivalence class counts into abundances.
+
+Methods
+    N/A
+"""
+from typing import Dict, Union, List, Tuple, Optional, Iterable
+import numpy as np
+
+
+
+
+class EquivalenceClassEM:
+    """
+    This estimates the fraction of reads from each genome, given the
+    equivalence classes of the reads.
+
+    Each iteration shares the reads of every class between its genomes in
+    proportion to the current abundances (E-step), then sets the abundances
+    to the share each genome received (M-step). The classes are held as a
+    (classes x genomes) matrix, so the cost of an iteration depends on the
+    number of classes, not the number of reads.
+    """
+
+    def __init__(self, max_iterations: int = 1000, tolerance: float = 1e-8):
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance # max change in any abundance to stop
+        self.iterations = 0 # iterations used in the last fit
+
+    def fit(self, hit_classes: Dict[Tuple[str, ...], int], genome_subset: Optional[Iterable[str]] = None) -> Dict[str, float]:
+        """
+        resolves the equivalence classes into read counts per genome.
+        INPUT
+            1. {(genomes a read hits): number of reads}
+            2. genomes to keep (optional, all genomes if None); genomes
+               outside of the subset are dropped from the classes
+        OUTPUT
+            {genome: expected number of reads, ..., 'UNK': unassigned reads}
+        """
+        if genome_subset is not None:
+            genome_subset = set(genome_subset)
+            hit_classes = self.restrict(hit_classes, genome_subset)
+        unassigned = sum(count for hit_class, count in hit_classes.items() if not hit_class)
+        hit_classes = {hit_class: count for hit_class, count in hit_classes.items() if hit_class}
+        genome_names = sorted({genome for hit_class in hit_classes for genome in hit_class})
+        read_counts: Dict[str, float] = {}
+        if genome_names:
+            compatibility, class_counts = self.class_matrix(hit_classes, genome_names)
+            abundances = self.expectation_maximization(compatibility, class_counts)
+            mapped_reads = class_counts.sum()
+            for genome, abundance in zip(genome_names, abundances):
+                read_counts[genome] = float(abundance * mapped_reads)
+        if unassigned:
+            read_counts["UNK"] = float(unassigned)
+        return read_counts
+
+    @staticmethod
+    def restrict(hit_classes: Dict[Tuple[str, ...], int], genome_subset: set) -> Dict[Tuple[str, ...], int]:
+        """ drops the genomes outside of the subset, merging classes that become equal """
+        restricted: Dict[Tuple[str, ...], int] = {}
+        for hit_class, count in hit_classes.items():
+            kept_class = tuple(genome for genome in hit_class if genome in genome_subset)
+            restricted[kept_class] = restricted.get(kept_class, 0) + count
+        return restricted
+
+    @staticmethod
+    def class_matrix(hit_classes: Dict[Tuple[str, ...], int], genome_names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        builds the (classes x genomes) compatibility matrix and
+        the read count of each class.
+        """
+        genome_index = {genome: index for index, genome in enumerate(genome_names)}
+        compatibility = np.zeros((len(hit_classes), len(genome_names)), dtype=np.float64)
+        class_counts = np.empty(len(hit_classes), dtype=np.float64)
+        for class_index, (hit_class, count) in enumerate(hit_classes.items()):
+            compatibility[class_index, [genome_index[genome] for genome in hit_class]] = 1.0
+            class_counts[class_index] = count
+        return compatibility, class_counts
+
+    def expectation_maximization(self, compatibility: np.ndarray, class_counts: np.ndarray) -> np.ndarray:
+        """
+        INPUT
+            1. (classes x genomes) compatibility matrix
+            2. read count of each class
+        OUTPUT
+            fraction of the mapped reads from each genome
+        """
+        total_reads = class_counts.sum()
+        abundances = np.full(compatibility.shape[1], 1.0 / compatibility.shape[1])
+        for self.iterations in range(1, self.max_iterations + 1):
+            class_likelihoods = compatibility @ abundances # reads of a class go to genomes in proportion to these
+            new_abundances = abundances * (compatibility.T @ (class_counts / class_likelihoods)) / total_reads
+            converged = np.max(np.abs(new_abundances - abundances)) < self.tolerance
+            abundances = new_abundances
+            if converged:
+                break
+        return abundances
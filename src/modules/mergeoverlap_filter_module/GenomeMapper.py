@@ -7,13 +7,42 @@ Classes
     2. MinimapMapperWithInfo - concrete class using minimap as a mapper. This class
                                also saved inforrmation about the mapped reads.
     3. MinimapMapper - concrete class using minimap as a mapper.
+    4. MinimapMultiMapperWithInfo - concrete class using a single minimap index built
+                                    from many genomes. Hits are attributed to a genome
+                                    using the contig name.
 
 Methods
-    N/A
+    1. load_aligner - minimap2 index of a genome file, built once per process.
 """
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, Union, List, Tuple, Optional
+import os
+import tempfile
 import mappy as mp
+from MappingStats import MappingStats
+
+
+ALIGNER_CACHE_SIZE = 512 # genome indexes kept per process (phage genomes are small)
+
+
+@lru_cache(maxsize=ALIGNER_CACHE_SIZE)
+def _cached_aligner(real_path: str, size: int, mtime_ns: int, best_n: int) -> mp.Aligner:
+    return mp.Aligner(real_path, best_n=best_n)
+
+
+def load_aligner(file_path, best_n=1) -> mp.Aligner:
+    """
+    DESCRIPTION:
+        returns the minimap2 index of a genome file. Indexes are kept per
+        process (keyed by path, size and mtime), so the samples of a
+        batch mapped in the same process share them. The indexes are only
+        read once built, so they can be used from several mappers at once.
+    """
+    real_path = os.path.realpath(file_path)
+    stat = os.stat(real_path)
+    return _cached_aligner(real_path, stat.st_size, stat.st_mtime_ns, best_n)
 
 
 
@@ -21,8 +50,13 @@ import mappy as mp
 class GenomeMapper(ABC):
     """ This acts as an adapter for mapping reads to a genome """
 
-    def __init__(self, name):
+    def __init__(self, name, keep_spans=True):
         self._genome_name = name
+        self.keep_spans = keep_spans # if False, only the coverage of the reads is kept
+        self.minimap_out = {}
+        self.genome_lengths: Dict[str, int] = {} # genome name -> total length
+        self.contig2genome: Dict[str, str] = {} # contig name -> genome name
+        self.contig_offsets: Dict[str, int] = {} # contig name -> start within the genome
  
     @abstractmethod
     def map_fasta_read(self, sequence):
@@ -50,63 +84,280 @@ class GenomeMapper(ABC):
         """
         pass 
 
+    @abstractmethod
+    def hit_genomes(self, sequence, thread_buffer=None, minimap_out=None, genome=None) -> List[str]:
+        """
+        returns the names of the genomes the read maps to, best hit first
+        (empty if unmapped). information about the best hit is added to
+        minimap_out, so each thread can use its own buffer and dictionary.
+        if a genome is given, only the hits on that genome are used.
+        """
+        pass
+
+    def assign_read(self, sequence, thread_buffer=None, minimap_out=None) -> Optional[str]:
+        """
+        returns the name of the genome the read maps to (None if unmapped).
+        """
+        genomes = self.hit_genomes(sequence, thread_buffer, minimap_out)
+        return genomes[0] if genomes else None
+
+    def add_contig(self, contig_name, genome_name, contig_length):
+        """
+        adds a contig of the index to its genome (contigs of a genome
+        are placed one after the other in the genome coordinates).
+        """
+        self.contig2genome[contig_name] = genome_name
+        self.contig_offsets[contig_name] = self.genome_lengths.get(genome_name, 0)
+        self.genome_lengths[genome_name] = self.contig_offsets[contig_name] + contig_length
+
+    def record_hit(self, minimap_out, hits) -> str:
+        """
+        adds the best hit to minimap_out (in genome coordinates) and
+        returns the genome name for the hit. For read pairs, the best
+        hit is merged with its mate, so the fragment span is added.
+        """
+        best_hit = hits[0]
+        start, end, mapq = best_hit.r_st, best_hit.r_en, best_hit.mapq
+        for mate_hit in hits[1:]:
+            if mate_hit.read_num != best_hit.read_num and mate_hit.ctg == best_hit.ctg and mate_hit.is_primary:
+                start, end = min(start, mate_hit.r_st), max(end, mate_hit.r_en)
+                mapq = max(mapq, mate_hit.mapq)
+                break
+        genome_name = self.contig2genome[best_hit.ctg]
+        offset = self.contig_offsets[best_hit.ctg]
+        if genome_name not in minimap_out:
+            minimap_out[genome_name] = MappingStats() # create if first time
+        minimap_out[genome_name].add(mapq, start + offset, end + offset)
+        return genome_name
+
+    def merge_minimap_out(self, other_minimap_out):
+        """
+        merges the information in other_minimap_out into minimap_out
+        (used for combining the statistics from each thread). The
+        coverage of the reads is accumulated here.
+        """
+        for genome_name, genome_out in other_minimap_out.items():
+            if genome_name not in self.minimap_out:
+                self.minimap_out[genome_name] = MappingStats(genome_length=self.genome_lengths[genome_name],
+                                                             keep_spans=self.keep_spans)
+            self.minimap_out[genome_name].extend(genome_out)
+
+    def new_thread_buffer(self):
+        """
+        returns the per-thread buffer used by the underlying mapper.
+        """
+        return None
+
+    def map_batch(self, sequences: List[str], threads: int = 1,
+                  assigned: Optional[List[bool]] = None,
+                  genomes: Optional[List[Optional[str]]] = None) -> List[List[str]]:
+        """
+        maps a batch of reads using a pool of worker threads.
+
+        The batch is split into one chunk per thread. Each worker uses its
+        own thread buffer and statistics, which are merged (in read order)
+        into minimap_out once every chunk has been mapped.
+
+        INPUT:
+            1. list of read sequences (or (mate 1, mate 2) tuples for read pairs)
+            2. number of threads
+            3. (optional) list marking reads already assigned to another
+               genome; these are mapped, but not added to minimap_out.
+            4. (optional) list with the genome each read is restricted to
+               (or None); only the hits on that genome are used.
+        OUTPUT:
+            1. list with the genomes each read maps to (best hit first)
+        """
+        if assigned is None:
+            assigned = [False] * len(sequences)
+        if genomes is None:
+            genomes = [None] * len(sequences)
+        threads = max(1, min(int(threads), len(sequences)))
+        chunk_size = -(-len(sequences) // threads) if sequences else 0
+        chunks = [(sequences[i:i + chunk_size], assigned[i:i + chunk_size], genomes[i:i + chunk_size])
+                  for i in range(0, len(sequences), chunk_size or 1)]
+        if threads == 1:
+            chunk_results = [self._map_chunk(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                chunk_results = list(pool.map(self._map_chunk, chunks))
+        read_genomes = []
+        for chunk_genomes, chunk_minimap_out in chunk_results:
+            read_genomes.extend(chunk_genomes)
+            if chunk_minimap_out:
+                self.merge_minimap_out(chunk_minimap_out)
+        return read_genomes
+
+    def _map_chunk(self, chunk: Tuple[List[str], List[bool], List[Optional[str]]]) -> Tuple[List[List[str]], Dict]:
+        """ maps a chunk of reads within a single worker thread """
+        thread_buffer = self.new_thread_buffer()
+        chunk_minimap_out = {}
+        chunk_genomes = [self.hit_genomes(sequence, thread_buffer,
+                                          None if read_assigned else chunk_minimap_out, genome)
+                         for sequence, read_assigned, genome in zip(*chunk)]
+        return chunk_genomes, chunk_minimap_out
+
 class MinimapMapperWithInfo(GenomeMapper):
     """ mapping object adapter for minimap """
 
-    def __init__(self, name, file_path):
-        self._genome_name = name
-        self.index_object = mp.Aligner(file_path, best_n=1)
-        self.minimap_out = {}
+    def __init__(self, name, file_path, keep_spans=True):
+        super().__init__(name, keep_spans=keep_spans)
+        self.index_object = load_aligner(file_path, best_n=1)
+        for contig_name in self.index_object.seq_names:
+            self.add_contig(contig_name, name, len(self.index_object.seq(contig_name)))
 
-    def map_fasta_read(self, sequence):
+    def map_fasta_read(self, sequence, thread_buffer=None):
         """
-        this method is used to map an individual read.
+        this method is used to map an individual read
+        (or a read pair, given as a tuple).
         """
         #print("{}\t{}\t{}\t{}\t{}".format(hit.ctg, hit.r_st, hit.r_en, hit.mapq, hit.mlen))
-        return self.index_object.map(sequence)
+        if isinstance(sequence, tuple): # mates are mapped jointly
+            return self.index_object.map(sequence[0], sequence[1], buf=thread_buffer)
+        return self.index_object.map(sequence, buf=thread_buffer)
+
+    def new_thread_buffer(self):
+        """
+        returns a mappy buffer for a single thread.
+        """
+        return mp.ThreadBuffer()
 
     def does_read_map(self, sequence) -> bool:
         """
         checks if the input read maps to the given genome.
         if it does, get information about the mapped read. 
         """
-        try:
-            first_result = next(self.map_fasta_read(sequence))
-            if self.genome_name in self.minimap_out:
-                self.minimap_out[self.genome_name]["mapq"].append(first_result.mapq)
-                #self.minimap_out[genomeName]["readmaps"].add((first_result.r_st, first_result.r_en))
-                self.minimap_out[self.genome_name]["readmaps"].append((first_result.r_st, first_result.r_en))
-                self.minimap_out[self.genome_name]["readcount"] += 1
-            else:
-                self.minimap_out[self.genome_name] = {} # create if first time
-                self.minimap_out[self.genome_name]["mapq"] = [first_result.mapq]
-                #self.minimap_out[genomeName]["readmaps"] = set((first_result.r_st, first_result.r_en))
-                self.minimap_out[self.genome_name]["readmaps"] = [(first_result.r_st, first_result.r_en)]
-                self.minimap_out[self.genome_name]["readcount"] = 1
-        except StopIteration:
-            return False
-        return True
+        return len(self.map_batch([sequence])[0]) > 0
+
+    def hit_genomes(self, sequence, thread_buffer=None, minimap_out=None, genome=None) -> List[str]:
+        """
+        returns [genome name] if the read maps (empty if not).
+        if it does, get information about the mapped read. 
+        """
+        hits = list(self.map_fasta_read(sequence, thread_buffer))
+        if not hits:
+            return []
+        if minimap_out is not None:
+            self.record_hit(minimap_out, hits)
+        return [self.genome_name]
 
 class MinimapMapper(GenomeMapper):
     """ mapping object adapter for minimap """
 
     def __init__(self, name, file_path):
-        self._genome_name = name
-        self.index_object = mp.Aligner(file_path, best_n=1)
+        super().__init__(name)
+        self.index_object = load_aligner(file_path, best_n=1)
 
-    def map_fasta_read(self, sequence):
+    def map_fasta_read(self, sequence, thread_buffer=None):
         """
-        this method is used to map an individual read.
+        this method is used to map an individual read
+        (or a read pair, given as a tuple).
         """
         #print("{}\t{}\t{}\t{}\t{}".format(hit.ctg, hit.r_st, hit.r_en, hit.mapq, hit.mlen))
-        return self.index_object.map(sequence)
+        if isinstance(sequence, tuple): # mates are mapped jointly
+            return self.index_object.map(sequence[0], sequence[1], buf=thread_buffer)
+        return self.index_object.map(sequence, buf=thread_buffer)
+
+    def new_thread_buffer(self):
+        """
+        returns a mappy buffer for a single thread.
+        """
+        return mp.ThreadBuffer()
 
     def does_read_map(self, sequence) -> bool:
         """
         checks if the input read maps to the given genome.
         """
+        return self.assign_read(sequence) is not None
+
+    def hit_genomes(self, sequence, thread_buffer=None, minimap_out=None, genome=None) -> List[str]:
+        """
+        returns [genome name] if the read maps (empty if not).
+        """
         try:
-            first_result = next(self.map_fasta_read(sequence))
+            first_result = next(self.map_fasta_read(sequence, thread_buffer))
         except StopIteration:
-            return False
-        return True
\ No newline at end of file
+            return []
+        return [self.genome_name]
+
+
+class MinimapMultiMapperWithInfo(GenomeMapper):
+    """
+    mapping object adapter for minimap, using a single index for all genomes.
+
+    All genomes are written into one multi-sequence index, so each read
+    is mapped once instead of once per genome. The contig name of the
+    best hit is used to find the genome the read belongs to, and the
+    secondary hits give the other genomes the read maps to.
+    """
+
+    def __init__(self, name, genome_paths: Dict[str, str], best_n=1, keep_spans=True):
+        super().__init__(name, keep_spans=keep_spans)
+        with tempfile.TemporaryDirectory() as index_dir:
+            merged_fasta = os.path.join(index_dir, "merged_genomes.fa")
+            contig_genomes = self.write_merged_fasta(genome_paths, merged_fasta)
+            self.index_object = mp.Aligner(merged_fasta, best_n=best_n)
+        if not self.index_object:
+            raise RuntimeError(f"minimap2 could not build the merged index for {name}")
+        for contig_name in self.index_object.seq_names:
+            self.add_contig(contig_name, contig_genomes[contig_name], len(self.index_object.seq(contig_name)))
+
+    def write_merged_fasta(self, genome_paths: Dict[str, str], merged_fasta) -> Dict[str, str]:
+        """
+        writes every genome into one multi-fasta and returns
+        which genome each contig came from.
+        """
+        contig_genomes: Dict[str, str] = {}
+        with open(merged_fasta, "w") as merged_file:
+            for genome_name, file_path in genome_paths.items():
+                with open(file_path) as genome_file:
+                    for line in genome_file:
+                        if line[0] == ">":
+                            contig_name = line[1:].split()[0] if line[1:].strip() else genome_name
+                            if contig_name in contig_genomes: # keep contig names unique
+                                contig_name = f"{genome_name}_{contig_name}"
+                            contig_genomes[contig_name] = genome_name
+                            merged_file.write(f">{contig_name}\n")
+                        else:
+                            merged_file.write(line.rstrip("\n") + "\n")
+        return contig_genomes
+
+    def map_fasta_read(self, sequence, thread_buffer=None):
+        """
+        this method is used to map an individual read
+        (or a read pair, given as a tuple).
+        """
+        if isinstance(sequence, tuple): # mates are mapped jointly
+            return self.index_object.map(sequence[0], sequence[1], buf=thread_buffer)
+        return self.index_object.map(sequence, buf=thread_buffer)
+
+    def new_thread_buffer(self):
+        """
+        returns a mappy buffer for a single thread.
+        """
+        return mp.ThreadBuffer()
+
+    def hit_genomes(self, sequence, thread_buffer=None, minimap_out=None, genome=None) -> List[str]:
+        """
+        returns the genomes the read maps to, best hit first (empty if unmapped).
+        if it maps, get information about the best hit (on the given genome only,
+        if there is one).
+        """
+        hits = list(self.map_fasta_read(sequence, thread_buffer))
+        if genome is not None:
+            hits = [hit for hit in hits if self.contig2genome[hit.ctg] == genome]
+        if hits and minimap_out is not None:
+            self.record_hit(minimap_out, hits)
+        genomes = []
+        for hit in hits:
+            genome_name = self.contig2genome[hit.ctg]
+            if genome_name not in genomes:
+                genomes.append(genome_name)
+        return genomes
+
+    def does_read_map(self, sequence) -> bool:
+        """
+        checks if the input read maps to any of the genomes.
+        """
+        return len(self.map_batch([sequence])[0]) > 0
+
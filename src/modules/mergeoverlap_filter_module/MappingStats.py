@@ -0,0 +1,202 @@
+"""
+Module for storing information about the reads mapping to each genome. The
+statistics are kept in growable typed arrays (instead of python lists), and
+are saved in a compressed columnar file.
+
+Classes
+    1. MappingStats - growable typed-array store of the mapq values and the
+                      reference spans of the reads mapping to a genome.
+
+Methods
+    1. save_minimap_out - saves a minimap_out dictionary to a compressed .npz file.
+    2. load_minimap_out - loads a minimap_out dictionary from a .npz file.
+"""
+from typing import Dict, Union, List, Tuple, Optional
+import numpy as np
+from CoverageAccumulator import CoverageAccumulator
+
+
+
+
+class MappingStats:
+    """
+    This holds the mapq (uint8) and the start/end (int32) of each read
+    mapping to a genome. Arrays double in size when full, so adding a
+    read is amortized O(1) and costs 9 bytes per read.
+
+    If genome_length is given, the read spans are also added to a
+    CoverageAccumulator as they arrive. With keep_spans=False the spans
+    themselves are not stored, so only the mapq grows with the read count.
+
+    For compatibility with the nested dictionaries used before, the
+    statistics can also be accessed by key:
+        stats["mapq"], stats["readmaps"], stats["readcount"]
+    and extra features (e.g. "percentOverlap") can be stored by key.
+    """
+    STAT_KEYS = ("mapq", "readmaps", "readcount")
+
+    def __init__(self, capacity: int = 1024, genome_length: Optional[int] = None, keep_spans: bool = True):
+        self.keep_spans = keep_spans
+        span_capacity = capacity if keep_spans else 0
+        self._mapq = np.empty(capacity, dtype=np.uint8)
+        self._starts = np.empty(span_capacity, dtype=np.int32)
+        self._ends = np.empty(span_capacity, dtype=np.int32)
+        self._readcount = 0
+        self.coverage: Optional[CoverageAccumulator] = None
+        if genome_length is not None:
+            self.coverage = CoverageAccumulator(genome_length)
+        self.features: Dict[str, object] = {} # extra features (e.g. percentOverlap)
+
+    @classmethod
+    def from_arrays(cls, mapq, starts, ends):
+        """
+        creates the store directly from arrays (no copy is made
+        if the arrays already have the right type).
+        """
+        stats = cls(capacity=0, keep_spans=len(starts) == len(mapq))
+        stats._mapq = np.asarray(mapq, dtype=np.uint8)
+        stats._starts = np.asarray(starts, dtype=np.int32)
+        stats._ends = np.asarray(ends, dtype=np.int32)
+        stats._readcount = len(stats._mapq)
+        return stats
+
+    def __grow(self, min_capacity: int):
+        """ doubles the capacity of the arrays until min_capacity fits """
+        capacity = max(len(self._mapq), 1)
+        while capacity < min_capacity:
+            capacity *= 2
+        attributes = ("_mapq", "_starts", "_ends") if self.keep_spans else ("_mapq",)
+        for attribute in attributes:
+            old_array = getattr(self, attribute)
+            new_array = np.empty(capacity, dtype=old_array.dtype)
+            new_array[:self._readcount] = old_array[:self._readcount]
+            setattr(self, attribute, new_array)
+
+    def add(self, mapq: int, start: int, end: int):
+        """ adds a mapped read """
+        if self._readcount == len(self._mapq):
+            self.__grow(self._readcount + 1)
+        self._mapq[self._readcount] = mapq
+        if self.keep_spans:
+            self._starts[self._readcount] = start
+            self._ends[self._readcount] = end
+        if self.coverage is not None:
+            self.coverage.add(start, end)
+        self._readcount += 1
+
+    def extend(self, other: "MappingStats"):
+        """
+        adds all of the reads in another store (which must keep its spans,
+        unless both stores only hold coverage).
+        """
+        new_readcount = self._readcount + other.readcount
+        if new_readcount > len(self._mapq):
+            self.__grow(new_readcount)
+        self._mapq[self._readcount:new_readcount] = other.mapq
+        if self.keep_spans:
+            self._starts[self._readcount:new_readcount] = other.starts
+            self._ends[self._readcount:new_readcount] = other.ends
+        if self.coverage is not None:
+            if other.keep_spans:
+                self.coverage.add_batch(other.starts, other.ends)
+            else:
+                self.coverage.merge(other.coverage)
+        self._readcount = new_readcount
+
+    @property
+    def readcount(self) -> int:
+        """ number of reads mapped """
+        return self._readcount
+
+    @property
+    def mapq(self) -> np.ndarray:
+        """ mapq of each mapped read (view) """
+        return self._mapq[:self._readcount]
+
+    @property
+    def starts(self) -> np.ndarray:
+        """ reference start of each mapped read (view, empty if spans aren't kept) """
+        return self._starts[:self._readcount]
+
+    @property
+    def ends(self) -> np.ndarray:
+        """ reference end of each mapped read (view, empty if spans aren't kept) """
+        return self._ends[:self._readcount]
+
+    @property
+    def readmaps(self) -> np.ndarray:
+        """ (start, end) of each mapped read, as a (readcount, 2) array """
+        return np.column_stack((self.starts, self.ends))
+
+    def keys(self) -> List[str]:
+        """ names of the statistics and features held """
+        return list(self.STAT_KEYS) + list(self.features.keys())
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key in self.STAT_KEYS:
+            return getattr(self, key)
+        return self.features[key]
+
+    def __setitem__(self, key, value):
+        if key in self.STAT_KEYS:
+            raise KeyError(f"{key} is computed from the mapped reads and can't be set")
+        self.features[key] = value
+
+
+def save_minimap_out(minimap_out: Dict[str, MappingStats], out_path):
+    """
+    saves a minimap_out dictionary to a compressed columnar .npz file.
+
+    The reads of every genome are concatenated into one column per statistic,
+    with offsets columns giving where each genome starts (spans have their own
+    offsets, since a store may not keep them). Numerical features (e.g.
+    percentOverlap) are saved as one column with a value per genome.
+    """
+    genome_names = list(minimap_out.keys())
+    readcounts = np.array([minimap_out[name].readcount for name in genome_names], dtype=np.int64)
+    offsets = np.zeros(len(genome_names) + 1, dtype=np.int64)
+    np.cumsum(readcounts, out=offsets[1:])
+    span_counts = np.array([len(minimap_out[name].starts) for name in genome_names], dtype=np.int64)
+    span_offsets = np.zeros(len(genome_names) + 1, dtype=np.int64)
+    np.cumsum(span_counts, out=span_offsets[1:])
+    columns = {
+        "genome_names": np.array(genome_names, dtype=str),
+        "offsets": offsets,
+        "span_offsets": span_offsets,
+        "mapq": np.concatenate([minimap_out[name].mapq for name in genome_names] or [np.empty(0, np.uint8)]),
+        "starts": np.concatenate([minimap_out[name].starts for name in genome_names] or [np.empty(0, np.int32)]),
+        "ends": np.concatenate([minimap_out[name].ends for name in genome_names] or [np.empty(0, np.int32)]),
+    }
+    feature_names = {feature for name in genome_names for feature in minimap_out[name].features}
+    for feature in sorted(feature_names):
+        values = [minimap_out[name].features.get(feature, np.nan) for name in genome_names]
+        if all(np.isscalar(value) for value in values):
+            columns[f"feature_{feature}"] = np.array(values, dtype=np.float64)
+    np.savez_compressed(out_path, **columns)
+
+
+def load_minimap_out(npz_path) -> Dict[str, MappingStats]:
+    """
+    loads a minimap_out dictionary saved with save_minimap_out.
+    Each column is decompressed once; the per-genome statistics are
+    views (no copies) into the loaded columns.
+    """
+    minimap_out: Dict[str, MappingStats] = {}
+    with np.load(npz_path) as columns:
+        offsets = columns["offsets"]
+        span_offsets = columns["span_offsets"] if "span_offsets" in columns.files else offsets
+        mapq, starts, ends = columns["mapq"], columns["starts"], columns["ends"]
+        feature_columns = {key[len("feature_"):]: columns[key]
+                           for key in columns.files if key.startswith("feature_")}
+        for index, genome_name in enumerate(columns["genome_names"]):
+            start, end = offsets[index], offsets[index + 1]
+            span_start, span_end = span_offsets[index], span_offsets[index + 1]
+            stats = MappingStats.from_arrays(mapq[start:end], starts[span_start:span_end], ends[span_start:span_end])
+            for feature, values in feature_columns.items():
+                if not np.isnan(values[index]):
+                    stats[feature] = float(values[index])
+            minimap_out[str(genome_name)] = stats
+    return minimap_out
@@ -0,0 +1,219 @@
+"""
+Module for streaming reads from a sequencing file. Reads are yielded one at
+a time, so memory stays flat regardless of the size of the input file.
+
+Classes
+    1. ReadStream - streams reads from a FASTA or FASTQ file (optionally gzipped)
+                    and counts the reads that were yielded.
+    2. PairedReadStream - streams read pairs from two synchronized mate files
+                          and counts the fragments that were yielded.
+
+Methods
+    1. sampled_reads - yields every read of a stream once, in an interleaved
+                       or random order, so any prefix is a sample of the file
+                       (the buckets are spilled to temporary files, within a
+                       size limit per pass over the file, and read back in
+                       an order spread across the file).
+    2. sampled_sequences - same as sampled_reads, yielding only the sequences.
+"""
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Union
+import array
+import contextlib
+import itertools
+import mmap
+import tempfile
+import re
+import numpy as np
+import mappy as mp
+
+
+MAX_SPILL_BYTES = 1024**3 # reads written to spill files per pass by sampled_reads
+
+
+class ReadStream:
+    """ This streams reads from a FASTA/FASTQ(.gz) file """
+
+    def __init__(self, read_path: Union[str, Path]):
+        self.read_path: Path = Path(read_path)
+        self.total_reads: int = 0 # updated while streaming
+        if not self.read_path.is_file():
+            raise FileNotFoundError(f"{self.read_path} does not exist.")
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        """
+        yields (name, sequence) for each read in the file.
+        """
+        self.total_reads = 0
+        for name, sequence, _ in mp.fastx_read(str(self.read_path)):
+            self.total_reads += 1
+            yield name, sequence
+
+    def sequences(self) -> Iterator[str]:
+        """
+        yields only the sequence for each read in the file.
+        """
+        for _, sequence in self:
+            yield sequence
+
+
+class PairedReadStream:
+    """ This streams read pairs from two mate FASTA/FASTQ(.gz) files """
+
+    MATE_SUFFIX = re.compile(r"/[12]$")
+
+    def __init__(self, read_path_1: Union[str, Path], read_path_2: Union[str, Path]):
+        self.mates_1 = ReadStream(read_path_1)
+        self.mates_2 = ReadStream(read_path_2)
+        self.total_reads: int = 0 # number of fragments, updated while streaming
+
+    def __iter__(self) -> Iterator[Tuple[str, Tuple[str, str]]]:
+        """
+        yields (name, (sequence 1, sequence 2)) for each read pair.
+        """
+        self.total_reads = 0
+        mates_2 = iter(self.mates_2)
+        for name_1, sequence_1 in self.mates_1:
+            try:
+                name_2, sequence_2 = next(mates_2)
+            except StopIteration:
+                raise ValueError(f"{self.mates_2.read_path} has fewer reads than {self.mates_1.read_path}")
+            if self.MATE_SUFFIX.sub("", name_1) != self.MATE_SUFFIX.sub("", name_2):
+                raise ValueError(f"mate files are not synchronized: {name_1} and {name_2}")
+            self.total_reads += 1
+            yield name_1, (sequence_1, sequence_2)
+        if next(mates_2, None) is not None:
+            raise ValueError(f"{self.mates_1.read_path} has fewer reads than {self.mates_2.read_path}")
+
+    def sequences(self) -> Iterator[Tuple[str, str]]:
+        """
+        yields only the (sequence 1, sequence 2) for each read pair.
+        """
+        for _, sequences in self:
+            yield sequences
+
+
+def sampled_reads(reads: Union[ReadStream, PairedReadStream], n_buckets: int = 20,
+                  order: str = "interleaved", seed: int = 0, spill_directory=None,
+                  max_spill_bytes: int = MAX_SPILL_BYTES) -> Iterator:
+    """
+    yields the reads of a read stream bucket by bucket, so that the
+    reads seen so far are a sample spread across the whole file (instead
+    of its first reads). Every read is yielded exactly once.
+
+    Each pass over the file spills the reads of the next buckets to
+    temporary files (one per bucket, under spill_directory), which are
+    yielded once the pass is over, in an order spread across the file
+    (bit reversed positions, or shuffled with the "random" order). The
+    first pass only spills the first bucket, so a run that stops within
+    it reads the file once and writes 1 / n_buckets of it. The following
+    passes spill as many buckets as fit in max_spill_bytes (at least
+    one), and each spill file is deleted once it has been yielded.
+    INPUT
+        1. ReadStream or PairedReadStream
+        2. number of buckets
+        3. "interleaved" (read i goes to bucket i % n_buckets) or
+           "random" (each read goes to a random bucket, seeded)
+        4. random seed
+        5. directory of the spill files [Default the system temporary directory]
+        6. max bytes of reads spilled per pass
+    OUTPUT
+        (name, sequence) reads (or (name, sequence pair)), bucket by bucket
+    """
+    if order not in ("interleaved", "random"):
+        raise ValueError(f"unknown read order: {order}")
+    bucket_order = list(range(n_buckets))
+    if order == "random":
+        bucket_order = np.random.default_rng(seed).permutation(n_buckets).tolist()
+    with tempfile.TemporaryDirectory(dir=spill_directory) as pass_directory:
+        remaining = bucket_order
+        first_pass = True
+        while remaining:
+            spilled = _spill_buckets(reads, remaining[:1] if first_pass else remaining, n_buckets, order, seed,
+                                     Path(pass_directory), max_spill_bytes)
+            for bucket in remaining[:len(spilled)]:
+                spill_path, line_starts = spilled[bucket]
+                if order == "interleaved":
+                    line_order = _spread_order(len(line_starts))
+                else:
+                    line_order = np.random.default_rng([seed, bucket]).permutation(len(line_starts))
+                yield from _read_spill(spill_path, np.frombuffer(line_starts, dtype=np.int64), line_order)
+                spill_path.unlink()
+            remaining = remaining[len(spilled):]
+            first_pass = False
+
+
+def _spill_buckets(reads, buckets, n_buckets, order, seed, spill_directory: Path,
+                   max_spill_bytes) -> Dict[int, Tuple[Path, array.array]]:
+    """
+    streams the reads once and writes the reads of the buckets (in
+    priority order) to one file each. Once more than max_spill_bytes are
+    written, the last buckets are dropped (but not the first), so the
+    buckets spilled are always the first ones. Returns the spill file
+    and the offset of each line, per bucket.
+    """
+    if order == "interleaved":
+        read_buckets = itertools.cycle(range(n_buckets))
+    else:
+        read_buckets = _random_buckets(n_buckets, seed)
+    spill_paths = {bucket: spill_directory / f"{bucket}.tsv" for bucket in buckets}
+    line_starts = {bucket: array.array("q") for bucket in buckets}
+    bucket_bytes = {bucket: 0 for bucket in buckets}
+    spilled_bytes = 0
+    with contextlib.ExitStack() as spill_files:
+        spills = {bucket: spill_files.enter_context(open(spill_path, "wb"))
+                  for bucket, spill_path in spill_paths.items()}
+        kept = list(buckets) # buckets still spilled, in priority order
+        for (name, sequence), read_bucket in zip(reads, read_buckets):
+            if read_bucket not in spills:
+                continue
+            mates = sequence if isinstance(sequence, tuple) else (sequence,)
+            line = ("\t".join((name, *mates)) + "\n").encode()
+            spills[read_bucket].write(line)
+            line_starts[read_bucket].append(bucket_bytes[read_bucket])
+            bucket_bytes[read_bucket] += len(line)
+            spilled_bytes += len(line)
+            while spilled_bytes > max_spill_bytes and len(kept) > 1: # left for a later pass
+                dropped = kept.pop()
+                spilled_bytes -= bucket_bytes[dropped]
+                spills.pop(dropped).close()
+                spill_paths.pop(dropped).unlink()
+    return {bucket: (spill_path, line_starts[bucket]) for bucket, spill_path in spill_paths.items()}
+
+
+def _read_spill(spill_path: Path, line_starts: np.ndarray, line_order: np.ndarray) -> Iterator:
+    """ yields the reads of a spill file, in the given order of its lines """
+    if not len(line_starts):
+        return
+    line_ends = np.append(line_starts[1:], spill_path.stat().st_size)
+    with open(spill_path, "rb") as spill_file, mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ) as spill:
+        for line_index in line_order:
+            line = spill[line_starts[line_index]:line_ends[line_index]].decode()
+            name, *mates = line.rstrip("\n").split("\t")
+            yield name, (tuple(mates) if len(mates) > 1 else mates[0])
+
+
+def _spread_order(n_lines: int) -> np.ndarray:
+    """ positions 0..n_lines-1 in bit reversed order, so every prefix is spread across them """
+    bits = max(1, (n_lines - 1).bit_length())
+    positions = np.arange(1 << bits, dtype=np.int64)
+    reversed_positions = np.zeros_like(positions)
+    for bit in range(bits):
+        reversed_positions |= ((positions >> bit) & 1) << (bits - 1 - bit)
+    return reversed_positions[reversed_positions < n_lines]
+
+
+def sampled_sequences(reads: Union[ReadStream, PairedReadStream], n_buckets: int = 20,
+                      order: str = "interleaved", seed: int = 0) -> Iterator:
+    """
+    yields only the sequences of sampled_reads.
+    """
+    for _, sequence in sampled_reads(reads, n_buckets=n_buckets, order=order, seed=seed):
+        yield sequence
+
+
+def _random_buckets(n_buckets: int, seed: int, block_size: int = 4096) -> Iterator[int]:
+    """ yields the same stream of random buckets for the same seed """
+    rng = np.random.default_rng(seed + 1)
+    while True:
+        yield from rng.integers(0, n_buckets, size=block_size).tolist()
@@ -14,10 +14,12 @@ from pathlib import Path
 import sys
 from typing import Dict, Union, List, Tuple, Optional
 import csv
+import json
 import os
 import argparse
+import itertools
+from scipy.stats import norm
 import numpy as np
-import pickle as pickle
 from matplotlib import pyplot
 # non-std packages
 import matplotlib.pyplot as plt
@@ -26,21 +28,30 @@ from numpy import where
 # in house packages
 current_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(f"{current_path}/../PathOrganizer_module")
+sys.path.append(f"{current_path}/../kraken_module")
+sys.path.append(f"{current_path}/../fasta_module")
 sys.path.append(f"{current_path}")
 from PathOrganizer import PathOrganizer, PathErrors, DuplicateGenomeError
+from GenomeStore import genome_store
+from FastaIndex import read_fasta
 from ClusteringModel import TrueGenomeFinder, GMM, KMeansClustering, get_true_positive, get_filtered_genomes
-from GenomeMapper import GenomeMapper, MinimapMapperWithInfo, MinimapMapper
+from GenomeMapper import GenomeMapper, MinimapMapperWithInfo, MinimapMapper, MinimapMultiMapperWithInfo
+from ReadStream import ReadStream, PairedReadStream, sampled_reads, MAX_SPILL_BYTES
+from KrakenReadTable import KrakenReadTable
+from MappingStats import MappingStats, save_minimap_out, load_minimap_out
+from CoverageAccumulator import CoverageAccumulator
+from EquivalenceClassEM import EquivalenceClassEM
 
 
 
 
-# Changing to directory of script.
-abspath = os.path.abspath(sys.argv[0])
-dname = os.path.dirname(abspath)
-os.chdir(dname)
-
 # GLOBALS.
 PATH = os.path.dirname(os.path.abspath(__file__))
+MAPPING_BATCH_SIZE = 20000 # number of reads handed to the mappers at once
+COVERAGE_WINDOW_SIZE = 1000 # bases per window for the windowed coverage
+CONVERGENCE_BATCH_SIZE = 5000 # reads mapped between convergence checks
+MIN_GENOMES_FOR_FILTER = 2 # genomes are filtered (and abundances refined) with more genomes than this
+READ_ORDER_BUCKETS = 20 # buckets the reads are sampled in (with a tolerance)
 
 # Create an argparse.Namespace object from input args.
 def parseArgs(argv=None) -> argparse.Namespace:
@@ -57,11 +68,20 @@ def parseArgs(argv=None) -> argparse.Namespace:
     group.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-i", "--input", help="the input lsv file with phage names", required=True)
     parser.add_argument("-o", "--output_prefix", help="the output file prefix", required=True)
-    parser.add_argument("-f", "--fasta", help="input fasta path", required=True)
+    parser.add_argument("-f", "--fasta", help="input fasta/fastq path (may be gzipped)", required=True)
+    parser.add_argument("-f2", "--fasta_2", help="input fasta/fastq path for mate 2 of paired end reads", required=False)
     parser.add_argument("-g", "--genome_directory", help="path to the directory of genomes", required=True)
     parser.add_argument("-c", "--use_gmm", help="uses Gaussian Mixture Model for clustering", action='store_false', required=False)
     parser.add_argument("-p", "--plot_results", help="plots extra results", action='store_false', required=False)
     parser.add_argument("-t", "--threads", help="number of threads", required=True)
+    parser.add_argument("-m", "--merged_index", help="map reads against one index holding all genomes", action='store_true', required=False)
+    parser.add_argument("-e", "--tolerance", help="stop mapping once every abundance is known within this (e.g. 0.005); reads are then sampled across the file, which is read once per group of buckets (see --spill_mb)", type=float, required=False)
+    parser.add_argument("-a", "--abundance_method", help="how reads hitting several genomes are counted [em, first_hit]", default="em", required=False)
+    parser.add_argument("-k", "--kraken_reads", help="read to taxid table from the kraken stage (.npz)", required=False)
+    parser.add_argument("-km", "--kraken_mode", help="use of reads kraken assigned to a genome [prioritize, skip]: prioritize maps them against their genome first, then the others if they don't map; skip counts them for their genome, mapping them against it only (for its mapping statistics)", default="prioritize", required=False)
+    parser.add_argument("-kc", "--kraken_min_confidence", help="min kraken confidence for a read to count as assigned", type=float, default=0.5, required=False)
+    parser.add_argument("-r", "--read_order", help="order reads are sampled in with --tolerance [interleaved, random]", default="interleaved", required=False)
+    parser.add_argument("-sm", "--spill_mb", help="max MB of sampled reads written next to the output per pass over the input, with --tolerance", type=int, default=MAX_SPILL_BYTES // 1024**2, required=False)
     return parser.parse_args(argv)
 
 class GenomeTestSet:
@@ -69,15 +89,35 @@ class GenomeTestSet:
     This class is used to test the a folder of simulated sequences
     """
     
-    def __init__(self, line_seperated_genomes, genome_directory):
+    def __init__(self, line_seperated_genomes, genome_directory, merged_index=False, threads=1,
+                 record_read_hits=False, keep_read_spans=False, abundance_method="first_hit",
+                 kraken_reads=None, kraken_mode="prioritize", kraken_min_confidence=0.5):
         """ initialize all params """
         # input attributes
         self.input_taxids = [tax_id.strip("\n") for tax_id in open(line_seperated_genomes).readlines()]
         self.object_PathOrganizer = PathOrganizer(genome_directory)
         # primary attributes
-        self.genomes = {} # this directory will hold all of the genomes
+        self.genome_lengths: Dict[str, int] = {} # this directory will hold the length of each genome
+        self.keep_read_spans = keep_read_spans # if False, only the coverage of the reads is kept
         self.mappingAdapter = MinimapMapperWithInfo # pointer, instantiated per genome.
         self.genomeMap: Dict[str, GenomeMapper] = {} # this dictionary hold minmap indexes
+        self.merged_index = merged_index # if True, one index holds all genomes
+        self.mergedMapper: Optional[MinimapMultiMapperWithInfo] = None
+        self.threads = int(threads) # number of mapping threads
+        if abundance_method not in ("first_hit", "em"):
+            raise ValueError(f"unknown abundance method: {abundance_method}")
+        self.abundance_method = abundance_method # 'first_hit' (LSV order) or 'em' (shared by EM)
+        self.record_read_hits = record_read_hits or abundance_method == "em" # if True, keep every genome each read hits
+        self.readHitClasses: Dict[Tuple[str, ...], int] = {} # genomes hit (in mapping order) -> read count
+        if kraken_mode not in ("prioritize", "skip"):
+            raise ValueError(f"unknown kraken mode: {kraken_mode}")
+        self.krakenReads: Optional[KrakenReadTable] = KrakenReadTable(kraken_reads) if kraken_reads else None
+        self.kraken_mode = kraken_mode # 'prioritize' (kraken genome mapped first) or 'skip' (only mapped to the kraken genome)
+        self.kraken_min_confidence = kraken_min_confidence
+        self.kraken_assigned_reads = 0 # reads kraken assigned to one of the genomes
+        self.total_reads = 0 # reads used for the abundances
+        self.mapped_reads = 0 # reads assigned to a genome (not 'UNK')
+        self.confidenceIntervals: Dict[str, Tuple[float, float]] = {} # set when stopping early
         self.simAbundance = {} # this dictionary hold simulated abundance amounts
         # add genomes
         self.__addGenomes()
@@ -88,74 +128,333 @@ class GenomeTestSet:
     def __addGenomes(self):
         """ add genomes to to genomes attr """
         print("Creating indexes for minimap2")
-        for genome_taxid in self.input_taxids:
+        genome_paths: Dict[str, str] = {}
+        for genome_taxid, file_path in self.object_PathOrganizer.genomes(self.input_taxids).items():
             print(f"genome NCBI tax id: {genome_taxid}")
-            file_path: Path = self.object_PathOrganizer.genome(genome_taxid)
             if file_path != None: # TODO: IF THIS IS NONE THEN THERE'S A PROBLEM FINDING GENOMES!!
-                self.genomes[genome_taxid] = self.parseFasta(file_path)[1][0]
-                self.genomeMap[genome_taxid] = self.mappingAdapter(name=genome_taxid,
-                                                                     file_path=str(file_path))
+                genome_paths[genome_taxid] = str(file_path)
+                if not self.merged_index:
+                    self.genomeMap[genome_taxid] = self.mappingAdapter(name=genome_taxid,
+                                                                         file_path=str(file_path),
+                                                                         keep_spans=self.keep_read_spans)
             else:
                 print(f"FIX THIS: there's a problem finding the genome for {genome_taxid}")
+        if self.merged_index and genome_paths:
+            # every genome hit is kept when all of them are recorded, or for the kraken genome in skip mode
+            every_hit = self.record_read_hits or (self.krakenReads is not None and self.kraken_mode == "skip")
+            self.mergedMapper = MinimapMultiMapperWithInfo(name="merged_index",
+                                                           genome_paths=genome_paths,
+                                                           best_n=len(genome_paths) if every_hit else 1,
+                                                           keep_spans=self.keep_read_spans)
+        for minimap_mapper in self.mappers():
+            self.genome_lengths.update(minimap_mapper.genome_lengths)
 
     @staticmethod
     def parseFasta(fasta_path):
         """
-        DESCRIPTION - parses a fasta or multifasta file.
+        DESCRIPTION - parses a fasta or multifasta file (read from the packed
+                      genome store of its directory, if it has it).
         INPUT - 1. fasta path
         OUTPUT - 1. name (ordered list); 2. genome sequence (ordered list)
         """
         seq_names, sequences = [], []
         print(f"fasta file: {fasta_path}")
-        with open(fasta_path) as fasta_file:
-            fasta_input = fasta_file.readlines()
-            sequence_i = ""
-            for counter, line in enumerate(fasta_input):
-                if (line[0] == ">"):
-                    seq_name = line[1:]
-                    seq_names.append(seq_name.strip("\n"))
-                    if (counter != 0):
-                        sequences.append(sequence_i.strip("\n"))
-                        sequence_i = "" # renew sequence
-                else:
-                    sequence_i += line.strip("\n")
-            sequences.append(sequence_i.strip("\n"))
+        store = genome_store(Path(fasta_path).parent)
+        if store.has(fasta_path):
+            records = store.records(fasta_path)
+            return [record.name for record in records], [store.sequence(record) for record in records]
+        for record in read_fasta(fasta_path):
+            seq_names.append(record.header)
+            sequences.append(record.sequence)
         return seq_names, sequences     
 
-    def checkSeqFile(self, input_fasta):
+    def checkSeqFile(self, input_fasta, input_fasta_2=None, tolerance=None, confidence=0.95,
+                     read_order="interleaved", seed=0, spill_directory=None, max_spill_bytes=MAX_SPILL_BYTES):
         """
-        iterate through fasta and generate results
+        iterate through fasta and generate results. If a second (mate 2)
+        file is given, each read pair is mapped jointly and counted once.
+
+        If a tolerance is given, reads are sampled across the file (see
+        sampled_reads) and mapping stops once the confidence interval
+        of every abundance is within +/- tolerance. The abundances are then
+        relative to the reads used (self.total_reads).
         INPUT
-            fasta file path
+            1. fasta/fastq file path (may be gzipped)
+            2. fasta/fastq file path for mate 2 (optional)
+            3. tolerance on each abundance (optional, maps all reads if None)
+            4. confidence level of the intervals
+            5. read order with a tolerance ("interleaved" or "random")
+            6. random seed for the "random" read order
+            7. directory of the sampled reads spilled to disk with a tolerance
+            8. max bytes of reads spilled per pass over the file
         OUTPUT
             {Blessia : 0.3, D29: 0.4, ... Persues: 0.3 }
         """
-        # init
-        seq_names, seqs = self.parseFasta(input_fasta)
-        total_reads = len(seqs)
-        genome_count: Dict[str,int] = self.count_reads_mapping_per_genome(seqs)
+        # init (reads are streamed straight into the mappers)
+        if input_fasta_2:
+            reads = PairedReadStream(input_fasta, input_fasta_2)
+        else:
+            reads = ReadStream(input_fasta)
+        if tolerance is None:
+            genome_count: Dict[str,int] = self.count_reads_mapping_per_genome(reads)
+            total_reads = reads.total_reads
+        else:
+            sampled = sampled_reads(reads, n_buckets=READ_ORDER_BUCKETS, order=read_order, seed=seed,
+                                    spill_directory=spill_directory, max_spill_bytes=max_spill_bytes)
+            genome_count, total_reads = self.count_reads_until_converged(sampled, tolerance, confidence)
+        self.total_reads = total_reads
+        print(f"total reads: {total_reads}")
+        if self.abundance_method == "em": # share reads hitting several genomes
+            genome_count = EquivalenceClassEM().fit(self.readHitClasses)
+        self.mapped_reads = int(round(total_reads - genome_count.get("UNK", 0)))
         # normalize the results
         for genome in genome_count.keys():
             genome_count[genome] = genome_count[genome] / total_reads
         self.resultDict = genome_count
         # return dictionary
-        for minimap_obj in self.genomeMap.values():
+        for minimap_obj in self.mappers():
             for gen, minimap_output in minimap_obj.minimap_out.items():
                 self.minimap_out[gen] = minimap_output
         return genome_count
 
-    def count_reads_mapping_per_genome(self, seqs) -> Dict[str,int]:
+    def mappers(self) -> List[GenomeMapper]:
+        """ returns the mapping objects holding the minimap2 indexes """
+        if self.mergedMapper is not None:
+            return [self.mergedMapper]
+        return list(self.genomeMap.values())
+
+    def count_reads_mapping_per_genome(self, reads) -> Dict[str,int]:
         """
         Method returns a dictionary counter for the 
         number of reads mapping per genome. 
+
+        Reads ((name, sequence) tuples) are mapped in batches,
+        using self.threads worker threads per batch.
         """
         genome_count: Dict[str,int] = {}
-        for sequence in seqs:
-            genome = self.__findSeq(sequence)
-            if genome in genome_count.keys():
-                genome_count[genome] += 1
-            else:
-                genome_count[genome] = 1
+        reads = iter(reads)
+        while True:
+            batch = list(itertools.islice(reads, MAPPING_BATCH_SIZE))
+            if not batch:
+                break
+            for genome in self.__findReadBatch(batch):
+                if genome in genome_count.keys():
+                    genome_count[genome] += 1
+                else:
+                    genome_count[genome] = 1
+        return genome_count
+
+    def __findReadBatch(self, batch) -> List[str]:
+        """
+        finds the genome of each (name, sequence) read, using the kraken
+        read table (if given) to skip or prioritize reads kraken assigned.
+        """
+        read_names = [name for name, _ in batch]
+        input_seqs = [sequence for _, sequence in batch]
+        if self.krakenReads is None:
+            return self.findSeqBatch(input_seqs)
+        kraken_genomes = self.krakenReads.assigned_taxids(read_names, self.genome_lengths.keys(),
+                                                          min_confidence=self.kraken_min_confidence)
+        self.kraken_assigned_reads += sum(genome is not None for genome in kraken_genomes)
+        if self.kraken_mode == "prioritize":
+            return self.findSeqBatch(input_seqs, priority_genomes=kraken_genomes)
+        # skip: reads kraken assigned count for their genome without searching the others
+        to_map = [i for i, genome in enumerate(kraken_genomes) if genome is None]
+        read_genomes: List[str] = list(kraken_genomes)
+        for read_index, genome in zip(to_map, self.findSeqBatch([input_seqs[i] for i in to_map])):
+            read_genomes[read_index] = genome
+        assigned = [i for i, genome in enumerate(kraken_genomes) if genome is not None]
+        self.__mapKrakenReads([input_seqs[i] for i in assigned], [kraken_genomes[i] for i in assigned])
+        if self.record_read_hits:
+            for genome in kraken_genomes:
+                if genome is not None:
+                    self.readHitClasses[(genome,)] = self.readHitClasses.get((genome,), 0) + 1
+        return read_genomes
+
+    def __mapKrakenReads(self, input_seqs, kraken_genomes):
+        """
+        maps the reads kraken assigned against their genome only (skip
+        mode), so the mapping statistics of the genome include them. With
+        a merged index, only the hits on their genome are recorded.
+        """
+        if not input_seqs:
+            return
+        if self.mergedMapper is not None:
+            self.mergedMapper.map_batch(input_seqs, threads=self.threads, genomes=kraken_genomes)
+        else:
+            self.__mapPriorityReads(input_seqs, kraken_genomes)
+
+    def count_reads_until_converged(self, reads, tolerance, confidence=0.95) -> Tuple[Dict[str,int], int]:
+        """
+        Same as count_reads_mapping_per_genome, but stops once the
+        abundance of every genome (and 'UNK') has a confidence interval
+        within +/- tolerance. The intervals are kept in self.confidenceIntervals.
+        They are computed on the abundances that are reported: the EM
+        read counts with the 'em' method (treated as binomial counts, so
+        the extra uncertainty of reads shared by genomes is not included),
+        else the first hit counts.
+        INPUT
+            1. (name, sequence) reads, in the order they should be sampled
+            2. tolerance on each abundance
+            3. confidence level of the intervals
+        OUTPUT
+            1. dictionary counter of reads per genome
+            2. number of reads used
+        """
+        genome_count: Dict[str,int] = {}
+        reads_used = 0
+        converged = False
+        reads = iter(reads)
+        while not converged:
+            batch = list(itertools.islice(reads, CONVERGENCE_BATCH_SIZE))
+            if not batch:
+                break
+            for genome in self.__findReadBatch(batch):
+                genome_count[genome] = genome_count.get(genome, 0) + 1
+            reads_used += len(batch)
+            reported_count = genome_count
+            if self.abundance_method == "em":
+                reported_count = EquivalenceClassEM().fit(self.readHitClasses)
+            genome_names = set(self.genome_lengths.keys()) | set(reported_count.keys()) | {"UNK"}
+            self.confidenceIntervals = {genome: self.wilson_interval(reported_count.get(genome, 0), reads_used, confidence)
+                                        for genome in genome_names}
+            converged = all((upper - lower) / 2 <= tolerance for lower, upper in self.confidenceIntervals.values())
+        print(f"used {reads_used} reads ({'converged' if converged else 'did not converge'} within +/- {tolerance})")
+        return genome_count, reads_used
+
+    @staticmethod
+    def wilson_interval(count, total, confidence=0.95) -> Tuple[float, float]:
+        """
+        Wilson score interval for a proportion (count / total), which stays
+        sensible for proportions near 0 or 1.
+        INPUT
+            1. number of reads for the genome
+            2. number of reads used
+            3. confidence level
+        OUTPUT
+            (lower, upper) bounds of the abundance
+        """
+        if total == 0:
+            return 0.0, 1.0
+        z = norm.ppf(0.5 + confidence / 2)
+        proportion = count / total
+        denominator = 1 + z**2 / total
+        center = (proportion + z**2 / (2 * total)) / denominator
+        half_width = z * np.sqrt(proportion * (1 - proportion) / total + z**2 / (4 * total**2)) / denominator
+        return max(0.0, center - half_width), min(1.0, center + half_width)
+
+    def findSeqBatch(self, input_seqs, priority_genomes=None) -> List[str]:
+        """
+        batched version of __findSeq.
+        INPUT
+            1. list of input reads
+            2. genome to try first for each read, or None (optional)
+        OUTPUT
+            list with the genome of each read ('UNK' if no genome matches).
+            the priority genome wins if the read maps to it, else the
+            first genome (in LSV order) with a match wins.
+
+        if self.record_read_hits, every read is mapped against every
+        genome and the genomes it hits are counted in self.readHitClasses.
+        """
+        if priority_genomes is None:
+            priority_genomes = [None] * len(input_seqs)
+        if self.record_read_hits:
+            return self.__findSeqBatchRecorded(input_seqs, priority_genomes)
+        read_hits = self.__mapPriorityReads(input_seqs, priority_genomes)
+        unassigned = [i for i, genome_names in enumerate(read_hits) if not genome_names]
+        for genome_name, minimap_mapper in self.__namedMappers():
+            to_map = [i for i in unassigned if genome_name is None or priority_genomes[i] != genome_name]
+            if not to_map:
+                continue
+            batch_genomes = minimap_mapper.map_batch([input_seqs[i] for i in to_map],
+                                                     threads=self.threads)
+            for read_index, genome_names in zip(to_map, batch_genomes):
+                read_hits[read_index] = genome_names
+            unassigned = [i for i in unassigned if not read_hits[i]]
+        return [self.__pickGenome(genome_names, priority_genome)
+                for genome_names, priority_genome in zip(read_hits, priority_genomes)]
+
+    def __findSeqBatchRecorded(self, input_seqs, priority_genomes) -> List[str]:
+        """
+        maps each read against all genomes, keeping the genomes
+        hit per read (first hit wins for the abundances).
+        """
+        read_hits = self.__mapPriorityReads(input_seqs, priority_genomes)
+        for genome_name, minimap_mapper in self.__namedMappers():
+            to_map = [i for i, priority_genome in enumerate(priority_genomes)
+                      if genome_name is None or priority_genome != genome_name]
+            assigned = [bool(read_hits[i]) for i in to_map]
+            batch_genomes = minimap_mapper.map_batch([input_seqs[i] for i in to_map], threads=self.threads,
+                                                     assigned=assigned)
+            for read_index, new_genome_names in zip(to_map, batch_genomes):
+                read_hits[read_index].extend(new_genome_names)
+        read_genomes = []
+        for genome_names, priority_genome in zip(read_hits, priority_genomes):
+            genome = self.__pickGenome(genome_names, priority_genome)
+            if genome in genome_names: # the genome picked leads the hit class
+                genome_names = [genome] + [name for name in genome_names if name != genome]
+            hit_class = tuple(genome_names)
+            self.readHitClasses[hit_class] = self.readHitClasses.get(hit_class, 0) + 1
+            read_genomes.append(genome)
+        return read_genomes
+
+    def __namedMappers(self) -> List[Tuple[Optional[str], GenomeMapper]]:
+        """ (genome name, mapper) in LSV order; the merged index has no single genome """
+        if self.mergedMapper is not None:
+            return [(None, self.mergedMapper)]
+        return list(self.genomeMap.items())
+
+    def __mapPriorityReads(self, input_seqs, priority_genomes) -> List[List[str]]:
+        """
+        maps reads with a priority genome against that genome only (one
+        batch per genome). Returns the genomes hit by each read so far.
+        """
+        read_hits: List[List[str]] = [[] for _ in input_seqs]
+        if self.mergedMapper is not None: # one index, the priority is applied when picking
+            return read_hits
+        reads_per_genome: Dict[str, List[int]] = {}
+        for read_index, priority_genome in enumerate(priority_genomes):
+            if priority_genome in self.genomeMap:
+                reads_per_genome.setdefault(priority_genome, []).append(read_index)
+        for genome_name, read_indexes in reads_per_genome.items():
+            batch_genomes = self.genomeMap[genome_name].map_batch([input_seqs[i] for i in read_indexes],
+                                                                   threads=self.threads)
+            for read_index, genome_names in zip(read_indexes, batch_genomes):
+                read_hits[read_index].extend(genome_names)
+        return read_hits
+
+    @staticmethod
+    def __pickGenome(genome_names, priority_genome) -> str:
+        """ the priority genome if it was hit, else the first genome hit (or 'UNK') """
+        if priority_genome is not None and priority_genome in genome_names:
+            return priority_genome
+        return genome_names[0] if genome_names else "UNK"
+
+    def refinedAbundances(self, genome_subset) -> Dict[str, float]:
+        """
+        recalculates the abundances for a subset of the genomes,
+        using the genomes hit by each read in checkSeqFile (requires
+        record_read_hits). With the 'first_hit' method, this gives the same
+        result as mapping the reads again against only the subset; with 'em',
+        the reads are shared between the genomes of the subset they hit.
+        INPUT
+            list of genome names (taxids) to keep
+        OUTPUT
+            {Blessia : 0.3, D29: 0.4, ... Persues: 0.3 }
+        """
+        if not self.record_read_hits:
+            raise ValueError("refinedAbundances requires GenomeTestSet(record_read_hits=True)")
+        genome_subset = set(genome_subset)
+        if self.abundance_method == "em":
+            genome_count = EquivalenceClassEM().fit(self.readHitClasses, genome_subset)
+            return {genome: count / self.total_reads for genome, count in genome_count.items()}
+        genome_count: Dict[str, int] = {}
+        for hit_class, read_count in self.readHitClasses.items():
+            genome = next((name for name in hit_class if name in genome_subset), "UNK")
+            genome_count[genome] = genome_count.get(genome, 0) + read_count
+        for genome in genome_count.keys():
+            genome_count[genome] = genome_count[genome] / self.total_reads
         return genome_count
 
     def __findSeq(self, input_seq):
@@ -169,8 +468,12 @@ class GenomeTestSet:
                3. exactly one, output the name of the corresponding genome.
         """
         genome_from = ""
+        # single index, the best hit decides the genome
+        if self.mergedMapper is not None:
+            genome_names = self.mergedMapper.map_batch([input_seq])[0]
+            return genome_names[0] if genome_names else "UNK"
         # find genome that read is in
-        for genome_name in self.genomes.keys():
+        for genome_name in self.genomeMap.keys():
             minimap_mapper: MinimapMapper = self.genomeMap[genome_name]
             read_maps_to_genome: bool = minimap_mapper.does_read_map(input_seq)
             if read_maps_to_genome:
@@ -185,53 +488,23 @@ class GenomeTestSet:
     def overlapMerge(self, genome_name):
         """ extend reads to assess % genome covered
 
-        Algorithm:
-            Example:
-                1. input
-                (50,150), (0,100), (200,300), (149,249)
-                2. sort by starting reference index
-                (0,100), (50,150), (149,249), (200,300)
-                3. merge
-                    iteration one:
-                        p1 = (0,100)
-                        p2 = (50, 150)
-                        if p1[1] >= p2[0]:
-                            merge
-                            p1 = merged
-                            p2 = move forward
-                        else:
-                            p1 = p2
-                            p2 = move forward
+        The coverage of the reads is accumulated while the reads
+        are mapped (see CoverageAccumulator), so the regions covered
+        are read straight from the coverage (no sorting of the reads).
+
+        Example:
+            reads: (50,150), (0,100), (200,300), (149,249)
+            merged: (0,150), (149,300) -> (0,300)
 
         INPUT:
-            self.minimap_out[genomeName]["readmaps"] (set object)
+            self.minimap_out[genomeName].coverage
         OUTPUT:
             return
                 1. merged set
-                2. % of genome with reads mapped
-        """
-        mergedSet = set()
-        #1. input
-        mapped_reads = self.minimap_out[genome_name]["readmaps"] #[(50,120),(110,220),(150,200)]
-        print(f"before merge overlap: {len(mapped_reads)}")
-        #2. sort the reads by starting index
-        sorted_mapped_reads = sorted(mapped_reads, key=lambda x: x[0])
-        #3. merge overlapping regions
-        p1 = 0 # pointer 1
-        p2 = 1 # pointer 2
-        p1_start, p1_end = sorted_mapped_reads[p1]
-        while p2 < len(sorted_mapped_reads):
-            p2_start, p2_end = sorted_mapped_reads[p2]
-            if p1_end >= p2_start:  # if overlap,  then merge
-                if p1_end <= p2_end:
-                    p1_end = p2_end
-            else:                   # if no overlap, set p1=p2 and p2++
-                mergedSet.add((p1_start, p1_end))
-                p1_start, p1_end = sorted_mapped_reads[p2] #notice: using p2
-            p2 += 1
-        # add last interval to to the merged set
-        mergedSet.add((p1_start, p1_end))
-
+        """
+        coverage: CoverageAccumulator = self.minimap_out[genome_name].coverage
+        print(f"before merge overlap: {coverage.readcount}")
+        mergedSet = coverage.covered_intervals()
         print(f"after merge overlap: {len(mergedSet)}")
         return mergedSet
 
@@ -247,7 +520,7 @@ class GenomeTestSet:
         """
         # initialize
         overall_map_length = 0
-        genome_length = len(self.genomes[genome_name])
+        genome_length = self.genome_lengths[genome_name]
         # calculate # of bases with mapped reads
         for interval in merged_set:
             interval_size = abs(interval[0] - interval[1])
@@ -262,7 +535,8 @@ class GenomeTestSet:
         """
         Plot bar plot of the results from the simulation
         """
-        if len(self.resultDict.keys()) == 0:
+        result = self.resultDict if result is None else result
+        if len(result.keys()) == 0:
             print("must create a result by running checkSeqFile")
             exit(1)
         # plot color
@@ -274,33 +548,61 @@ class GenomeTestSet:
         fig.suptitle(plotTitle, size=TITLESIZE)
         fig.set_size_inches(20,10)
         # create bottom plot
-        ax2.bar(self.resultDict.keys(),
-                list(self.resultDict.values()),
+        ax2.bar(result.keys(),
+                list(result.values()),
                 color=PLOTCOLOR,
                 edgecolor='black')
         ax2.set_ylabel('Estimated Abundances using Minimap2',size=AXISSIZE)
-        ax2.set_xticklabels(self.resultDict.keys(), fontsize=15)
+        ax2.set_xticklabels(result.keys(), fontsize=15)
         # save the plot
         plt.savefig(out, dpi=300)
 
-    def saveResultAsCSV(self, csvout="testing.csv"):
+    def saveResultAsCSV(self, csvout="testing.csv", result=None):
         """
         returns a csv that can be used in regression testing.
         """
+        result = self.resultDict if result is None else result
         with open(csvout, 'w') as csvfile:
                 writer = csv.writer(csvfile)
                 #writer.writeheader()
-                for genome_name, abundance in self.resultDict.items():
+                for genome_name, abundance in result.items():
                     writer.writerow([genome_name, abundance])
 
+    def saveCounts(self, jsonout):
+        """ saves the read and genome counts of the run (used in the run report) """
+        counts = {"total_reads": self.total_reads,
+                  "mapped_reads": self.mapped_reads,
+                  "kraken_assigned_reads": self.kraken_assigned_reads,
+                  "genomes": len(self.genome_lengths)}
+        with open(jsonout, "w") as json_file:
+            json.dump(counts, json_file, indent=1)
+
+    def saveAliases(self, csvout):
+        """
+        saves the genomes removed from the database as identical in sequence
+        to a found genome (genome, alias taxid, alias accession), so the
+        abundances can be expanded to every taxid of a sequence.
+        """
+        with open(csvout, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            for genome_name in self.resultDict:
+                if genome_name not in self.genome_lengths: # ('UNK')
+                    continue
+                for alias in self.object_PathOrganizer.aliases(genome_name):
+                    writer.writerow([genome_name, alias.taxid, alias.accession])
+
     def save_features(self):
         """ this method saves the features of each genome"""
         for genomeName in self.minimap_out:
             overlapMerge = self.overlapMerge(genomeName)
             percentOverlap = self.calcGenomePercetage(genomeName, overlapMerge)
             print(f"percent overlap: {percentOverlap}")
+            coverage: CoverageAccumulator = self.minimap_out[genomeName].coverage
             self.minimap_out[genomeName]["overlapMerge"] = overlapMerge
             self.minimap_out[genomeName]["percentOverlap"] = percentOverlap       
+            self.minimap_out[genomeName]["meanDepth"] = coverage.mean_depth()
+            self.minimap_out[genomeName]["depthEvenness"] = coverage.evenness()
+            self.minimap_out[genomeName]["windowedCoverage"] = coverage.windowed_coverage(COVERAGE_WINDOW_SIZE)
 
     def print_minimap2output(self, out_prefix):
         """ prints output in minimap_out datastructure """
@@ -316,14 +618,14 @@ class GenomeTestSet:
             plt.clf()
             self.save_features()
 
-def print_values_for_mappedinfo(dataset: Dict[str,Dict[str, Union[set, int, float]]]) -> Tuple[List[float]]:
+def print_values_for_mappedinfo(dataset: Dict[str, MappingStats]) -> Tuple[List[float]]:
     """ 
-    takes in the pickle output from the MergeOverlap and prints metrics 
+    takes in the minimap_out from the MergeOverlap and prints metrics 
     
-    :input (Dict[str,Dict[str, Union[set, int, float]]]):
-        The input is a nested dicitonary containing information from the
+    :input (Dict[str, MappingStats]):
+        The input is a dicitonary containing information from the
         primary data structure generated during MergeOverlap. This is
-        put into a pickle file and used for data analysis here.
+        put into a .npz file (see load_minimap_out) and used for data analysis here.
         
     :output (tuple[List[float]):
         1. np.array(y_vector) - a vector containing the names for the phages
@@ -337,10 +639,11 @@ def print_values_for_mappedinfo(dataset: Dict[str,Dict[str, Union[set, int, floa
         x_vector.append([])
         for metric in dataset[genome].keys(): 
             if metric in ['mapq', 'readmaps', 'readcount']:
-                print(f" {metric}: {np.average(dataset[genome][metric])}")
+                if np.size(dataset[genome][metric]) > 0: # readmaps are empty if spans aren't kept
+                    print(f" {metric}: {np.average(dataset[genome][metric])}")
                 if (metric == 'mapq'):
                     x_vector[index].append(np.average(dataset[genome][metric]))
-            elif metric == "overlapMerge":
+            elif metric in ["overlapMerge", "windowedCoverage"]:
                 print(f" {metric}: {len(dataset[genome][metric]) }")
             elif metric == "percentOverlap":
                 print(f" {metric}: {dataset[genome][metric]}")
@@ -390,12 +693,37 @@ def scatter_of_filtered(clusters, x_vector, y_vector, outfile):
 def main():
     print("RUNNING THE MERGE OVERLAP FILTER")
     arguments = parseArgs(argv=sys.argv[1:])
+    # Changing to directory of script.
+    os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+    run_merge_overlap(arguments)
 
+def run_merge_overlap(arguments: argparse.Namespace) -> "GenomeTestSet":
+    """ maps the reads to the candidate genomes and writes the abundances and filtered genomes to output_prefix* """
     # Running the algorithm.
     GENOME_DIR = arguments.genome_directory
-    genomeTestObj = GenomeTestSet(line_seperated_genomes=arguments.input, genome_directory=GENOME_DIR)
-    genomeTestObj.checkSeqFile(arguments.fasta)
+    if arguments.kraken_reads and not os.path.isfile(arguments.kraken_reads):
+        print(f"kraken read table {arguments.kraken_reads} not found, mapping all reads")
+        arguments.kraken_reads = None
+    # every genome a read hits is only needed by EM, and by the refined abundances (more than 2 genomes),
+    # else each read stops at its first hit
+    with open(arguments.input) as input_genomes:
+        refine_abundances = sum(1 for line in input_genomes if line.strip()) > MIN_GENOMES_FOR_FILTER
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=arguments.input, genome_directory=GENOME_DIR,
+                                  merged_index=arguments.merged_index,
+                                  threads=arguments.threads,
+                                  record_read_hits=refine_abundances,
+                                  abundance_method=arguments.abundance_method,
+                                  kraken_reads=arguments.kraken_reads,
+                                  kraken_mode=arguments.kraken_mode,
+                                  kraken_min_confidence=arguments.kraken_min_confidence)
+    genomeTestObj.checkSeqFile(arguments.fasta, arguments.fasta_2,
+                               tolerance=arguments.tolerance,
+                               read_order=arguments.read_order,
+                               spill_directory=os.path.dirname(os.path.abspath(arguments.output_prefix)),
+                               max_spill_bytes=arguments.spill_mb * 1024**2)
     genomeTestObj.saveResultAsCSV(arguments.output_prefix+".csv")
+    genomeTestObj.saveCounts(arguments.output_prefix+"_counts.json")
+    genomeTestObj.saveAliases(arguments.output_prefix+"_aliases.csv")
     
     if (arguments.plot_results):
         genomeTestObj.plotResult("Estimated Abundances Using Raw Read Mapping", out=arguments.output_prefix+".png")
@@ -403,10 +731,9 @@ def main():
     else:
         genomeTestObj.save_features()
 
-    # save the pickle output.
+    # save the mapping statistics (load with load_minimap_out).
     predicted_abundances = genomeTestObj.minimap_out
-    with open(f'{arguments.output_prefix}_minimap_out.pickle', 'wb') as handle:
-        pickle.dump(predicted_abundances, handle)
+    save_minimap_out(predicted_abundances, f'{arguments.output_prefix}_minimap_out.npz')
 
     # save to original genomes to LSV (note: reduntant with kraken lsv)
     with open(arguments.output_prefix+"_genomes.lsv", "w") as genomes_csv:
@@ -414,7 +741,7 @@ def main():
             genomes_csv.write(genome_name + "\n")
 
     # if more than one genome, use GMM to see if really in sample
-    if len(predicted_abundances.keys()) > 2:
+    if len(predicted_abundances.keys()) > MIN_GENOMES_FOR_FILTER:
         # use unsupervised model to obtain true genomes in sample
         y_vector, x_vector = print_values_for_mappedinfo(genomeTestObj.minimap_out)
         if arguments.use_gmm:
@@ -441,15 +768,16 @@ def main():
                 print(filtered_genomes.readlines())
 
 
-        genomeTestObj2 = GenomeTestSet(line_seperated_genomes=Path(arguments.output_prefix+"_filtered_genomes.lsv"),
-                                    genome_directory=GENOME_DIR)
-        genomeTestObj2.checkSeqFile(arguments.fasta)
-        genomeTestObj2.saveResultAsCSV(arguments.output_prefix+"_refined.csv")
+        # (reuses the genomes hit by each read, instead of mapping the reads again)
+        refined_abundances = genomeTestObj.refinedAbundances(true_genomes)
+        genomeTestObj.saveResultAsCSV(arguments.output_prefix+"_refined.csv", result=refined_abundances)
         if (arguments.plot_results):
             plot_scatter_plot(x_vector, y_vector, f"{arguments.output_prefix}_scatterplot.png")
             scatter_of_filtered(clusters, x_vector, y_vector, f"{arguments.output_prefix}_clusters_scatterplot.png")
-            genomeTestObj2.plotResult("Estimated Abundances Using Raw Read Mapping", 
-                                      out=arguments.output_prefix+"_refined.png")
+            genomeTestObj.plotResult("Estimated Abundances Using Raw Read Mapping", 
+                                     out=arguments.output_prefix+"_refined.png",
+                                     result=refined_abundances)
+    return genomeTestObj
 
 if __name__ == "__main__":
     main()
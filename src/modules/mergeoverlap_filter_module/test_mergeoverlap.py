@@ -5,12 +5,24 @@ DESCRIPTION:
 # std packages
 from enum import Enum
 import pickle
+import gzip
+import json
 import os
+import csv
+import shutil
+import itertools
 # non-std packages
 import pytest
+import numpy as np
 from pathlib import Path
 # in house packages
-from src.modules.mergeoverlap_filter_module.mergeoverlap import GenomeTestSet
+from src.modules.mergeoverlap_filter_module.mergeoverlap import GenomeTestSet, parseArgs, run_merge_overlap
+from src.modules.mergeoverlap_filter_module.ReadStream import ReadStream, PairedReadStream, sampled_sequences, sampled_reads
+from src.modules.mergeoverlap_filter_module.MappingStats import save_minimap_out, load_minimap_out
+from src.modules.mergeoverlap_filter_module.CoverageAccumulator import CoverageAccumulator
+from src.modules.mergeoverlap_filter_module.EquivalenceClassEM import EquivalenceClassEM
+from src.modules.kraken_module.KrakenReadTable import KrakenReadTableWriter
+from src.modules.PathOrganizer_module.PathOrganizer import GenomeAlias, save_aliases
  
 
 
@@ -24,6 +36,15 @@ class singleGenomeTest(Enum):
     output_prefix = f"{directory_path}/testing_output/single_genome"
     truth = [("1076136", 1.0)]
 
+class pairedGenomeTest(Enum):
+    directory_path = os.path.dirname(os.path.realpath(__file__))
+    input = f"{directory_path}/single_test_files/taxid_file.lsv"
+    fasta = f"{directory_path}/../../../examples/paired_end_reads/paired_illumina_1.fa"
+    fasta_2 = f"{directory_path}/../../../examples/paired_end_reads/paired_illumina_2.fa"
+    genome_directory = f"{directory_path}/test_genome_dir"
+    output_prefix = f"{directory_path}/testing_output/paired_genome"
+    truth = [("1076136", 1.0)]
+
 class multiGenomeTest(Enum):
     #directory_path = "./mergeoverlap_filter_module/"
     directory_path = os.path.dirname(os.path.realpath(__file__))
@@ -57,6 +78,55 @@ def test_singlegenome():
     for taxid, abundance in singleGenomeTest.truth.value:
         assert abs(results[taxid] - abundance) < 0.10
     
+def test_shared_genome_indexes(tmp_path):
+    """
+    Tests that the genome indexes are built once per process (as for
+    the samples of a batch), and that the read counts are saved.
+    """
+    first = GenomeTestSet(line_seperated_genomes=singleGenomeTest.input.value,
+                          genome_directory=singleGenomeTest.genome_directory.value)
+    second = GenomeTestSet(line_seperated_genomes=singleGenomeTest.input.value,
+                           genome_directory=singleGenomeTest.genome_directory.value)
+    for genome_name, mapper in first.genomeMap.items():
+        assert second.genomeMap[genome_name].index_object is mapper.index_object
+        assert second.genomeMap[genome_name] is not mapper
+    first.checkSeqFile(singleGenomeTest.fasta.value)
+    first.saveCounts(tmp_path / "counts.json")
+    counts = json.loads((tmp_path / "counts.json").read_text())
+    assert counts["total_reads"] == first.total_reads > 0
+    assert 0 < counts["mapped_reads"] <= counts["total_reads"]
+    assert counts["genomes"] == len(first.genomeMap)
+
+def test_saved_aliases(tmp_path):
+    """
+    Tests that genomes removed as identical to a found genome are saved.
+    """
+    genome_directory = tmp_path / "genomes"
+    shutil.copytree(singleGenomeTest.genome_directory.value, genome_directory)
+    save_aliases(genome_directory, [GenomeAlias(99, "NC_99.1", "perseus_copy.fa", 1076136, "perseus_genome.fa", "0f"),
+                                    GenomeAlias(98, "NC_98.1", "other_copy.fa", 1, "other.fa", "1f")])
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=singleGenomeTest.input.value,
+                                  genome_directory=str(genome_directory))
+    genomeTestObj.checkSeqFile(singleGenomeTest.fasta.value)
+    genomeTestObj.saveAliases(tmp_path / "aliases.csv")
+    with open(tmp_path / "aliases.csv") as aliases_file:
+        assert list(csv.reader(aliases_file)) == [["1076136", "99", "NC_99.1"]]
+
+@pytest.mark.parametrize("taxids, abundance_method, records_hits", [(["1076136"], "first_hit", False),
+                                                                     (["1076136"], "em", True),
+                                                                     (["1076136", "1527524", "1493514"], "first_hit", True)])
+def test_run_records_read_hits_when_needed(tmp_path, taxids, abundance_method, records_hits):
+    """
+    Tests that reads are mapped against every genome only for EM or the refined abundances.
+    """
+    (tmp_path / "taxids.lsv").write_text("\n".join(taxids) + "\n")
+    arguments = parseArgs(["--input", str(tmp_path / "taxids.lsv"), "--genome_directory", singleGenomeTest.genome_directory.value,
+                           "--fasta", singleGenomeTest.fasta.value, "--output_prefix", str(tmp_path / "out"),
+                           "--abundance_method", abundance_method, "--threads", "1"])
+    genomeTestObj = run_merge_overlap(arguments)
+    assert genomeTestObj.record_read_hits == records_hits
+    assert (tmp_path / "out.csv").is_file()
+
 def test_multiplegenomes():
     """
     This tests a file with multiple genomes
@@ -69,3 +139,295 @@ def test_multiplegenomes():
 
     for taxid, abundance in multiGenomeTest.truth.value:
         assert abs(results[taxid] - abundance) < 0.10
+
+def test_multiplegenomes_merged_index():
+    """
+    This tests a file with multiple genomes, using
+    one minimap2 index for all of the genomes.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  merged_index=True)
+    genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+    genomeTestObj.saveResultAsCSV(multiGenomeTest.output_prefix.value+"_merged.csv")
+    results = parse_output_csv(multiGenomeTest.output_prefix.value+"_merged.csv")
+
+    for taxid, abundance in multiGenomeTest.truth.value:
+        assert abs(results[taxid] - abundance) < 0.10
+    for taxid in genomeTestObj.minimap_out:
+        assert genomeTestObj.minimap_out[taxid]["readcount"] == len(genomeTestObj.minimap_out[taxid]["mapq"])
+
+def test_multiplegenomes_threads():
+    """
+    This tests that mapping with several threads gives the
+    same abundances and statistics as mapping with one thread.
+    """
+    single_thread = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  threads=1)
+    multi_thread = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                 genome_directory=multiGenomeTest.genome_directory.value,
+                                 threads=4)
+    assert single_thread.checkSeqFile(multiGenomeTest.fasta.value) == multi_thread.checkSeqFile(multiGenomeTest.fasta.value)
+    for taxid in single_thread.minimap_out:
+        assert single_thread.minimap_out[taxid]["readcount"] == multi_thread.minimap_out[taxid]["readcount"]
+        assert np.array_equal(single_thread.minimap_out[taxid].coverage.depth(), multi_thread.minimap_out[taxid].coverage.depth())
+
+def test_readstream_fastq_gz(tmp_path):
+    """
+    This tests streaming reads from a gzipped fastq file.
+    """
+    fasta_reads = [(name, seq) for name, seq in ReadStream(multiGenomeTest.fasta.value)]
+    fastq_path = tmp_path / "reads.fq.gz"
+    with gzip.open(fastq_path, "wt") as fastq_file:
+        for name, seq in fasta_reads[:100]:
+            fastq_file.write(f"@{name}\n{seq}\n+\n{'I' * len(seq)}\n")
+    reads = ReadStream(fastq_path)
+    assert [(name, seq) for name, seq in reads] == fasta_reads[:100]
+    assert reads.total_reads == 100
+
+def test_paired_reads():
+    """
+    This tests mapping read pairs, counting fragments instead of reads.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=pairedGenomeTest.input.value,
+                                  genome_directory=pairedGenomeTest.genome_directory.value)
+    genomeTestObj.checkSeqFile(pairedGenomeTest.fasta.value, pairedGenomeTest.fasta_2.value)
+    genomeTestObj.saveResultAsCSV(pairedGenomeTest.output_prefix.value+".csv")
+    results = parse_output_csv(pairedGenomeTest.output_prefix.value+".csv")
+
+    assert genomeTestObj.total_reads == len(list(ReadStream(pairedGenomeTest.fasta.value)))
+    for taxid, abundance in pairedGenomeTest.truth.value:
+        assert abs(results[taxid] - abundance) < 0.10
+        # the fragment spans are longer than either mate on its own
+        stats = genomeTestObj.minimap_out[taxid]
+        single_read_length = max(len(seq) for seq in ReadStream(pairedGenomeTest.fasta.value).sequences())
+        assert stats.coverage.mapped_bases / stats.readcount > single_read_length
+
+def test_paired_reads_unsynchronized(tmp_path):
+    """
+    This tests that mate files out of sync are rejected.
+    """
+    reads = list(ReadStream(pairedGenomeTest.fasta_2.value))
+    shuffled_path = tmp_path / "mates_2.fa"
+    with open(shuffled_path, "w") as shuffled_file:
+        for name, seq in reads[1:] + reads[:1]:
+            shuffled_file.write(f">{name}\n{seq}\n")
+    with pytest.raises(ValueError):
+        list(PairedReadStream(pairedGenomeTest.fasta.value, shuffled_path))
+
+@pytest.mark.parametrize("read_order", ["interleaved", "random"])
+def test_sampled_sequences(read_order):
+    """
+    This tests that sampling the reads yields every read once.
+    """
+    reads = ReadStream(multiGenomeTest.fasta.value)
+    sequences = list(reads.sequences())
+    sampled = list(sampled_sequences(reads, n_buckets=7, order=read_order, seed=3))
+    assert sampled != sequences
+    assert sorted(sampled) == sorted(sequences)
+
+class CountedPairs(PairedReadStream):
+    """ read pairs counting the passes over the files """
+    passes = 0
+    def __iter__(self):
+        CountedPairs.passes += 1
+        return super().__iter__()
+
+@pytest.mark.parametrize("max_spill_bytes, passes", [(10**9, 2), (1, 5)])
+def test_sampled_reads_passes(tmp_path, max_spill_bytes, passes):
+    """
+    This tests that read pairs are sampled with one pass for the first
+    bucket, then one per group of buckets that fits in the spill limit.
+    """
+    CountedPairs.passes = 0
+    reads = CountedPairs(pairedGenomeTest.fasta.value, pairedGenomeTest.fasta_2.value)
+    sampled = list(sampled_reads(reads, n_buckets=5, order="random", seed=1,
+                                 spill_directory=tmp_path, max_spill_bytes=max_spill_bytes))
+    assert CountedPairs.passes == passes
+    assert sorted(sampled) == sorted(PairedReadStream(pairedGenomeTest.fasta.value, pairedGenomeTest.fasta_2.value))
+    assert list(tmp_path.iterdir()) == [] # spill files removed
+
+def test_sampled_reads_first_bucket():
+    """
+    This tests that the first bucket is spread across the whole file,
+    and is read in one pass.
+    """
+    CountedPairs.passes = 0
+    reads = list(ReadStream(multiGenomeTest.fasta.value))
+    sampled = sampled_reads(CountedPairs(pairedGenomeTest.fasta.value, pairedGenomeTest.fasta_2.value), n_buckets=4)
+    next(sampled)
+    assert CountedPairs.passes == 1
+    first_bucket = list(itertools.islice(sampled_reads(ReadStream(multiGenomeTest.fasta.value), n_buckets=4),
+                                         len(reads[::4])))
+    assert sorted(first_bucket) == sorted(reads[::4])
+    assert first_bucket[0] == reads[0] and reads.index(first_bucket[1]) >= len(reads) // 2 # (not the head of the file)
+
+def test_convergence_early_stopping():
+    """
+    This tests stopping once the abundances are within the tolerance.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                                  genome_directory=multiGenomeTest.genome_directory.value)
+    results = genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value, tolerance=0.02)
+
+    assert genomeTestObj.total_reads < len(list(ReadStream(multiGenomeTest.fasta.value)))
+    for taxid, abundance in multiGenomeTest.truth.value:
+        assert abs(results[taxid] - abundance) < 0.05
+        lower, upper = genomeTestObj.confidenceIntervals[taxid]
+        assert lower <= results[taxid] <= upper
+        assert (upper - lower) / 2 <= 0.02
+
+@pytest.mark.parametrize("genome_subset", [["2886930", "2681618"], ["10868"]])
+def test_refined_abundances(tmp_path, genome_subset):
+    """
+    This tests that the refined abundances calculated from the first
+    pass match mapping the reads again against the genome subset.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  record_read_hits=True)
+    first_pass = genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+    subset_lsv = tmp_path / "filtered_genomes.lsv"
+    subset_lsv.write_text("\n".join(genome_subset) + "\n")
+    genomeTestObj2 = GenomeTestSet(line_seperated_genomes=subset_lsv, 
+                                   genome_directory=multiGenomeTest.genome_directory.value)
+    second_pass = genomeTestObj2.checkSeqFile(multiGenomeTest.fasta.value)
+
+    refined = genomeTestObj.refinedAbundances(genome_subset)
+    assert refined.keys() == second_pass.keys()
+    for genome_name, abundance in second_pass.items():
+        assert abs(refined[genome_name] - abundance) < 1e-9
+    assert genomeTestObj.refinedAbundances(genomeTestObj.minimap_out.keys()) == first_pass
+
+def test_minimap_out_npz(tmp_path):
+    """
+    This tests saving and loading the mapping statistics.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  keep_read_spans=True)
+    genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+    genomeTestObj.save_features()
+    save_minimap_out(genomeTestObj.minimap_out, tmp_path / "minimap_out.npz")
+    loaded = load_minimap_out(tmp_path / "minimap_out.npz")
+
+    assert list(loaded.keys()) == list(genomeTestObj.minimap_out.keys())
+    for taxid, stats in genomeTestObj.minimap_out.items():
+        assert loaded[taxid]["readcount"] == stats["readcount"]
+        assert loaded[taxid]["mapq"].dtype == np.uint8
+        assert np.array_equal(loaded[taxid]["mapq"], stats["mapq"])
+        assert np.array_equal(loaded[taxid]["readmaps"], stats["readmaps"])
+        assert loaded[taxid]["percentOverlap"] == stats["percentOverlap"]
+
+def test_coverage_accumulator():
+    """
+    This tests the coverage of overlapping reads.
+    """
+    coverage = CoverageAccumulator(genome_length=400)
+    for start, end in [(50, 150), (0, 100), (200, 300), (149, 249)]:
+        coverage.add(start, end)
+    assert coverage.covered_intervals() == {(0, 300)}
+    assert coverage.breadth() == 0.75
+    assert coverage.mean_depth() == 1.0
+    assert coverage.depth()[60] == 2
+    assert list(coverage.windowed_coverage(100)) == [1.5, 1.01, 1.49, 0.0]
+    batch_coverage = CoverageAccumulator(genome_length=400)
+    batch_coverage.add_batch(np.array([50, 0, 200, 149]), np.array([150, 100, 300, 249]))
+    assert np.array_equal(batch_coverage.depth(), coverage.depth())
+
+def test_coverage_features():
+    """
+    This tests the coverage features of the mapped genomes.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value, 
+                                  genome_directory=multiGenomeTest.genome_directory.value)
+    genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+    genomeTestObj.save_features()
+    for taxid, stats in genomeTestObj.minimap_out.items():
+        assert len(stats["readmaps"]) == 0 # only the coverage is kept
+        assert stats.coverage.readcount == stats["readcount"]
+        assert 0.99 < stats["percentOverlap"] <= 1.0
+        assert 0.0 < stats["depthEvenness"] <= 1.0
+        assert stats["meanDepth"] > 0
+
+def test_equivalence_class_em():
+    """
+    This tests sharing multi-mapping reads between genomes by EM.
+    """
+    hit_classes = {("A",): 100, ("B",): 300, ("A", "B"): 400, ("B", "A"): 0, (): 50}
+    read_counts = EquivalenceClassEM().fit(hit_classes)
+    assert abs(read_counts["A"] - 200) < 1e-3
+    assert abs(read_counts["B"] - 600) < 1e-3
+    assert read_counts["UNK"] == 50
+    # dropping a genome moves its reads to the genomes left (or UNK)
+    read_counts = EquivalenceClassEM().fit(hit_classes, genome_subset=["B"])
+    assert abs(read_counts["B"] - 700) < 1e-3
+    assert read_counts["UNK"] == 150
+
+def test_em_abundances():
+    """
+    This tests the EM abundances (there are no multi-mapping reads here,
+    so they should match first hit wins).
+    """
+    first_hit = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                              genome_directory=multiGenomeTest.genome_directory.value)
+    em = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                       genome_directory=multiGenomeTest.genome_directory.value,
+                       abundance_method="em")
+    first_hit_results = first_hit.checkSeqFile(multiGenomeTest.fasta.value)
+    em_results = em.checkSeqFile(multiGenomeTest.fasta.value)
+    assert em_results.keys() == first_hit_results.keys()
+    for genome_name, abundance in first_hit_results.items():
+        assert abs(em_results[genome_name] - abundance) < 1e-6
+
+@pytest.fixture
+def kraken_read_table(tmp_path):
+    """ read table as kraken2 would give for the multi genome reads """
+    accession_taxids = {"NC_001422.1": "2886930", "NC_001954.1": "10868", "NC_002166.1": "2681618"}
+    writer = KrakenReadTableWriter()
+    for name, seq in ReadStream(multiGenomeTest.fasta.value):
+        taxid = accession_taxids[name.split("-")[0]]
+        writer.add_line(f"C\t{name}\t{taxid}\t{len(seq)}\t{taxid}:{len(seq) - 40} 0:5\n")
+    return writer.save(tmp_path / "kraken_reads.npz")
+
+@pytest.mark.parametrize("kraken_mode, merged_index", [("skip", False), ("prioritize", False),
+                                                        ("skip", True), ("prioritize", True)])
+def test_kraken_read_table(kraken_read_table, kraken_mode, merged_index):
+    """
+    This tests using the reads kraken assigned, which should not
+    change the abundances for reads kraken assigned correctly.
+    """
+    genomeTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  merged_index=merged_index)
+    krakenTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  merged_index=merged_index,
+                                  kraken_reads=kraken_read_table, kraken_mode=kraken_mode)
+    results = genomeTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+    kraken_results = krakenTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+
+    assert krakenTestObj.kraken_assigned_reads == krakenTestObj.total_reads
+    for taxid, _ in multiGenomeTest.truth.value:
+        assert abs(kraken_results[taxid] - results[taxid]) < 0.01
+    for taxid, _ in multiGenomeTest.truth.value: # assigned reads are still in the mapping statistics
+        assert krakenTestObj.minimap_out[taxid].readcount >= 0.9 * genomeTestObj.minimap_out[taxid].readcount
+
+def test_kraken_skip_merged_index_statistics(tmp_path):
+    """
+    This tests that in skip mode with a merged index, the reads kraken
+    assigned only add to the mapping statistics of their kraken genome.
+    """
+    writer = KrakenReadTableWriter()
+    for name, seq in ReadStream(multiGenomeTest.fasta.value): # every read is given to one genome
+        writer.add_line(f"C\t{name}\t10868\t{len(seq)}\t10868:{len(seq) - 40} 0:5\n")
+    krakenTestObj = GenomeTestSet(line_seperated_genomes=multiGenomeTest.input.value,
+                                  genome_directory=multiGenomeTest.genome_directory.value,
+                                  merged_index=True, kraken_mode="skip",
+                                  kraken_reads=writer.save(tmp_path / "kraken_reads.npz"))
+    kraken_results = krakenTestObj.checkSeqFile(multiGenomeTest.fasta.value)
+
+    assert kraken_results == {"10868": 1.0}
+    assert set(krakenTestObj.minimap_out) == {"10868"}
+    assert 0 < krakenTestObj.minimap_out["10868"].readcount <= krakenTestObj.total_reads
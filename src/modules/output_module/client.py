@@ -3,6 +3,7 @@ import os
 import argparse
 
 # in house packages
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import consolidator
 import plotter
 
@@ -26,6 +27,11 @@ def parse_args(argv=None) -> argparse.Namespace:
 
 def main():
     arguments = parse_args(argv=sys.argv[1:])
+    run_client(arguments)
+
+
+def run_client(arguments: argparse.Namespace):
+    ''' copies the abundance and cluster CSVs to the output directory and plots the clusters '''
 
     # consolidator tasks
     list_of_files = [arguments.inputdir + '/merge_overlap_filter/merge_overlap_out.csv',
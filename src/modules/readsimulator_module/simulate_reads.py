@@ -19,6 +19,9 @@ import argparse
 import ntpath
 from typing import List, Optional, Tuple, Union
 import pandas as pd
+# in-house packages
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../fasta_module")
+from FastaIndex import read_fasta, read_headers
 
 
 
@@ -194,12 +197,7 @@ class ReadSegmenter:
         """
         Counts the number of read names in a fasta file
         """
-        read_count = 0
-        with open(fasta_path) as fasta:
-            fasta_lines = fasta.readlines()
-            for line in fasta_lines:
-                read_count += 1 if (line[0] == ">") else 0
-        return read_count
+        return sum(1 for _ in read_headers(fasta_path))
 
     def open_fasta_file(self, output_fasta_prefix, seqtype):
         """
@@ -226,14 +224,9 @@ class ReadSegmenter:
         Takes a fasta path and returns a list of names and sequences.
         """
         name_list, seq_list = [], []
-        with open(fasta_path) as fasta_file:
-            fasta_files_array = fasta_file.readlines()
-            for line_index, line in enumerate(fasta_files_array):
-                if line[0] == ">":
-                    name = line.strip(">")
-                    seq = fasta_files_array[line_index+1]
-                    name_list.append(name)
-                    seq_list.append(seq)
+        for record in read_fasta(fasta_path):
+            name_list.append(record.header)
+            seq_list.append(record.sequence)
         return name_list, seq_list
 
     def addDBtoFile(self, inputDF: pd.DataFrame, outputfile, file_name) -> None:
@@ -243,7 +236,7 @@ class ReadSegmenter:
         """
         for index, row in inputDF.iterrows():
             name, seq = row['names'], row['seqs']
-            outputfile.write(">" + name.strip("\n") + "|" + file_name + "\n" + seq)
+            outputfile.write(">" + name + "|" + file_name + "\n" + seq + "\n")
 
 # MAIN
 def main():
@@ -1,20 +1,28 @@
 #!/usr/bin/env nextflow
 
+nextflow.enable.dsl=2
+
 Executor = 'local'
 
 def usage() {
     log.info ''
-	log.info 'Usage: nextflow run enrichseq.nf --read single --fasta /Path/to/infile.fasta --workdir /Path/to/working_directory --dbdir /Path/to/databases [--threads 4] [--log=/Path/to/run.log]'
-	log.read '  --read       Ready type (single / paired / long)'
-    log.read '  --verbose   Give output figures and debug print statements'
-    log.read '  --use_gmm   Use the Gaussian Mixture Model during Merge Overlap'
-	log.info '  --fasta		Path to the input FASTA file. If paired end reads, only use file prefix (i.e. before underscore)! Example: '--fasta fastaA' if 'fastaA_1.fa'/'fastaA_2.fa' [suffix must be "_{1/2}.fa"])'
+	log.info 'Usage: nextflow run enrichseq.nf --read single --fasta /Path/to/infile.fasta --workdir /Path/to/working_directory --dbdir /Path/to/databases [--threads 4] [--log=/Path/to/run.log] [-resume]'
+	log.info '  --read       Ready type (single / paired / long)'
+    log.info '  --verbose   Give output figures and debug print statements'
+    log.info '  --use_gmm   Use the Gaussian Mixture Model during Merge Overlap'
+	log.info '  --fasta		Path to the input FASTA file (mate 1 for paired end reads)'
+	log.info '  --fasta_2	Path to the mate 2 FASTA file for paired end reads'
 	log.info '  --workdir	Path to the output working directory'
 	log.info "  --dbdir		Path to the classification databases"
     log.info "  --genomedir Path to the genome directory, built running the Krake2Build.sh script"
 	log.info "  --threads	Number of threads to use (Default=1)"
 	log.info "  --log		Log file (Default=Don't save the log)"
 	log.info '  --help		Print this help message out'
+	log.info '  -resume		Reuse the results of stages whose inputs did not change'
+	log.info '  --assembly_mode	Reads assembled: full, subsample, normalize or skip (Default=full)'
+	log.info '  --assembly_fraction	Fraction of the reads assembled with subsample (Default=0.1)'
+	log.info '  --assembly_coverage	Target k-mer coverage with normalize (Default=20)'
+	log.info '  --assembly_memory	MEGAHIT memory: auto, bytes or a fraction of the machine (Default=auto)'
 	log.info ''
 	exit 1
 }
@@ -74,9 +82,16 @@ databasesDir = file(params.dbdir)
 genomeDir = file(params.genomedir)
 
 BASE = fastafile.getName()
-THREADS = params.threads
+THREADS = params.threads as int
+// the raw read kraken run overlaps the assembly branch, so the threads are split between
+// them (the local executor only runs tasks together when their cpus fit in --threads);
+// the raw reads get all of them when the reads aren't assembled
+KRAKEN_READ_THREADS = params.assembly_mode == 'skip' ? THREADS : Math.max(1, THREADS.intdiv(2))
+ASSEMBLY_THREADS = Math.max(1, THREADS - KRAKEN_READ_THREADS)
 WORKFLOW = "enrichseq"
 
+// every stage runs in its own nextflow task directory (so -resume can reuse it),
+// and its results are published to the stage directories below.
 megahitDir = file("$workingDir/$WORKFLOW/megahit")
 krakenDir = file("$workingDir/$WORKFLOW/kraken")
 mergeOverlapDir = file("$workingDir/$WORKFLOW/merge_overlap_filter")
@@ -84,134 +99,193 @@ genomeCompareDir = file("$workingDir/$WORKFLOW/genome_comparison")
 outputDir = file("$workingDir/$WORKFLOW/output_files")
 
 
-process Create_Working_Directories {
-    output:
-    stdout create
+process Initialize {
+    executor Executor
+    echo true
 
     """
-    mkdir -p $workingDir
-    mkdir -p $workingDir/$WORKFLOW
-
-    if [ -d $megahitDir ]; then rm -rf $megahitDir; fi;
-    if [ -d $krakenDir ]; then rm -rf $krakenDir; fi;
-    if [ -d $mergeOverlapDir ]; then rm -rf $mergeOverlapDir; fi;
-    if [ -d $genomeCompareDir ]; then rm -rf $genomeCompareDir; fi;
-    if [ -d $outputDir ]; then rm -rf $outputDir; fi;
-
-    #mkdir $megahitDir
-    mkdir $krakenDir
-    mkdir $mergeOverlapDir
-    mkdir $genomeCompareDir
-    mkdir $outputDir
+    echo -n " # Launching $WORKFLOW workflow ........................ " | tee -a $logfile; date '+%H:%M:%S %Y-%m-%d' | tee -a $logfile
     """
 }
 
-process Initialize {
+// digital normalization of the reads given to MEGAHIT (--assembly_mode normalize);
+// the abundances are still estimated from every read
+process Run_Normalize {
+    publishDir "${megahitDir}", mode: 'copy'
+    echo true
+
     input:
-    val create from create
+    path reads_1
+    path reads_2, stageAs: 'mate_2/*'
 
     output:
-    stdout init
-
-    executor Executor
+    path 'normalized_1.fa', emit: reads_1
+    path 'normalized_2.fa', emit: reads_2
 
+    script:
+    def mate_2 = params.read == 'paired' ? "--input2 ${reads_2} --out2 normalized_2.fa" : ''
     """
-    echo -n " # Launching $WORKFLOW workflow ........................ " | tee -a $logfile; date '+%H:%M:%S %Y-%m-%d' | tee -a $logfile
+    python ${params.toolpath}/megahit_module/ReadSubsampler.py --mode normalize \
+            --input1 ${reads_1} \
+            --out1 normalized_1.fa \
+            ${mate_2} \
+            --coverage ${params.assembly_coverage}
+    touch normalized_2.fa
     """
 }
 
 process Run_Megahit {
-    input:
-    val init from init
-
-    output:
-    stdout megahit
+    publishDir "${megahitDir}", mode: 'copy'
+    cpus ASSEMBLY_THREADS
+    echo true
 
     if ( Executor == 'local' ) {
        executor "local"
     }
 
+    input:
+    path reads_1
+    path reads_2, stageAs: 'mate_2/*'
+
+    output:
+    path 'megahit_out.contigs.fa', emit: contigs
+
     script:
+    // normalized reads (Run_Normalize) are assembled whole
+    def assembly_mode = params.assembly_mode == 'normalize' ? 'full' : params.assembly_mode
     """
     bash ${params.toolpath}/megahit_module/megahitRun.sh --read=${params.read} \
-        		  --input1=${fastafile} \
-                  --input2=${fastafile_2} \
-    			  --threads=${THREADS} \
-    			  --out=${megahitDir}
+        		  --input1=${reads_1} \
+                  --input2=${reads_2} \
+    			  --threads=${ASSEMBLY_THREADS} \
+    			  --out=megahit \
+    			  --mode=${assembly_mode} \
+    			  --fraction=${params.assembly_fraction} \
+    			  --coverage=${params.assembly_coverage} \
+    			  --memory=${params.assembly_memory}
+    cp megahit/megahit_out.contigs.fa megahit_out.contigs.fa
     """
 }
 
+// both kraken runs memory map the database, so they share one copy in the page cache
 process Run_Kraken {
+    publishDir "${krakenDir}", mode: 'copy'
+    cpus ASSEMBLY_THREADS
+    echo true
+
 	input:
-	val megaout from megahit
-	//val krakendb from databases
+	path contigs
 
 	output:
-	stdout kraken
-	
+	path 'kraken_assembled.report', emit: report
+	path 'kraken_assembled_contigs.npz', emit: read_table
+
 	script:
 	"""
 	bash ${params.toolpath}/kraken_module/kraken2Run.sh --krakendb=${databasesDir} \
-				--queryfasta=${megahitDir}/*.contigs.fa \
-				--report=${krakenDir}/kraken_assembled.report \
-				--out=${krakenDir}/kraken1.log
+				--queryfasta=${contigs} \
+				--report=kraken_assembled.report \
+				--out=kraken_assembled_contigs.npz \
+				--threads=${ASSEMBLY_THREADS} \
+				--memory_mapping
+	"""
+}
+
+// the raw reads only need the input, so they are classified while the reads are assembled
+process Run_Kraken_Reads {
+    publishDir "${krakenDir}", mode: 'copy'
+    cpus KRAKEN_READ_THREADS
+    echo true
+
+	input:
+	path reads_1
+
+	output:
+	path 'kraken_orig.report', emit: report
+	path 'kraken_reads.npz', emit: read_table
+
+	script:
+	"""
 	bash ${params.toolpath}/kraken_module/kraken2Run.sh --krakendb=${databasesDir} \
-				--queryfasta=${fastafile} \
-				--report=${krakenDir}/kraken_orig.report \
-				--out=${krakenDir}/kraken2.log
+				--queryfasta=${reads_1} \
+				--report=kraken_orig.report \
+				--out=kraken_reads.npz \
+				--threads=${KRAKEN_READ_THREADS} \
+				--memory_mapping
 	"""
 }
 
 
 process Run_KrakenParser {
-   input: 
-   val krakenout from kraken
+   publishDir "${krakenDir}", mode: 'copy'
+   echo true
+
+   input:
+   path report
 
    output:
-   stdout kraken_parser
+   path 'taxid_file.txt', emit: taxids
+   path 'parsed_kraken_phages.txt'
 
    script:
    """
-   python ${params.toolpath}/kraken_module/parseKraken.py ${krakenDir}/kraken_assembled.report \
-          ${krakenDir}/taxid_file.txt ${krakenDir}/parsed_kraken_phages.txt
+   python ${params.toolpath}/kraken_module/parseKraken.py ${report} \
+          taxid_file.txt parsed_kraken_phages.txt \
+          --min_reads ${params.kraken_min_reads} \
+          --min_fraction ${params.kraken_min_fraction}
    """
 }
 
 
+// (mergeoverlap.py changes directory on start, so it is given absolute paths)
 process Run_MergeOverlap {
+    publishDir "${mergeOverlapDir}", mode: 'copy'
+    cpus THREADS
+    echo true
+
 	input:
-    val kraken_parse from kraken_parser
+    path taxids
+    path reads_1
+    path reads_2, stageAs: 'mate_2/*'
+    path kraken_read_table
 
 	output:
-	stdout merge_overlap
+	path 'merge_overlap_out*', emit: results
+	path 'merge_overlap_out.csv', emit: abundances
 
-	script:    
+	script:
+	def mate_2 = params.read == 'paired' ? "--fasta_2 \$PWD/${reads_2}" : ''
 	"""
-	echo "Running the Merge Overlap Filter" > ${mergeOverlapDir}/mergeOverlap.log;
+	echo "Running the Merge Overlap Filter"
 	python ${params.toolpath}/mergeoverlap_filter_module/mergeoverlap.py \
-            --input ${krakenDir}/taxid_file.txt \
-            --output_prefix ${mergeOverlapDir}/merge_overlap_out \
+            --input \$PWD/${taxids} \
+            --output_prefix \$PWD/merge_overlap_out \
             --genome_directory ${genomeDir} \
-            --fasta ${fastafile} \
+            --fasta \$PWD/${reads_1} \
+            ${mate_2} \
+            --kraken_reads \$PWD/${kraken_read_table} \
             ${plotMergeOverlapResults} \
             ${use_gmm_MO} \
-            --threads ${THREADS} 
+            --threads ${THREADS}
 	"""
 }
 
 process Run_GenomeComparison {
+    publishDir "${genomeCompareDir}", mode: 'copy'
+    echo true
+
 	input:
-    val filter from merge_overlap
+    path merge_overlap_results
 
 	output:
-	stdout clusters
+	path 'cluster_*.csv', emit: clusters
 
-	script:    
+	script:
 	"""
-	echo "Running the Genome Comparison module" > ${genomeCompareDir}/genomeCompare.log;
+	echo "Running the Genome Comparison module"
 	python ${params.toolpath}/genomeCompare_module/genome_comparison.py \
-            --input ${mergeOverlapDir}/ \
-            --output_dir ${genomeCompareDir}/ \
+            --input \$PWD/ \
+            --output_dir \$PWD/ \
             --genome_directory ${genomeDir} \
             --kmer_length ${params.kmer_length} \
             --threshold ${params.clustering_threshold}
@@ -219,25 +293,51 @@ process Run_GenomeComparison {
 }
 
 process Run_CombineOutput {
+    publishDir "${workingDir}/${WORKFLOW}", mode: 'copy'
+    echo true
+
     input:
-    val cluster_out from clusters
+    path abundances, stageAs: 'merge_overlap_filter/*'
+    path clusters, stageAs: 'genome_comparison/*'
 
     output:
-    stdout enrichseq_out
+    path 'output_files/*'
 
     script:
     """
-    echo "Consolidating output" > ${outputDir}/genomeCompare.log;
+    echo "Consolidating output"
+    mkdir -p output_files
     python ${params.toolpath}/output_module/client.py \
-            --inputdir ${workingDir}/${WORKFLOW} \
-            --outputdir ${outputDir}
+            --inputdir \$PWD \
+            --outputdir \$PWD/output_files
     """
 }
 
-create.subscribe { print "$it" }
-init.subscribe { print "$it" }
-megahit.subscribe { print "$it" }
-kraken.subscribe { print "$it" }
-merge_overlap.subscribe { print "$it" }
-clusters.subscribe { print "$it" } 
-enrichseq_out.subscribe { print "$it"}
+workflow {
+    reads_1 = Channel.value(fastafile)
+    reads_2 = Channel.value(fastafile_2)
+
+    Initialize()
+    // raw read classification (runs alongside the assembly below)
+    Run_Kraken_Reads(reads_1)
+    // assembly -> contig classification -> candidate genomes
+    if (params.assembly_mode == 'skip') {
+        // the reads aren't assembled, so the read classification gives the candidate genomes
+        Run_KrakenParser(Run_Kraken_Reads.out.report)
+    }
+    else {
+        if (params.assembly_mode == 'normalize') {
+            Run_Normalize(reads_1, reads_2)
+            Run_Megahit(Run_Normalize.out.reads_1, Run_Normalize.out.reads_2)
+        }
+        else {
+            Run_Megahit(reads_1, reads_2)
+        }
+        Run_Kraken(Run_Megahit.out.contigs)
+        Run_KrakenParser(Run_Kraken.out.report)
+    }
+
+    Run_MergeOverlap(Run_KrakenParser.out.taxids, reads_1, reads_2, Run_Kraken_Reads.out.read_table)
+    Run_GenomeComparison(Run_MergeOverlap.out.results)
+    Run_CombineOutput(Run_MergeOverlap.out.abundances, Run_GenomeComparison.out.clusters)
+}
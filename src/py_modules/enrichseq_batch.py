@@ -0,0 +1,134 @@
+"""
+This module runs EnrichSeq on every sample of a sample sheet with one
+native pipeline runner, instead of one EnrichSeq run per sample.
+
+The samples share the warm resources of the runner: kraken2 memory maps
+the database (one copy in the page cache for every sample), and the merge
+overlap stages of all samples run in the same worker processes, which keep
+the minimap2 index of each genome they have built (see load_aligner in
+GenomeMapper.py). Each sample is published to <output>/<sample>, and the
+abundances of every sample are combined in <output>/abundance_matrix.tsv.
+
+SAMPLE SHEET (tab separated, with a header; reads_2 is optional):
+    sample	reads_1	reads_2
+    S1	S1_R1.fa	S1_R2.fa
+    S2	S2.fa
+    Relative read paths are relative to the sample sheet.
+
+Classes
+    1. Sample - a sample of the sheet.
+
+Methods
+    1. read_sample_sheet - reads and checks a sample sheet.
+    2. abundance_matrix_stage - combines the abundances of the samples.
+    3. build_batch_pipeline - adds the stages of every sample to a PipelineRunner.
+"""
+import csv
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+from src.py_modules.pipeline import PipelineRunner, Stage, StageOutput
+from src.py_modules.enrichseq_stages import build_enrichseq_pipeline
+
+
+SAMPLE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$") # used as a directory name
+MATRIX_NAME = "abundance_matrix.tsv"
+UNKNOWN_GENOME = "UNK"
+
+
+@dataclass
+class Sample:
+    """ a sample of the sample sheet (reads_2 for paired end reads) """
+    name: str
+    reads_1: str
+    reads_2: Optional[str] = None
+
+    @property
+    def read_type(self) -> str:
+        return "paired" if self.reads_2 else "single"
+
+
+def read_sample_sheet(sheet_path) -> List[Sample]:
+    """
+    DESCRIPTION:
+        reads a tab separated sample sheet (columns sample, reads_1 and
+        optionally reads_2), checking the names and read files.
+
+    OUTPUT:
+        the samples, in sheet order
+    """
+    sheet_path = Path(sheet_path)
+    samples: List[Sample] = []
+    with open(sheet_path, newline="") as sheet:
+        rows = csv.DictReader((line for line in sheet if line.strip() and not line.startswith("#")), delimiter="\t")
+        if rows.fieldnames is None or not {"sample", "reads_1"} <= set(rows.fieldnames):
+            raise ValueError(f"{sheet_path} needs the columns 'sample' and 'reads_1'")
+        for row in rows:
+            name = row["sample"].strip()
+            if not SAMPLE_NAME.match(name):
+                raise ValueError(f"invalid sample name {name!r} (letters, digits, '.', '_' and '-' only)")
+            if name in (sample.name for sample in samples):
+                raise ValueError(f"duplicate sample name {name!r}")
+            reads = []
+            for column in ("reads_1", "reads_2"):
+                reads_path = (row.get(column) or "").strip()
+                if not reads_path:
+                    reads.append(None)
+                    continue
+                reads_path = sheet_path.parent / reads_path
+                if not reads_path.is_file():
+                    raise FileNotFoundError(f"{reads_path} (sample {name}) does not exist.")
+                reads.append(str(reads_path.resolve()))
+            if reads[0] is None:
+                raise ValueError(f"sample {name} has no reads_1")
+            samples.append(Sample(name, reads[0], reads[1]))
+    if not samples:
+        raise ValueError(f"{sheet_path} has no samples")
+    return samples
+
+
+def read_abundances(csv_path) -> Dict[str, float]:
+    """ {genome: abundance} from a merge overlap csv """
+    with open(csv_path, newline="") as csv_file:
+        return {row[0]: float(row[1]) for row in csv.reader(csv_file) if len(row) >= 2}
+
+
+def abundance_matrix_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ combines the abundances of the samples (genomes x samples, 0 where not found) """
+    abundances = {sample: read_abundances(inputs[sample]) for sample in params["samples"]}
+    genomes = sorted({genome for sample_abundances in abundances.values() for genome in sample_abundances},
+                     key=lambda genome: (genome == UNKNOWN_GENOME, genome)) # 'UNK' last
+    with open(out_dir / MATRIX_NAME, "w", newline="") as matrix_file:
+        writer = csv.writer(matrix_file, delimiter="\t")
+        writer.writerow(["taxid"] + params["samples"])
+        for genome in genomes:
+            writer.writerow([genome] + [abundances[sample].get(genome, 0.0) for sample in params["samples"]])
+    return {"matrix": MATRIX_NAME}
+
+
+def build_batch_pipeline(runner: PipelineRunner, samples: List[Sample], krakendb, genome_directory,
+                         threads: int = 4, parallel_samples: int = 1, **stage_options) -> PipelineRunner:
+    """
+    DESCRIPTION:
+        adds the stages of every sample (named <sample>/<stage>) and the
+        abundance matrix to a runner. The threads are split between the
+        samples running at once (the runner should have 2 * parallel_samples
+        threads and parallel_samples processes).
+
+    INPUT:
+        1. runner
+        2. samples (see read_sample_sheet)
+        3. kraken database, genome directory
+        4. total threads and samples processed at once
+        5. options of build_enrichseq_pipeline (verbose, use_gmm, ...)
+    """
+    sample_threads = max(1, int(threads) // max(1, int(parallel_samples)))
+    for sample in samples:
+        build_enrichseq_pipeline(runner, sample.read_type, sample.reads_1, sample.reads_2, krakendb, genome_directory,
+                                 threads=sample_threads, sample=sample.name, **stage_options)
+    runner.add(Stage("abundance_matrix", abundance_matrix_stage,
+                     inputs={sample.name: StageOutput(f"{sample.name}/merge_overlap", "abundances") for sample in samples},
+                     params={"samples": [sample.name for sample in samples]},
+                     publish_dir="."))
+    return runner
@@ -0,0 +1,409 @@
+"""
+This module runs EnrichSeq as a long running service, so on-demand jobs
+don't pay the startup cost of every run. The service keeps warm:
+    - worker processes with the python modules (numpy, sklearn, mappy...)
+      imported, which keep the minimap2 index of each genome they have
+      built (see load_aligner in GenomeMapper.py)
+    - the kraken database files in the page cache (kraken2 memory maps them)
+    - a stage cache shared by every job, so repeated inputs aren't rerun
+
+Jobs are queued in a bounded queue (submitting to a full queue fails with
+503) and run by a fixed number of job workers (the concurrency limit).
+Only the last finished (done or failed) jobs are kept, the older ones are
+forgotten when jobs are submitted (their outputs stay on disk).
+
+API (JSON over HTTP, on a TCP port or a Unix socket):
+    POST /jobs        {"reads_1": path, "reads_2": path (optional), "name": label (optional)}
+                      -> 202 {"job_id": ..., "status": "queued", ...}
+    GET  /jobs        -> every job
+    GET  /jobs/<id>   -> status, timings, stage metrics and (once done) abundances
+    GET  /health      -> queue and worker state
+
+Classes
+    1. Job - a submitted sample, with its status and timings.
+    2. EnrichSeqService - bounded job queue run by the job workers.
+    3. ServiceHandler - HTTP request handler for the API.
+    4. UnixHTTPServer - HTTP server on a Unix socket.
+    5. EnrichSeqClient - client for the API (TCP or Unix socket).
+
+Methods
+    1. enrichseq_job_pipeline - adds the EnrichSeq stages of a job to a runner.
+    2. make_server - HTTP server for a service.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import socket
+import threading
+import http.client
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+import src.py_modules.run_metrics as run_metrics
+from src.py_modules.pipeline import PipelineRunner, StageOutput, CACHE_DIR_NAME
+from src.py_modules.enrichseq_stages import build_enrichseq_pipeline, MODULES_PATH
+from src.py_modules.enrichseq_batch import read_abundances
+
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+PAGE_CACHE_BLOCK = 1 << 24 # bytes read at once when warming the kraken database
+MAX_FINISHED_JOBS = 1000 # finished jobs kept by the service (GET /jobs/<id>)
+
+
+class ServiceBusyError(Exception):
+    """ Exception raised when the job queue is full """
+
+class ServiceError(Exception):
+    """ Exception raised by the client for an error response """
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+@dataclass
+class Job:
+    """ a submitted sample, with its status and timings """
+    job_id: str
+    request: Dict
+    status: str = "queued"
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    abundances: Dict[str, float] = field(default_factory=dict)
+    stages: Dict[str, Dict] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        """ json view of the job (timings in seconds) """
+        now = time.time()
+        timings = {"queue_wait_s": (self.started or now) - self.submitted}
+        if self.started is not None:
+            timings["run_s"] = (self.finished or now) - self.started
+        return {"job_id": self.job_id, "name": self.request.get("name"), "status": self.status,
+                "submitted": self.submitted, "timings": timings, "error": self.error,
+                "stages": self.stages, "abundances": self.abundances}
+
+
+def enrichseq_job_pipeline(runner: PipelineRunner, request: Dict, settings: Dict) -> StageOutput:
+    """
+    DESCRIPTION:
+        adds the EnrichSeq stages of a job to a runner.
+
+    OUTPUT:
+        the stage output holding the abundances (merge overlap csv)
+    """
+    build_enrichseq_pipeline(runner, "paired" if request.get("reads_2") else "single",
+                             request["reads_1"], request.get("reads_2"),
+                             settings["krakendb"], settings["genome_directory"],
+                             threads=settings.get("threads", 4),
+                             use_gmm=settings.get("use_gmm", False),
+                             kmer_length=settings.get("kmer_length", 20),
+                             clustering_threshold=settings.get("clustering_threshold", 0.2),
+                             **{option: value for option, value in settings.items() if option.startswith("assembly_")})
+    return StageOutput("merge_overlap", "abundances")
+
+
+def _warm_worker():
+    """ imports the python stages once per worker process """
+    for module_directory, module_name in (("mergeoverlap_filter_module", "mergeoverlap"),
+                                          ("genomeCompare_module", "genome_comparison")):
+        module_path = str(MODULES_PATH / module_directory)
+        if module_path not in sys.path:
+            sys.path.append(module_path)
+        try:
+            __import__(module_name)
+        except Exception as error: # the stage will report it when it runs
+            print(f"could not preload {module_name}: {error}")
+
+
+def _noop():
+    return os.getpid()
+
+
+def _warm_page_cache(database_path: Path):
+    """ reads the kraken database files once, so kraken2 maps them from the page cache """
+    for database_file in sorted(Path(database_path).glob("*.k2d")):
+        with open(database_file, "rb") as k2d_file:
+            while k2d_file.read(PAGE_CACHE_BLOCK):
+                pass
+
+
+class EnrichSeqService:
+    """
+    DESCRIPTION:
+        Bounded job queue run by max_jobs job workers. Every job runs
+        its stages in the same warm thread and process pools, with one
+        stage cache for the service.
+
+    INPUT:
+        1. output directory (job outputs in <output>/jobs/<job id>)
+        2. settings (krakendb, genome_directory, threads, use_gmm, ...)
+        3. jobs running at once
+        4. jobs waiting at most
+        5. builder(runner, request, settings) -> StageOutput of the abundances
+        6. if True, start the worker processes with the stage modules imported
+        7. finished jobs kept (the oldest are forgotten on submit)
+    """
+
+    def __init__(self, output_dir: Union[str, Path], settings: Dict, max_jobs: int = 1, queue_size: int = 8,
+                 builder: Callable = enrichseq_job_pipeline, warm_workers: bool = True,
+                 max_finished_jobs: int = MAX_FINISHED_JOBS):
+        self.output_dir = Path(output_dir)
+        self.settings = dict(settings)
+        self.max_jobs = max(1, int(max_jobs))
+        self.builder = builder
+        self.warm_workers = warm_workers
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict() # in submission order
+        self.max_finished_jobs = max(0, int(max_finished_jobs))
+        self.lock = threading.Lock()
+        self.queue: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.workers: List[threading.Thread] = []
+        # (assembly and read classification of a job run at the same time)
+        self.thread_pool = ThreadPoolExecutor(max_workers=2 * self.max_jobs)
+        self.process_pool = ProcessPoolExecutor(max_workers=self.max_jobs,
+                                                initializer=_warm_worker if warm_workers else None)
+
+    def start(self) -> "EnrichSeqService":
+        """ starts the job workers and warms the worker processes and kraken database """
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.warm_workers:
+            for _ in range(self.max_jobs):
+                self.process_pool.submit(_noop)
+        if self.settings.get("krakendb") and Path(self.settings["krakendb"]).is_dir():
+            threading.Thread(target=_warm_page_cache, args=(self.settings["krakendb"],), daemon=True).start()
+        for _ in range(self.max_jobs):
+            worker = threading.Thread(target=self.__work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def stop(self):
+        """ lets the running jobs finish, then stops the workers and pools (queued jobs fail) """
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.error, job.status = "the service was stopped", "failed"
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.thread_pool.shutdown()
+        self.process_pool.shutdown()
+
+    def submit(self, request: Dict) -> Job:
+        """ queues a job; raises ValueError for invalid requests and ServiceBusyError if the queue is full """
+        if not isinstance(request, dict) or not request.get("reads_1"):
+            raise ValueError("a job needs reads_1")
+        for reads in ("reads_1", "reads_2"):
+            if request.get(reads) and not Path(request[reads]).is_file():
+                raise ValueError(f"{request[reads]} does not exist.")
+        job = Job(job_id=uuid.uuid4().hex[:12], request=dict(request))
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                raise ServiceBusyError(f"the job queue is full ({self.queue.maxsize} jobs waiting)")
+            self.jobs[job.job_id] = job
+            self.__forget_finished_jobs()
+        return job
+
+    def __forget_finished_jobs(self):
+        """ drops the oldest finished jobs beyond max_finished_jobs (called with the lock held) """
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def job(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def health(self) -> Dict:
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {"status": "ok", "max_jobs": self.max_jobs, "queue_size": self.queue.maxsize,
+                **{status: statuses.count(status) for status in JOB_STATUSES}}
+
+    def __work(self):
+        """ job worker: runs queued jobs until stopped """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.run_job(job)
+
+    def run_job(self, job: Job):
+        """ runs the stages of a job in the shared pools """
+        job.started, job.status = time.time(), "running"
+        job_dir = self.output_dir / "jobs" / job.job_id
+        runner = PipelineRunner(job_dir, threads=2, processes=1, cache_dir=self.output_dir / CACHE_DIR_NAME)
+        try:
+            result = self.builder(runner, job.request, self.settings)
+            outputs = runner.run(self.thread_pool, self.process_pool)
+            job.abundances = read_abundances(outputs[result.stage][result.name])
+            job.status = "done"
+        except Exception as error:
+            job.error, job.status = str(error), "failed"
+        finally:
+            job.finished = time.time()
+            job.stages = runner.metrics
+            run_metrics.write_run_metrics(job_dir, "service", runner.metrics, job.finished - job.started)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """ HTTP request handler for the API (the server holds the service) """
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        if getattr(self.server, "verbose", False):
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        service: EnrichSeqService = self.server.service
+        path = self.path.rstrip("/")
+        if path == "/health":
+            return self.send_json(200, service.health())
+        if path == "/jobs":
+            with service.lock:
+                jobs = list(service.jobs.values())
+            return self.send_json(200, [job.to_dict() for job in jobs])
+        if path.startswith("/jobs/"):
+            job = service.job(path[len("/jobs/"):])
+            if job is None:
+                return self.send_json(404, {"error": "unknown job"})
+            return self.send_json(200, job.to_dict())
+        self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        service: EnrichSeqService = self.server.service
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": f"unknown path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = service.submit(request)
+        except (ValueError, json.JSONDecodeError) as error:
+            return self.send_json(400, {"error": str(error)})
+        except ServiceBusyError as error:
+            return self.send_json(503, {"error": str(error)})
+        self.send_json(202, job.to_dict())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on a Unix socket """
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address) # left by a previous service
+        super().server_bind()
+
+
+def make_server(service: EnrichSeqService, host: str = "127.0.0.1", port: int = 8765,
+                socket_path: Optional[str] = None, verbose: bool = False):
+    """
+    DESCRIPTION:
+        HTTP server for a service, on a Unix socket if socket_path is
+        given, else on host:port (port 0 picks a free port).
+        Run it with serve_forever().
+    """
+    if socket_path:
+        server = UnixHTTPServer(str(socket_path), ServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, int(port)), ServiceHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class EnrichSeqClient:
+    """
+    DESCRIPTION:
+        Client for the service API.
+
+    INPUT:
+        1. host and port, or
+        2. Unix socket path
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, socket_path: Optional[str] = None,
+                 timeout: float = 30.0):
+        self.host = host
+        self.port = int(port)
+        self.socket_path = str(socket_path) if socket_path else None
+        self.timeout = timeout
+
+    def __request(self, method: str, path: str, body: Optional[Dict] = None):
+        if self.socket_path:
+            connection = _UnixHTTPConnection(self.socket_path, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            payload = json.dumps(body).encode() if body is not None else None
+            connection.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = json.loads(response.read() or b"null")
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise ServiceError(response.status, data.get("error") if isinstance(data, dict) else data)
+        return data
+
+    def submit(self, reads_1, reads_2=None, name: Optional[str] = None) -> Dict:
+        request = {"reads_1": str(reads_1)}
+        if reads_2:
+            request["reads_2"] = str(reads_2)
+        if name:
+            request["name"] = name
+        return self.__request("POST", "/jobs", request)
+
+    def status(self, job_id: str) -> Dict:
+        return self.__request("GET", f"/jobs/{job_id}")
+
+    def jobs(self) -> List[Dict]:
+        return self.__request("GET", "/jobs")
+
+    def health(self) -> Dict:
+        return self.__request("GET", "/health")
+
+    def wait(self, job_id: str, poll_interval: float = 1.0, timeout: Optional[float] = None) -> Dict:
+        """ polls a job until it is done or failed """
+        start_time = time.time()
+        while True:
+            job = self.status(job_id)
+            if job["status"] in ("done", "failed"):
+                return job
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f"job {job_id} is still {job['status']}")
+            time.sleep(poll_interval)
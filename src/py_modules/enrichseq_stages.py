@@ -0,0 +1,356 @@
+"""
+This module defines the EnrichSeq stages for the native pipeline runner
+(see pipeline.py), mirroring the processes in src/nextflow/enrichseq.nf.
+
+MEGAHIT and kraken2 run as subprocesses from worker threads. The python
+stages (read normalization, merge overlap, genome comparison) run in
+worker processes, which import numpy/sklearn/matplotlib once and call the
+modules directly instead of starting a new interpreter per stage.
+
+Methods
+    1. build_enrichseq_pipeline - adds the EnrichSeq stages to a PipelineRunner.
+    2. <stage>_stage - the function run for each stage.
+    3. <stage>_items - the item counts of each stage, for the run report.
+    4. nextflow_stage_metrics - the run report entries of a nextflow run.
+"""
+import sys
+import json
+import shutil
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+import src.py_modules.run_metrics as run_metrics
+from src.py_modules.pipeline import PipelineRunner, Stage, StageOutput
+
+
+MODULES_PATH = Path(__file__).resolve().parent.parent / "modules"
+WORKFLOW = "enrichseq"
+KRAKEN_DB_FILES = ("hash.k2d", "taxo.k2d")
+
+
+def _import_module_path(module_directory: str):
+    """ makes the scripts of a module directory importable """
+    module_path = str(MODULES_PATH / module_directory)
+    if module_path not in sys.path:
+        sys.path.append(module_path)
+
+
+def _file_signature(paths) -> List[Optional[List[int]]]:
+    """ [size, mtime_ns] of each file (None if it is missing), so a stage's key changes with its database """
+    signature = []
+    for path in paths:
+        try:
+            stat = Path(path).stat()
+            signature.append([stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            signature.append(None)
+    return signature
+
+
+def genome_directory_signature(genome_directory) -> List[Optional[List[int]]]:
+    """ signature of a genome directory: the directory, its taxid index and its alias table """
+    database_path = Path(genome_directory).resolve()
+    return _file_signature([database_path,
+                            database_path.parent / f".{database_path.name}.taxid_index.tsv",
+                            database_path.parent / f".{database_path.name}.sequence_aliases.tsv"])
+
+
+def krakendb_signature(krakendb) -> List[Optional[List[int]]]:
+    """ signature of a kraken database (its hash table and taxonomy) """
+    return _file_signature([Path(krakendb) / file_name for file_name in KRAKEN_DB_FILES])
+
+
+def _check_call(CMD_list):
+    """ runs a command (measured as part of the stage), raising if it fails """
+    out = run_metrics.call(CMD_list)
+    if out.returncode != 0:
+        raise RuntimeError(f"command failed ({out.returncode}): {' '.join(str(arg) for arg in CMD_list)}")
+    return out
+
+
+def normalize_reads_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ digital normalization of the reads given to MEGAHIT (see ReadSubsampler.py) """
+    _import_module_path("megahit_module")
+    from ReadSubsampler import normalize_by_median, write_fasta
+    from ReadStream import ReadStream, PairedReadStream
+    from CountMinSketch import CountMinSketch
+    outputs = {"reads_1": "normalized_1.fa"}
+    if "reads_2" in inputs:
+        reads = PairedReadStream(inputs["reads_1"], inputs["reads_2"])
+        outputs["reads_2"] = "normalized_2.fa"
+    else:
+        reads = ReadStream(inputs["reads_1"])
+    kept = normalize_by_median(reads, params["coverage"], params["kmer_length"],
+                               CountMinSketch(width_bits=params["sketch_bits"]))
+    write_fasta(kept, out_dir / outputs["reads_1"], out_dir / outputs["reads_2"] if "reads_2" in outputs else None)
+    return outputs
+
+
+def megahit_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ assembles the reads (or a subset of them), keeping only the contigs """
+    _check_call(["bash", f"{MODULES_PATH}/megahit_module/megahitRun.sh",
+                 f"--read={params['read']}",
+                 f"--input1={inputs['reads_1']}",
+                 f"--input2={inputs.get('reads_2', inputs['reads_1'])}",
+                 f"--threads={params['threads']}",
+                 f"--out={out_dir / 'megahit'}",
+                 f"--mode={params['mode']}",
+                 f"--fraction={params['fraction']}",
+                 f"--coverage={params['coverage']}",
+                 f"--memory={params['memory']}"])
+    shutil.copy(out_dir / "megahit" / "megahit_out.contigs.fa", out_dir / "megahit_out.contigs.fa")
+    shutil.rmtree(out_dir / "megahit")
+    return {"contigs": "megahit_out.contigs.fa"}
+
+
+def kraken_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ classifies the query with kraken2 (report and read table) """
+    report, read_table = f"{params['prefix']}.report", f"{params['prefix']}.npz"
+    _check_call(["bash", f"{MODULES_PATH}/kraken_module/kraken2Run.sh",
+                 f"--krakendb={params['krakendb']}",
+                 f"--queryfasta={inputs['query']}",
+                 f"--report={out_dir / report}",
+                 f"--out={out_dir / read_table}",
+                 f"--threads={params['threads']}",
+                 "--memory_mapping"])
+    return {"report": report, "read_table": read_table}
+
+
+def parse_kraken_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ picks the candidate genomes from the kraken report """
+    _import_module_path("kraken_module")
+    import parseKraken
+    kraken_phages = parseKraken.parseKrakenFile(inputs["report"], min_reads=params["min_reads"],
+                                                min_fraction=params["min_fraction"])
+    # (empty files are kept when no phages are found, so the outputs always exist)
+    (out_dir / "taxid_file.txt").touch()
+    (out_dir / "parsed_kraken_phages.txt").touch()
+    parseKraken.saveTaxidToFile(str(out_dir / "taxid_file.txt"), kraken_phages)
+    parseKraken.saveNameToFile(str(out_dir / "parsed_kraken_phages.txt"), kraken_phages)
+    return {"taxids": "taxid_file.txt", "names": "parsed_kraken_phages.txt"}
+
+
+def merge_overlap_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ estimates the abundances of the candidate genomes """
+    _import_module_path("mergeoverlap_filter_module")
+    import mergeoverlap
+    argv = ["--input", str(inputs["taxids"]),
+            "--output_prefix", str(out_dir / "merge_overlap_out"),
+            "--genome_directory", params["genome_directory"],
+            "--fasta", str(inputs["reads_1"]),
+            "--kraken_reads", str(inputs["kraken_reads"]),
+            "--threads", str(params["threads"])]
+    if "reads_2" in inputs:
+        argv += ["--fasta_2", str(inputs["reads_2"])]
+    if params["verbose"]:
+        argv += ["--plot_results"]
+    if params["use_gmm"]:
+        argv += ["--use_gmm"]
+    mergeoverlap.run_merge_overlap(mergeoverlap.parseArgs(argv))
+    outputs = {path.name: path.name for path in out_dir.glob("merge_overlap_out*")}
+    outputs["abundances"] = "merge_overlap_out.csv"
+    outputs["counts"] = "merge_overlap_out_counts.json"
+    return outputs
+
+
+def genome_comparison_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ clusters the genomes found by merge overlap """
+    _import_module_path("genomeCompare_module")
+    import genome_comparison
+    arguments = genome_comparison.parseArgs(["--input", f"{inputs['merge_overlap']}/",
+                                             "--output_dir", f"{out_dir}/",
+                                             "--genome_directory", params["genome_directory"],
+                                             "--kmer_length", str(params["kmer_length"]),
+                                             "--threshold", str(params["threshold"])])
+    genome_comparison.run_genome_comparison(arguments)
+    return {"cluster_members": "cluster_members.csv", "cluster_abundances": "cluster_abundances.csv"}
+
+
+def combine_output_stage(inputs: Dict[str, Path], params: Dict, out_dir: Path) -> Dict[str, str]:
+    """ consolidates the abundances and clusters into the final output files """
+    _import_module_path("output_module")
+    import client
+    stage_inputs = out_dir / "inputs" # same layout as the nextflow working directory
+    for input_name, sub_directory in (("abundances", "merge_overlap_filter"),
+                                      ("cluster_members", "genome_comparison"),
+                                      ("cluster_abundances", "genome_comparison")):
+        (stage_inputs / sub_directory).mkdir(parents=True, exist_ok=True)
+        shutil.copy(inputs[input_name], stage_inputs / sub_directory / inputs[input_name].name)
+    client.run_client(argparse.Namespace(inputdir=str(stage_inputs), outputdir=str(out_dir)))
+    shutil.rmtree(stage_inputs)
+    return {path.name: path.name for path in out_dir.iterdir() if path.is_file()}
+
+
+def _count_lines(path: Path) -> int:
+    """ number of non empty lines of a file """
+    with open(path) as file:
+        return sum(1 for line in file if line.strip())
+
+
+def normalize_reads_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    with open(outputs["reads_1"]) as reads:
+        return {"kept_reads": sum(1 for line in reads if line.startswith(">"))}
+
+
+def megahit_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    with open(outputs["contigs"]) as contigs:
+        return {"contigs": sum(1 for line in contigs if line.startswith(">"))}
+
+
+def kraken_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    _import_module_path("kraken_module")
+    from KrakenReadTable import KrakenReadTable
+    read_table = KrakenReadTable(outputs["read_table"])
+    return {"classified": len(read_table), "unclassified": read_table.unclassified_reads}
+
+
+def parse_kraken_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    return {"candidates": _count_lines(outputs["taxids"])}
+
+
+def merge_overlap_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    counts_path = outputs.get("counts")
+    return json.loads(counts_path.read_text()) if counts_path is not None and counts_path.is_file() else {}
+
+
+def genome_comparison_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    return {"genomes": _count_lines(outputs["cluster_members"]),
+            "clusters": _count_lines(outputs["cluster_abundances"])}
+
+
+def combine_output_items(outputs: Dict[str, Path]) -> Dict[str, int]:
+    return {"files": len(outputs)}
+
+
+# item counts of each stage, also used for the outputs published by nextflow
+STAGE_ITEM_COUNTERS = {"normalize_reads": normalize_reads_items,
+                       "megahit": megahit_items,
+                       "kraken_contigs": kraken_items,
+                       "kraken_reads": kraken_items,
+                       "parse_kraken": parse_kraken_items,
+                       "merge_overlap": merge_overlap_items,
+                       "genome_comparison": genome_comparison_items,
+                       "combine_output": combine_output_items}
+
+# nextflow process -> (stage name, {output name: file published under <workdir>/enrichseq})
+NEXTFLOW_STAGES = {"Run_Normalize": ("normalize_reads", {"reads_1": "megahit/normalized_1.fa"}),
+                   "Run_Megahit": ("megahit", {"contigs": "megahit/megahit_out.contigs.fa"}),
+                   "Run_Kraken": ("kraken_contigs", {"read_table": "kraken/kraken_assembled_contigs.npz"}),
+                   "Run_Kraken_Reads": ("kraken_reads", {"read_table": "kraken/kraken_reads.npz"}),
+                   "Run_KrakenParser": ("parse_kraken", {"taxids": "kraken/taxid_file.txt"}),
+                   "Run_MergeOverlap": ("merge_overlap", {"counts": "merge_overlap_filter/merge_overlap_out_counts.json"}),
+                   "Run_GenomeComparison": ("genome_comparison",
+                                            {"cluster_members": "genome_comparison/cluster_members.csv",
+                                             "cluster_abundances": "genome_comparison/cluster_abundances.csv"}),
+                   "Run_CombineOutput": ("combine_output", {})}
+
+
+def nextflow_stage_metrics(trace_path, workflow_dir) -> Dict[str, Dict]:
+    """
+    DESCRIPTION:
+        resources of each stage of a nextflow run (from its trace file),
+        with the item counts of the files it published.
+
+    OUTPUT:
+        {stage name: {"status": ..., <resources>, "items": {...}}}
+    """
+    workflow_dir = Path(workflow_dir)
+    stage_metrics = {}
+    for process, resources in run_metrics.read_nextflow_trace(trace_path).items():
+        if process not in NEXTFLOW_STAGES:
+            continue
+        stage_name, published = NEXTFLOW_STAGES[process]
+        outputs = {output_name: workflow_dir / file_name for output_name, file_name in published.items()}
+        if stage_name == "combine_output":
+            outputs = {path.name: path for path in (workflow_dir / "output_files").glob("*") if path.is_file()}
+        items = {}
+        if all(path.is_file() for path in outputs.values()):
+            items = STAGE_ITEM_COUNTERS[stage_name](outputs)
+        stage_metrics[stage_name] = {**resources, "items": items}
+    return stage_metrics
+
+
+def build_enrichseq_pipeline(runner: PipelineRunner, read_type: str, reads_1, reads_2, krakendb, genome_directory,
+                             threads: int = 4, verbose: bool = False, use_gmm: bool = False,
+                             kmer_length: int = 20, clustering_threshold: float = 0.2,
+                             kraken_min_reads: int = 0, kraken_min_fraction: float = 0.0,
+                             assembly_mode: str = "full", assembly_fraction: float = 0.1,
+                             assembly_coverage: int = 20, assembly_memory: str = "auto",
+                             sketch_bits: int = 22, sample: Optional[str] = None) -> PipelineRunner:
+    """
+    DESCRIPTION:
+        adds the EnrichSeq stages to a runner. The databases are keyed by
+        path and by the size and modification time of their index files
+        (hashing them would mean reading GBs on every run), so the stages
+        using them run again once a database is rebuilt or cleaned. With a
+        sample name, the stages are named <sample>/<stage> and published
+        to <sample>/enrichseq, so several samples can share one runner.
+        The assembly memory is a resource, so it isn't part of the key.
+        With the normalize assembly mode, the reads are normalized in a
+        stage of their own and only MEGAHIT gets the normalized reads (the
+        abundances are still estimated from every read). With the skip
+        assembly mode, there is no assembly and the candidate genomes are
+        picked from the report of the read classification (the reads are
+        classified once).
+
+    OUTPUT:
+        the runner, ready to run
+    """
+    threads = int(threads)
+    krakendb_params = {"krakendb": str(krakendb), "krakendb_signature": krakendb_signature(krakendb)}
+    genome_params = {"genome_directory": str(genome_directory),
+                     "genome_signature": genome_directory_signature(genome_directory)}
+    def name(stage_name: str) -> str:
+        return f"{sample}/{stage_name}" if sample else stage_name
+    publish = f"{sample}/{WORKFLOW}" if sample else WORKFLOW
+    reads = {"reads_1": reads_1}
+    if read_type == "paired":
+        reads["reads_2"] = reads_2
+    assembly_reads = dict(reads)
+    if assembly_mode == "normalize":
+        runner.add(Stage(name("normalize_reads"), normalize_reads_stage, executor="process", inputs=dict(reads),
+                         params={"coverage": assembly_coverage, "kmer_length": 20, "sketch_bits": sketch_bits},
+                         publish_dir=f"{publish}/megahit", item_counter=normalize_reads_items))
+        assembly_reads = {read: StageOutput(name("normalize_reads"), read) for read in reads}
+        assembly_mode = "full"
+    if assembly_mode == "skip": # the reads aren't assembled, so the read classification gives the report
+        report_stage, read_threads = name("kraken_reads"), threads
+    else: # the threads are split between the assembly branch and the raw read classification
+        read_threads = max(1, threads // 2)
+        assembly_threads = max(1, threads - read_threads)
+        runner.add(Stage(name("megahit"), megahit_stage, inputs=assembly_reads,
+                         params={"read": read_type, "mode": assembly_mode, "fraction": assembly_fraction,
+                                 "coverage": assembly_coverage},
+                         resources={"threads": assembly_threads, "memory": assembly_memory},
+                         publish_dir=f"{publish}/megahit", item_counter=megahit_items))
+        runner.add(Stage(name("kraken_contigs"), kraken_stage, inputs={"query": StageOutput(name("megahit"), "contigs")},
+                         params={**krakendb_params, "prefix": "kraken_assembled"},
+                         resources={"threads": assembly_threads}, publish_dir=f"{publish}/kraken",
+                         item_counter=kraken_items))
+        report_stage = name("kraken_contigs")
+    # the raw reads only need the input, so they are classified while the reads are assembled
+    runner.add(Stage(name("kraken_reads"), kraken_stage, inputs={"query": reads_1},
+                     params={**krakendb_params, "prefix": "kraken_reads"},
+                     resources={"threads": read_threads}, publish_dir=f"{publish}/kraken",
+                     item_counter=kraken_items))
+    runner.add(Stage(name("parse_kraken"), parse_kraken_stage,
+                     inputs={"report": StageOutput(report_stage, "report")},
+                     params={"min_reads": kraken_min_reads, "min_fraction": kraken_min_fraction},
+                     publish_dir=f"{publish}/kraken", item_counter=parse_kraken_items))
+    runner.add(Stage(name("merge_overlap"), merge_overlap_stage, executor="process",
+                     inputs={**reads, "taxids": StageOutput(name("parse_kraken"), "taxids"),
+                             "kraken_reads": StageOutput(name("kraken_reads"), "read_table")},
+                     params={**genome_params, "verbose": verbose, "use_gmm": use_gmm},
+                     resources={"threads": threads}, publish_dir=f"{publish}/merge_overlap_filter",
+                     item_counter=merge_overlap_items))
+    runner.add(Stage(name("genome_comparison"), genome_comparison_stage, executor="process",
+                     inputs={"merge_overlap": StageOutput(name("merge_overlap"))},
+                     params={**genome_params, "kmer_length": kmer_length,
+                             "threshold": clustering_threshold},
+                     publish_dir=f"{publish}/genome_comparison", item_counter=genome_comparison_items))
+    runner.add(Stage(name("combine_output"), combine_output_stage,
+                     inputs={"abundances": StageOutput(name("merge_overlap"), "abundances"),
+                             "cluster_members": StageOutput(name("genome_comparison"), "cluster_members"),
+                             "cluster_abundances": StageOutput(name("genome_comparison"), "cluster_abundances")},
+                     publish_dir=f"{publish}/output_files", item_counter=combine_output_items))
+    return runner
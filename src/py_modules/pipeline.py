@@ -0,0 +1,320 @@
+"""
+This module runs a DAG of pipeline stages in process, as an alternative
+to running the stages through nextflow.
+
+Stages whose dependencies are done run concurrently, in a thread pool
+(stages that mostly wait on a subprocess) or a process pool (stages that
+run python code). Each stage is keyed by a hash of its parameters, the
+contents of its input files and the keys of the stages it depends on. The
+outputs are cached under that key, so re-running a stage with the same
+key is skipped. The resources used by each stage (see run_metrics.py) are
+kept in its manifest and in PipelineRunner.metrics.
+
+Classes
+    1. StageOutput - reference to an output of another stage.
+    2. Stage - a step of the pipeline (function, inputs and parameters).
+    3. FileHasher - content hashes of input files, remembered by path/size/mtime.
+    4. PipelineRunner - runs stages in dependency order, with caching.
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from src.py_modules.run_metrics import StageMeter
+
+
+CACHE_DIR_NAME = ".enrichseq_cache"
+MANIFEST_NAME = "stage.json"
+
+
+class StageOutput:
+    """ reference to an output of another stage (name None for its whole directory) """
+
+    def __init__(self, stage: str, name: Optional[str] = None):
+        self.stage = stage
+        self.name = name
+
+    def __repr__(self):
+        return f"StageOutput({self.stage!r}, {self.name!r})"
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    INPUT:
+        1. stage name
+        2. function(inputs, params, out_dir) -> {output name: file name in out_dir}
+           (a top level function, so it can run in a process pool)
+        3. {input name: file path or StageOutput}
+        4. parameters (part of the cache key)
+        5. "thread" or "process"
+        6. resources (e.g. threads), passed with the parameters but not part of the key
+        7. directory (relative to the run output) the outputs are copied to, if any
+        8. version, bumped when the stage changes so old results aren't reused
+        9. function(outputs) -> {item name: count} for the run report (e.g. contigs)
+    """
+
+    def __init__(self, name: str, function: Callable, inputs: Optional[Dict[str, Union[str, Path, StageOutput]]] = None,
+                 params: Optional[Dict] = None, executor: str = "thread", resources: Optional[Dict] = None,
+                 publish_dir: Optional[str] = None, version: int = 1,
+                 item_counter: Optional[Callable[[Dict[str, Path]], Dict[str, int]]] = None):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"unknown executor: {executor}")
+        self.name = name
+        self.function = function
+        self.inputs = inputs or {}
+        self.params = params or {}
+        self.executor = executor
+        self.resources = resources or {}
+        self.publish_dir = publish_dir
+        self.version = version
+        self.item_counter = item_counter
+
+    def dependencies(self) -> List[str]:
+        """ names of the stages this stage needs outputs from """
+        return sorted({value.stage for value in self.inputs.values() if isinstance(value, StageOutput)})
+
+
+class FileHasher:
+    """
+    This hashes the contents of input files. Hashes are remembered by
+    (path, size, mtime) in a json file, so unchanged inputs aren't read again.
+    """
+
+    def __init__(self, memo_path: Union[str, Path]):
+        self.memo_path = Path(memo_path)
+        self.memo: Dict[str, str] = {}
+        if self.memo_path.is_file():
+            self.memo = json.loads(self.memo_path.read_text())
+
+    def hash(self, path: Union[str, Path]) -> str:
+        """ content hash of a file, or of every file in a directory """
+        path = Path(path).resolve()
+        if path.is_dir():
+            digest = hashlib.sha256()
+            for child in sorted(path.rglob("*")):
+                if child.is_file():
+                    digest.update(str(child.relative_to(path)).encode())
+                    digest.update(self.hash(child).encode())
+            return digest.hexdigest()
+        stat = path.stat()
+        memo_key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        if memo_key not in self.memo:
+            digest = hashlib.sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(block)
+            self.memo[memo_key] = digest.hexdigest()
+        return self.memo[memo_key]
+
+    def save(self):
+        """ saves the hashes (atomically, runners may share the cache directory) """
+        self.memo_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.memo_path.with_name(f"{self.memo_path.name}.{os.getpid()}.{id(self)}")
+        tmp_path.write_text(json.dumps(self.memo))
+        os.replace(tmp_path, self.memo_path)
+
+
+def _run_stage(function: Callable, inputs: Dict[str, str], params: Dict, out_dir: str,
+               scope: str = "thread") -> Tuple[Dict[str, str], Dict]:
+    """ runs a stage function (in a worker thread or process), returning its outputs and resources """
+    with StageMeter(scope) as meter:
+        output_names = function({name: Path(path) for name, path in inputs.items()}, params, Path(out_dir)) or {}
+    # outputs are kept relative to the stage directory, which is moved into the cache
+    output_names = {name: str(Path(file_name).relative_to(out_dir)) if Path(file_name).is_absolute() else str(file_name)
+                    for name, file_name in output_names.items()}
+    return output_names, meter.metrics
+
+
+class PipelineRunner:
+    """
+    DESCRIPTION:
+        Runs stages in dependency order, skipping stages with cached results.
+
+    INPUT:
+        1. run output directory
+        2. max stages running at once in threads
+        3. max stages running at once in processes
+        4. cache directory (default <output>/.enrichseq_cache), may be shared
+           by runners running at the same time
+    """
+
+    def __init__(self, output_dir: Union[str, Path], threads: int = 4, processes: int = 2,
+                 cache_dir: Optional[Union[str, Path]] = None):
+        self.output_dir = Path(output_dir)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else self.output_dir / CACHE_DIR_NAME
+        self.threads = max(1, int(threads))
+        self.processes = max(1, int(processes))
+        self.stages: Dict[str, Stage] = {}
+        self.keys: Dict[str, str] = {} # stage name -> cache key
+        self.outputs: Dict[str, Dict[str, Path]] = {} # stage name -> output paths
+        self.skipped: List[str] = [] # stages whose cached results were used
+        self.metrics: Dict[str, Dict] = {} # stage name -> resources and item counts
+        self.hasher = FileHasher(self.cache_dir / "file_hashes.json")
+
+    def add(self, stage: Stage) -> Stage:
+        """ adds a stage (its dependencies must be added first) """
+        if stage.name in self.stages:
+            raise ValueError(f"stage {stage.name} was already added")
+        for dependency in stage.dependencies():
+            if dependency not in self.stages:
+                raise ValueError(f"stage {stage.name} depends on unknown stage {dependency}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def stage_key(self, stage: Stage) -> str:
+        """ hash of the stage version, parameters, input contents and upstream keys """
+        key_inputs = {}
+        for input_name, value in sorted(stage.inputs.items()):
+            if isinstance(value, StageOutput):
+                key_inputs[input_name] = ["stage", self.keys[value.stage], value.name]
+            else:
+                key_inputs[input_name] = ["file", self.hasher.hash(value)]
+        key_data = {"stage": stage.name, "version": stage.version, "params": stage.params, "inputs": key_inputs}
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+    def stage_dir(self, stage: Stage) -> Path:
+        return self.cache_dir / f"{stage.name}-{self.keys[stage.name]}"
+
+    def resolve_inputs(self, stage: Stage) -> Dict[str, str]:
+        """ input paths of a stage, with stage outputs replaced by their cached files """
+        inputs = {}
+        for input_name, value in stage.inputs.items():
+            if isinstance(value, StageOutput):
+                if value.name is None:
+                    inputs[input_name] = str(self.stage_dir(self.stages[value.stage]))
+                else:
+                    inputs[input_name] = str(self.outputs[value.stage][value.name])
+            else:
+                inputs[input_name] = str(Path(value).resolve())
+        return inputs
+
+    def cached_outputs(self, stage: Stage) -> Optional[Dict[str, Path]]:
+        """ outputs of a finished stage with the same key, if any """
+        manifest_path = self.stage_dir(stage) / MANIFEST_NAME
+        if not manifest_path.is_file():
+            return None
+        manifest = json.loads(manifest_path.read_text())
+        outputs = {name: self.stage_dir(stage) / file_name for name, file_name in manifest["outputs"].items()}
+        if not all(path.exists() for path in outputs.values()):
+            return None
+        # (the resources recorded when the stage last ran)
+        self.metrics[stage.name] = {**manifest.get("metrics", {}), "status": "cached"}
+        return outputs
+
+    def run(self, thread_pool: Optional[ThreadPoolExecutor] = None,
+            process_pool: Optional[ProcessPoolExecutor] = None) -> Dict[str, Dict[str, Path]]:
+        """
+        runs every stage; returns {stage name: {output name: path}}.
+        Stages are only submitted when a worker is free, in the order they
+        were added, so the stages of earlier samples of a batch go first.
+        Pools that are passed in (e.g. kept warm by a service) are used
+        instead of new ones, and are not shut down.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        pending = dict(self.stages)
+        running = {}
+        capacity = {"thread": self.threads, "process": self.processes}
+        busy = {"thread": 0, "process": 0}
+        not_cached = set() # pending stages already checked against the cache
+        with ExitStack() as pools:
+            if thread_pool is None:
+                thread_pool = pools.enter_context(ThreadPoolExecutor(max_workers=self.threads))
+            if process_pool is None:
+                process_pool = pools.enter_context(ProcessPoolExecutor(max_workers=self.processes))
+            while pending or running:
+                progressed = True
+                while progressed: # cached stages can make more stages ready
+                    progressed = False
+                    for name in self.__ready(pending):
+                        stage = pending[name]
+                        if name not in not_cached:
+                            self.keys[name] = self.stage_key(stage)
+                            cached = self.cached_outputs(stage)
+                            if cached is not None:
+                                print(f"[{name}] cached ({self.keys[name]}), skipping")
+                                pending.pop(name)
+                                self.skipped.append(name)
+                                self.__finish(stage, cached)
+                                progressed = True
+                                continue
+                            not_cached.add(name)
+                        if busy[stage.executor] >= capacity[stage.executor]:
+                            continue
+                        pending.pop(name)
+                        # (unique, another runner sharing the cache may run the same stage)
+                        self.stage_dir(stage).parent.mkdir(parents=True, exist_ok=True)
+                        work_dir = Path(tempfile.mkdtemp(prefix=self.stage_dir(stage).name + ".tmp-",
+                                                         dir=self.stage_dir(stage).parent))
+                        pool = thread_pool if stage.executor == "thread" else process_pool
+                        print(f"[{name}] running ({self.keys[name]})")
+                        future = pool.submit(_run_stage, stage.function, self.resolve_inputs(stage),
+                                             {**stage.params, **stage.resources}, str(work_dir), stage.executor)
+                        running[future] = (stage, work_dir)
+                        busy[stage.executor] += 1
+                if not running:
+                    if pending: # nothing can run, so the dependencies can never be met
+                        raise RuntimeError(f"stages can't be scheduled: {sorted(pending)}")
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, work_dir = running.pop(future)
+                    busy[stage.executor] -= 1
+                    try:
+                        output_names, metrics = future.result()
+                    except Exception as error:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                        self.__abandon(running)
+                        raise RuntimeError(f"stage {stage.name} failed: {error}") from error
+                    self.__commit(stage, work_dir, output_names, metrics)
+        self.hasher.save()
+        return self.outputs
+
+    @staticmethod
+    def __abandon(running: Dict):
+        """ cancels the stages still running (waiting for those already started) and removes their work directories """
+        for future in running:
+            future.cancel()
+        wait(list(running))
+        for _, work_dir in running.values():
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def __ready(self, pending: Dict[str, Stage]) -> List[str]:
+        """ pending stages whose dependencies are done """
+        return [name for name, stage in pending.items()
+                if all(dependency in self.outputs for dependency in stage.dependencies())]
+
+    def __commit(self, stage: Stage, work_dir: Path, output_names: Dict[str, str], metrics: Dict):
+        """ moves a finished stage into the cache (the manifest marks it complete) """
+        items = {}
+        if stage.item_counter is not None:
+            items = stage.item_counter({name: work_dir / file_name for name, file_name in output_names.items()})
+        self.metrics[stage.name] = {"status": "completed", **metrics, "items": items}
+        manifest = {"stage": stage.name, "key": self.keys[stage.name], "params": stage.params,
+                    "outputs": {name: str(file_name) for name, file_name in output_names.items()},
+                    "metrics": {**metrics, "items": items}}
+        (work_dir / MANIFEST_NAME).write_text(json.dumps(manifest, indent=1, default=str))
+        stage_dir = self.stage_dir(stage)
+        if (stage_dir / MANIFEST_NAME).is_file(): # another runner finished the same stage first
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            os.replace(work_dir, stage_dir)
+        self.__finish(stage, {name: stage_dir / file_name for name, file_name in output_names.items()})
+
+    def __finish(self, stage: Stage, outputs: Dict[str, Path]):
+        """ records the outputs of a stage and copies them to its publish directory """
+        self.outputs[stage.name] = outputs
+        if stage.publish_dir is None:
+            return
+        publish_dir = self.output_dir / stage.publish_dir
+        publish_dir.mkdir(parents=True, exist_ok=True)
+        for path in outputs.values():
+            if path.is_file():
+                shutil.copy2(path, publish_dir / path.name)
@@ -0,0 +1,224 @@
+"""
+This module measures the resources used by each stage of a run (wall
+time, CPU time, peak RSS, bytes read and written) and writes them, with
+the item counts of each stage, to a JSON run report.
+
+The native engine measures stages with a StageMeter (in the thread or
+process running the stage). Subprocesses started through call() are
+added to the meter of the stage that started them. For nextflow runs,
+the resources are read from the nextflow trace file.
+
+Classes
+    1. StageMeter - measures the resources used while a stage runs.
+
+Methods
+    1. call - runs a command, adding its resources to the running stage.
+    2. read_nextflow_trace - resources of each process of a nextflow trace.
+    3. write_run_metrics - writes the run report (run_metrics.json).
+"""
+import os
+import json
+import time
+import datetime
+import threading
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
+
+
+RUN_METRICS_NAME = "run_metrics.json"
+RESOURCE_FIELDS = ("wall_time_s", "cpu_time_s", "peak_rss_bytes", "read_bytes", "write_bytes")
+_ACTIVE = threading.local() # meter of the stage running in this thread
+
+
+def _read_io(io_path: str) -> Tuple[int, int]:
+    """ (bytes read, bytes written) from a /proc io file, (0, 0) if unavailable """
+    try:
+        with open(io_path) as io_file:
+            fields = dict(line.split(":") for line in io_file if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peak_rss(reset: bool = False) -> int:
+    """ peak resident memory of this process in bytes (reset clears it first, on linux) """
+    if reset:
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+        except OSError:
+            pass
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+
+class StageMeter:
+    """
+    DESCRIPTION:
+        Measures the resources used while a stage runs (use as a context
+        manager). With the "thread" scope, CPU time and IO are those of
+        the calling thread, and the peak RSS that of the whole process
+        (shared with the other thread stages). With the "process" scope
+        (a worker process running one stage at a time) they are those of
+        the process. Both include the subprocesses started with call().
+
+    INPUT:
+        1. scope ("thread" or "process")
+    """
+
+    def __init__(self, scope: str = "thread"):
+        if scope not in ("thread", "process"):
+            raise ValueError(f"unknown scope: {scope}")
+        self.scope = scope
+        self.metrics: Dict[str, float] = {}
+        self.items: Dict[str, int] = {}
+        self.children = {"cpu_time_s": 0.0, "peak_rss_bytes": 0, "read_bytes": 0, "write_bytes": 0}
+
+    def __io_path(self) -> str:
+        if self.scope == "process":
+            return "/proc/self/io"
+        if not hasattr(threading, "get_native_id"): # (python < 3.8, the IO of thread stages isn't recorded)
+            return ""
+        return f"/proc/self/task/{threading.get_native_id()}/io"
+
+    def __cpu_time(self) -> float:
+        return time.process_time() if self.scope == "process" else time.thread_time()
+
+    def __enter__(self) -> "StageMeter":
+        self._previous = getattr(_ACTIVE, "meter", None)
+        _ACTIVE.meter = self
+        self._peak_start = _peak_rss(reset=self.scope == "process")
+        self._start = (time.perf_counter(), self.__cpu_time(), _read_io(self.__io_path()))
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_start, cpu_start, (read_start, write_start) = self._start
+        read_end, write_end = _read_io(self.__io_path())
+        self.metrics = {"wall_time_s": time.perf_counter() - wall_start,
+                        "cpu_time_s": self.__cpu_time() - cpu_start + self.children["cpu_time_s"],
+                        "peak_rss_bytes": max(_peak_rss(), self.children["peak_rss_bytes"]),
+                        "read_bytes": read_end - read_start + self.children["read_bytes"],
+                        "write_bytes": write_end - write_start + self.children["write_bytes"]}
+        _ACTIVE.meter = self._previous
+        return False
+
+    def add_child(self, cpu_time_s: float, peak_rss_bytes: int, read_bytes: int, write_bytes: int):
+        """ adds the resources of a finished subprocess """
+        self.children["cpu_time_s"] += cpu_time_s
+        self.children["peak_rss_bytes"] = max(self.children["peak_rss_bytes"], peak_rss_bytes)
+        self.children["read_bytes"] += read_bytes
+        self.children["write_bytes"] += write_bytes
+
+    def to_dict(self) -> Dict:
+        return {**self.metrics, "items": dict(self.items)}
+
+
+def active_meter() -> Optional[StageMeter]:
+    """ meter of the stage running in this thread, if any """
+    return getattr(_ACTIVE, "meter", None)
+
+
+def _exit_code(status: int) -> int:
+    """ return code of a wait status (minus the signal number if killed, as subprocess reports it) """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def call(CMD_list: List) -> subprocess.CompletedProcess:
+    """
+    DESCRIPTION:
+        runs a command (like utils.subproc_call), adding its CPU time,
+        peak RSS and IO (including the processes it waited for) to the
+        meter of the running stage.
+    """
+    process = subprocess.Popen([str(arg) for arg in CMD_list])
+    meter = active_meter()
+    if meter is None or not hasattr(os, "wait4"):
+        return subprocess.CompletedProcess(process.args, process.wait())
+    # wait without reaping, so the io counters of the exited process can still be read
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    read_bytes, write_bytes = _read_io(f"/proc/{process.pid}/io")
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = _exit_code(status)
+    if read_bytes == 0 and write_bytes == 0: # no /proc, use the block counts
+        read_bytes, write_bytes = usage.ru_inblock * 512, usage.ru_oublock * 512
+    meter.add_child(usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024, read_bytes, write_bytes)
+    return subprocess.CompletedProcess(process.args, process.returncode)
+
+
+def _trace_number(value: str) -> float:
+    """ value of a raw nextflow trace field ('-' when not recorded) """
+    value = value.strip().rstrip("%")
+    return float(value) if value not in ("", "-") else 0.0
+
+
+def read_nextflow_trace(trace_path: Union[str, Path]) -> Dict[str, Dict]:
+    """
+    DESCRIPTION:
+        reads a nextflow trace file written with raw = true and the fields
+        process, status, realtime, %cpu, peak_rss, rchar and wchar.
+
+    OUTPUT:
+        {process name: resources}, the last task of each process
+        (status "cached" for tasks reused with -resume)
+    """
+    processes = {}
+    with open(trace_path) as trace_file:
+        header = trace_file.readline().rstrip("\n").split("\t")
+        for line in trace_file:
+            task = dict(zip(header, line.rstrip("\n").split("\t")))
+            if "process" not in task:
+                continue
+            wall_time_s = _trace_number(task.get("realtime", "-")) / 1000
+            processes[task["process"]] = {
+                "status": "cached" if task.get("status") == "CACHED" else task.get("status", "").lower(),
+                "wall_time_s": wall_time_s,
+                "cpu_time_s": wall_time_s * _trace_number(task.get("%cpu", "-")) / 100,
+                "peak_rss_bytes": int(_trace_number(task.get("peak_rss", "-"))),
+                "read_bytes": int(_trace_number(task.get("rchar", "-"))),
+                "write_bytes": int(_trace_number(task.get("wchar", "-"))),
+            }
+    return processes
+
+
+def write_run_metrics(output_dir: Union[str, Path], engine: str, stages: Dict[str, Dict],
+                      wall_time_s: float) -> Path:
+    """
+    DESCRIPTION:
+        writes the run report to <output_dir>/run_metrics.json. The totals
+        only count the stages that ran (cached stages keep the resources
+        recorded when they last ran).
+
+    INPUT:
+        1. run output directory
+        2. engine name
+        3. {stage name: {"status": ..., <RESOURCE_FIELDS>, "items": {...}}}
+        4. wall time of the whole run
+    """
+    ran = [metrics for metrics in stages.values() if metrics.get("status") != "cached"]
+    totals = {"wall_time_s": wall_time_s,
+              "cpu_time_s": sum(metrics.get("cpu_time_s", 0.0) for metrics in ran),
+              "peak_rss_bytes": max((metrics.get("peak_rss_bytes", 0) for metrics in ran), default=0),
+              "read_bytes": sum(metrics.get("read_bytes", 0) for metrics in ran),
+              "write_bytes": sum(metrics.get("write_bytes", 0) for metrics in ran)}
+    report = {"engine": engine,
+              "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+              "totals": totals,
+              "stages": stages}
+    report_path = Path(output_dir) / RUN_METRICS_NAME
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    return report_path
@@ -0,0 +1,97 @@
+import pytest
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.py_modules.enrichseq_batch import read_sample_sheet, abundance_matrix_stage, build_batch_pipeline, Sample
+from src.py_modules.pipeline import PipelineRunner
+
+
+@pytest.fixture
+def sheet_dir(tmp_path):
+    for reads in ("s1_1.fa", "s1_2.fa", "s2.fa"):
+        (tmp_path / reads).write_text(">r\nACGT\n")
+    return tmp_path
+
+
+def test_read_sample_sheet(sheet_dir):
+    sheet = sheet_dir / "sheet.tsv"
+    sheet.write_text("sample\treads_1\treads_2\n# comment\nS1\ts1_1.fa\ts1_2.fa\nS2\ts2.fa\n")
+    samples = read_sample_sheet(sheet)
+    assert [sample.name for sample in samples] == ["S1", "S2"]
+    assert samples[0].read_type == "paired"
+    assert samples[0].reads_2 == str(sheet_dir / "s1_2.fa")
+    assert samples[1] == Sample("S2", str(sheet_dir / "s2.fa"))
+    assert samples[1].read_type == "single"
+
+
+@pytest.mark.parametrize("sheet_text, error", [
+    ("name\treads_1\nS1\ts2.fa\n", ValueError), # missing column
+    ("sample\treads_1\nS1\ts2.fa\nS1\ts2.fa\n", ValueError), # duplicate name
+    ("sample\treads_1\n../S1\ts2.fa\n", ValueError), # not a directory name
+    ("sample\treads_1\nS1\tmissing.fa\n", FileNotFoundError),
+    ("sample\treads_1\n", ValueError), # no samples
+])
+def test_read_sample_sheet_errors(sheet_dir, sheet_text, error):
+    sheet = sheet_dir / "sheet.tsv"
+    sheet.write_text(sheet_text)
+    with pytest.raises(error):
+        read_sample_sheet(sheet)
+
+
+def test_abundance_matrix_stage(tmp_path):
+    (tmp_path / "a.csv").write_text("10868,0.5\nUNK,0.5\n")
+    (tmp_path / "b.csv").write_text("2886930,0.25\n10868,0.25\nUNK,0.5\n")
+    abundance_matrix_stage({"A": tmp_path / "a.csv", "B": tmp_path / "b.csv"}, {"samples": ["A", "B"]}, tmp_path)
+    rows = [line.split("\t") for line in (tmp_path / "abundance_matrix.tsv").read_text().splitlines()]
+    assert rows == [["taxid", "A", "B"], ["10868", "0.5", "0.25"], ["2886930", "0.0", "0.25"], ["UNK", "0.5", "0.5"]]
+
+
+def test_build_batch_pipeline(tmp_path):
+    samples = [Sample("S1", "s1_1.fa", "s1_2.fa"), Sample("S2", "s2.fa")]
+    runner = build_batch_pipeline(PipelineRunner(tmp_path), samples, "krakendb", "genomes", threads=8, parallel_samples=2)
+    assert "S1/merge_overlap" in runner.stages and "S2/combine_output" in runner.stages
+    assert runner.stages["S1/merge_overlap"].resources["threads"] == 4
+    # the assembly and the raw read classification run at the same time, on half of the threads each
+    assert runner.stages["S1/megahit"].resources["threads"] + runner.stages["S1/kraken_reads"].resources["threads"] == 4
+    assert "reads_2" not in runner.stages["S2/megahit"].inputs
+    assert runner.stages["S2/merge_overlap"].publish_dir == "S2/enrichseq/merge_overlap_filter"
+    assert runner.stages["abundance_matrix"].dependencies() == ["S1/merge_overlap", "S2/merge_overlap"]
+
+
+def test_build_batch_pipeline_normalized_assembly(tmp_path):
+    samples = [Sample("S1", "s1_1.fa", "s1_2.fa")]
+    runner = build_batch_pipeline(PipelineRunner(tmp_path), samples, "krakendb", "genomes", assembly_mode="normalize")
+    # only the assembly gets the normalized reads
+    assert runner.stages["S1/megahit"].dependencies() == ["S1/normalize_reads"]
+    assert runner.stages["S1/megahit"].params["mode"] == "full"
+    assert runner.stages["S1/merge_overlap"].inputs["reads_1"] == "s1_1.fa"
+
+
+def test_build_batch_pipeline_skipped_assembly(tmp_path):
+    samples = [Sample("S1", "s1_1.fa", "s1_2.fa")]
+    runner = build_batch_pipeline(PipelineRunner(tmp_path), samples, "krakendb", "genomes", threads=8,
+                                  parallel_samples=1, assembly_mode="skip")
+    # the reads are classified once, and that report gives the candidate genomes
+    assert "S1/megahit" not in runner.stages and "S1/kraken_contigs" not in runner.stages
+    assert runner.stages["S1/parse_kraken"].dependencies() == ["S1/kraken_reads"]
+    assert runner.stages["S1/kraken_reads"].resources["threads"] == 8
+
+
+def test_build_batch_pipeline_database_signature(sheet_dir):
+    (sheet_dir / "krakendb").mkdir()
+    (sheet_dir / "krakendb" / "hash.k2d").write_text("hash")
+    (sheet_dir / "genomes").mkdir()
+    def stage_keys():
+        runner = build_batch_pipeline(PipelineRunner(sheet_dir / "out"), [Sample("S1", str(sheet_dir / "s2.fa"))],
+                                      sheet_dir / "krakendb", sheet_dir / "genomes")
+        return (runner.stage_key(runner.stages["S1/kraken_reads"]),
+                runner.stages["S1/merge_overlap"].params, runner.stages["S1/genome_comparison"].params)
+    kraken_key, merge_overlap_params, genome_comparison_params = stage_keys()
+    assert stage_keys()[0] == kraken_key
+    # rebuilt kraken database, cleaned genome directory
+    (sheet_dir / "krakendb" / "hash.k2d").write_text("rebuilt hash")
+    (sheet_dir / ".genomes.sequence_aliases.tsv").write_text("alias\n")
+    new_kraken_key, new_merge_overlap_params, new_genome_comparison_params = stage_keys()
+    assert new_kraken_key != kraken_key
+    assert new_merge_overlap_params["genome_signature"] != merge_overlap_params["genome_signature"]
+    assert new_genome_comparison_params["genome_signature"] != genome_comparison_params["genome_signature"]
@@ -0,0 +1,112 @@
+import pytest
+import sys
+import os
+import time
+import threading
+from pathlib import Path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.py_modules.enrichseq_service import EnrichSeqService, EnrichSeqClient, ServiceError, make_server
+from src.py_modules.pipeline import Stage, StageOutput
+
+
+RELEASE_JOBS = threading.Event()
+
+''' toy job: the abundance of each read name '''
+def abundance_stage(inputs, params, out_dir):
+    if params["block"]:
+        RELEASE_JOBS.wait(timeout=30)
+    names = [line[1:].strip() for line in Path(inputs["reads_1"]).read_text().splitlines() if line.startswith(">")]
+    (out_dir / "abundances.csv").write_text("".join(f"{name},{names.count(name) / len(names)}\n"
+                                                    for name in sorted(set(names))))
+    return {"abundances": "abundances.csv"}
+
+def toy_job_pipeline(runner, request, settings):
+    runner.add(Stage("abundance", abundance_stage, inputs={"reads_1": request["reads_1"]},
+                     params={"block": request.get("name") == "block"}))
+    return StageOutput("abundance", "abundances")
+
+
+@pytest.fixture
+def reads_path(tmp_path):
+    reads_path = tmp_path / "reads.fa"
+    reads_path.write_text(">a\nACGT\n>a\nACGT\n>b\nACGT\n>a\nACGT\n")
+    return reads_path
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def client_service(request, tmp_path):
+    service = EnrichSeqService(tmp_path / "service", settings={}, max_jobs=1, queue_size=1,
+                               builder=toy_job_pipeline, warm_workers=False).start()
+    if request.param == "unix":
+        server = make_server(service, socket_path=str(tmp_path / "enrichseq.sock"))
+        client = EnrichSeqClient(socket_path=str(tmp_path / "enrichseq.sock"))
+    else:
+        server = make_server(service, port=0)
+        client = EnrichSeqClient(port=server.server_address[1])
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    RELEASE_JOBS.clear()
+    yield client, service
+    RELEASE_JOBS.set()
+    server.shutdown()
+    server.server_close()
+    service.stop()
+
+
+def test_service_runs_jobs(client_service, reads_path):
+    client, service = client_service
+    job = client.submit(reads_path, name="sample")
+    assert job["status"] in ("queued", "running")
+    job = client.wait(job["job_id"], poll_interval=0.05, timeout=30)
+    assert job["status"] == "done"
+    assert job["abundances"] == {"a": 0.75, "b": 0.25}
+    assert job["timings"]["run_s"] >= 0 and job["timings"]["queue_wait_s"] >= 0
+    assert job["stages"]["abundance"]["status"] == "completed"
+    assert (service.output_dir / "jobs" / job["job_id"] / "run_metrics.json").is_file()
+    # the stage cache is shared by the jobs
+    job = client.wait(client.submit(reads_path)["job_id"], poll_interval=0.05, timeout=30)
+    assert job["stages"]["abundance"]["status"] == "cached"
+    assert [listed["job_id"] for listed in client.jobs()][-1] == job["job_id"]
+    assert client.health()["done"] == 2
+
+
+def test_service_bounded_queue(client_service, reads_path):
+    client, service = client_service
+    running = client.submit(reads_path, name="block") # holds the only job worker
+    while client.status(running["job_id"])["status"] == "queued":
+        pass
+    client.submit(reads_path, name="other") # fills the queue
+    with pytest.raises(ServiceError) as error:
+        client.submit(reads_path)
+    assert error.value.status == 503
+    assert client.health()["running"] == 1 and client.health()["queued"] == 1
+    RELEASE_JOBS.set()
+    assert client.wait(running["job_id"], poll_interval=0.05, timeout=30)["status"] == "done"
+
+
+def test_service_errors(client_service, tmp_path):
+    client, service = client_service
+    with pytest.raises(ServiceError) as error:
+        client.submit(tmp_path / "missing.fa")
+    assert error.value.status == 400
+    with pytest.raises(ServiceError) as error:
+        client.status("unknown")
+    assert error.value.status == 404
+
+
+def test_service_forgets_old_jobs(tmp_path, reads_path):
+    service = EnrichSeqService(tmp_path / "service", settings={}, max_finished_jobs=1,
+                               builder=toy_job_pipeline, warm_workers=False).start()
+    try:
+        job_ids = []
+        for _ in range(3):
+            job = service.submit({"reads_1": str(reads_path)})
+            job_ids.append(job.job_id)
+            while job.status not in ("done", "failed"):
+                time.sleep(0.01)
+        # the first job was forgotten when the third was submitted
+        assert service.job(job_ids[0]) is None
+        assert service.job(job_ids[1]).status == "done" and service.job(job_ids[2]) is not None
+        assert service.health()["done"] == 2
+    finally:
+        service.stop()
@@ -0,0 +1,112 @@
+import pytest
+import sys
+import os
+import time
+from pathlib import Path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.py_modules.pipeline import PipelineRunner, Stage, StageOutput
+
+
+''' Stage functions (top level, so they can run in a process pool) '''
+def count_stage(inputs, params, out_dir):
+    lines = Path(inputs["text"]).read_text().splitlines()
+    (out_dir / "count.txt").write_text(str(len(lines) * params["scale"]))
+    return {"count": "count.txt"}
+
+def report_stage(inputs, params, out_dir):
+    count = int(Path(inputs["count"]).read_text())
+    (out_dir / "report.txt").write_text(f"{params['label']}: {count}")
+    return {"report": out_dir / "report.txt"}
+
+def failing_stage(inputs, params, out_dir):
+    raise ValueError("broken stage")
+
+def slow_stage(inputs, params, out_dir):
+    time.sleep(0.3)
+    (out_dir / "slow.txt").write_text("done")
+    return {"slow": "slow.txt"}
+
+
+def count_items(outputs):
+    return {"count": int(outputs["count"].read_text())}
+
+
+def build_runner(output_dir, text_path, scale=2, label="lines", executor="thread"):
+    runner = PipelineRunner(output_dir, threads=2, processes=1)
+    runner.add(Stage("count", count_stage, inputs={"text": text_path}, params={"scale": scale}, executor=executor,
+                     item_counter=count_items))
+    runner.add(Stage("report", report_stage, inputs={"count": StageOutput("count", "count")},
+                     params={"label": label}, publish_dir="reports"))
+    return runner
+
+
+@pytest.fixture
+def text_path(tmp_path):
+    text_path = tmp_path / "input.txt"
+    text_path.write_text("a\nb\nc\n")
+    return text_path
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_pipeline_runs_and_publishes(tmp_path, text_path, executor):
+    outputs = build_runner(tmp_path / "out", text_path, executor=executor).run()
+    assert outputs["report"]["report"].read_text() == "lines: 6"
+    assert (tmp_path / "out" / "reports" / "report.txt").read_text() == "lines: 6"
+
+
+def test_pipeline_skips_cached_stages(tmp_path, text_path):
+    build_runner(tmp_path / "out", text_path).run()
+    runner = build_runner(tmp_path / "out", text_path)
+    runner.run()
+    assert runner.skipped == ["count", "report"]
+    # a downstream parameter only reruns the downstream stage
+    runner = build_runner(tmp_path / "out", text_path, label="total")
+    outputs = runner.run()
+    assert runner.skipped == ["count"]
+    assert outputs["report"]["report"].read_text() == "total: 6"
+    # new input contents rerun everything
+    text_path.write_text("a\n")
+    runner = build_runner(tmp_path / "out", text_path, label="total")
+    outputs = runner.run()
+    assert runner.skipped == []
+    assert outputs["report"]["report"].read_text() == "total: 2"
+
+
+def test_pipeline_failing_stage(tmp_path, text_path):
+    runner = PipelineRunner(tmp_path / "out")
+    runner.add(Stage("broken", failing_stage, inputs={"text": text_path}))
+    with pytest.raises(RuntimeError):
+        runner.run()
+    # failed stages aren't cached
+    assert not list((tmp_path / "out" / ".enrichseq_cache").glob("broken-*/stage.json"))
+
+
+def test_pipeline_failing_stage_cleanup(tmp_path, text_path):
+    runner = PipelineRunner(tmp_path / "out", threads=2)
+    runner.add(Stage("slow", slow_stage, inputs={"text": text_path}))
+    runner.add(Stage("broken", failing_stage, inputs={"text": text_path}))
+    with pytest.raises(RuntimeError):
+        runner.run()
+    # the work directories of the failed stage and of the stage still running are removed
+    assert not list((tmp_path / "out" / ".enrichseq_cache").rglob("*.tmp-*"))
+
+
+def test_pipeline_unknown_dependency(tmp_path):
+    runner = PipelineRunner(tmp_path / "out")
+    with pytest.raises(ValueError):
+        runner.add(Stage("report", report_stage, inputs={"count": StageOutput("count", "count")}))
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_pipeline_metrics(tmp_path, text_path, executor):
+    runner = build_runner(tmp_path / "out", text_path, executor=executor)
+    runner.run()
+    assert runner.metrics["count"]["status"] == "completed"
+    assert runner.metrics["count"]["items"] == {"count": 6}
+    assert runner.metrics["count"]["wall_time_s"] >= 0
+    assert runner.metrics["count"]["peak_rss_bytes"] > 0
+    # cached stages keep the resources of the run that made them
+    runner = build_runner(tmp_path / "out", text_path, executor=executor)
+    runner.run()
+    assert runner.metrics["count"]["status"] == "cached"
+    assert runner.metrics["count"]["items"] == {"count": 6}
@@ -0,0 +1,59 @@
+import pytest
+import sys
+import os
+import json
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import src.py_modules.run_metrics as run_metrics
+
+
+def test_stage_meter_measures_subprocesses(tmp_path):
+    out_path = tmp_path / "out.bin"
+    with run_metrics.StageMeter("thread") as meter:
+        out = run_metrics.call([sys.executable, "-c",
+                                f"open({str(out_path)!r}, 'wb').write(b'x' * 1000000); sum(range(3000000))"])
+    assert out.returncode == 0
+    assert meter.metrics["cpu_time_s"] > 0
+    assert meter.metrics["peak_rss_bytes"] > 0
+    if os.path.exists("/proc/self/io"):
+        assert meter.metrics["write_bytes"] >= 1000000
+    assert run_metrics.active_meter() is None
+
+
+def test_call_without_meter():
+    assert run_metrics.call([sys.executable, "-c", "import sys; sys.exit(3)"]).returncode == 3
+
+
+def test_call_exit_codes():
+    with run_metrics.StageMeter("thread"):
+        assert run_metrics.call([sys.executable, "-c", "import sys; sys.exit(3)"]).returncode == 3
+        assert run_metrics.call([sys.executable, "-c", "import os; os.kill(os.getpid(), 9)"]).returncode == -9
+
+
+def test_thread_meter_without_native_id(monkeypatch):
+    monkeypatch.delattr(run_metrics.threading, "get_native_id", raising=False)
+    with run_metrics.StageMeter("thread") as meter:
+        run_metrics.call([sys.executable, "-c", "pass"])
+    assert meter.metrics["read_bytes"] >= 0 and meter.metrics["cpu_time_s"] >= 0
+
+
+def test_read_nextflow_trace(tmp_path):
+    trace_path = tmp_path / "trace.txt"
+    trace_path.write_text("task_id\tprocess\tstatus\trealtime\t%cpu\tpeak_rss\trchar\twchar\n"
+                          "1\tRun_Megahit\tCOMPLETED\t2000\t150.0\t1048576\t100\t200\n"
+                          "2\tRun_Kraken\tCACHED\t500\t-\t-\t-\t-\n")
+    processes = run_metrics.read_nextflow_trace(trace_path)
+    assert processes["Run_Megahit"] == {"status": "completed", "wall_time_s": 2.0, "cpu_time_s": 3.0,
+                                        "peak_rss_bytes": 1048576, "read_bytes": 100, "write_bytes": 200}
+    assert processes["Run_Kraken"]["status"] == "cached"
+    assert processes["Run_Kraken"]["cpu_time_s"] == 0.0
+
+
+def test_write_run_metrics(tmp_path):
+    stages = {"a": {"status": "completed", "cpu_time_s": 1.0, "peak_rss_bytes": 10, "read_bytes": 1, "write_bytes": 2},
+              "b": {"status": "completed", "cpu_time_s": 2.0, "peak_rss_bytes": 30, "read_bytes": 3, "write_bytes": 4},
+              "c": {"status": "cached", "cpu_time_s": 50.0, "peak_rss_bytes": 99, "read_bytes": 5, "write_bytes": 6}}
+    report = json.loads(run_metrics.write_run_metrics(tmp_path, "native", stages, 4.0).read_text())
+    assert report["engine"] == "native"
+    assert report["totals"] == {"wall_time_s": 4.0, "cpu_time_s": 3.0, "peak_rss_bytes": 30,
+                                "read_bytes": 4, "write_bytes": 6}
+    assert set(report["stages"]) == {"a", "b", "c"}
@@ -7,21 +7,21 @@ Usage:
 python compare.py <simulated_fasta> <CSV>
 """
 from pathlib import Path
+import os
 import sys
 import json 
+# in house packages
+current_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(f"{current_path}/../modules/accession_module")
+from AccessionIndex import accession_index
 
 
 
 
 def make_dir():
+    """ seqid to taxid index of the kraken map (built on first use, see accession_module) """
     ncbi2taxid = "database_prev/krakenDB/seqid2taxid.map"
-    dictionary = {}
-    with open(ncbi2taxid) as ncbi2taxid:
-        lines = ncbi2taxid.readlines()
-        for line in lines:
-            ncbi, taxid = line.replace("\n","").split("\t")
-            dictionary[ncbi] = taxid
-    return dictionary
+    return accession_index(ncbi2taxid, key_column=0, taxid_column=1)
 
 def parse_simulated_fasta(fasta_path):
     """                          
@@ -54,7 +54,7 @@ def parse_simulated_fasta(fasta_path):
                 ncbi_id = line[1:].split("|")[0].split("-")[0]
                 # dictioinary from FastViromeExplorer, obtained above
                 if ncbi_id in dictionary:
-                    name = dictionary[line[1:].split("|")[0].split("-")[0]]
+                    name = str(dictionary[ncbi_id])
                 else:
                     file_name = line[1:].split("|")[-1].strip("\n")
                     path = Path("database_changingKraken/ref_genomes/" + file_name)
@@ -10,6 +10,9 @@ python db_compare.py ref_genomes/ krakenDB/seqid2taxid.map
 from typing import Dict
 import glob
 import sys
+import os
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/../modules/fasta_module")
+from FastaIndex import read_fasta
 
 
 
@@ -19,19 +22,7 @@ def fasta2dict(genome_path) -> Dict:
     Input: <str> a path of directory genomes
     Output: <Dict> name2seq
     """
-    name2seq : Dict = {}
-    seq_name : str = ""
-    with open(genome_path) as fasta_dir:
-        curr_line = fasta_dir.readline()
-        while (curr_line):
-            if (">" == curr_line[0]):
-                seq_name = curr_line[1:].strip("\n")
-                name2seq[seq_name] = ""
-            else:
-                name2seq[seq_name] += curr_line.strip("\n")
-            # read next line below; close
-            curr_line = fasta_dir.readline()
-    return name2seq
+    return {record.header: record.sequence for record in read_fasta(genome_path)}
 
 def parse_seqid2taxid(seqid2taxid_path):
     """